@@ -0,0 +1,138 @@
+import sys
+import json
+import time
+
+# -------------------------
+# Benchmark: armado de puntos (caso nacional, sin filtros)
+#   - "iterrows": el bucle anterior de /api/points y /api/points_integral
+#   - "vectorizado": registros_* de geoespacial.py
+#   - además compara json.dumps vs orjson para el payload final
+#
+# Uso:  python bench_points.py [repeticiones]
+# -------------------------
+import geoespacial as g
+
+REPS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+# -------------------------
+# Referencia: bucles iterrows originales
+# -------------------------
+def iterrows_atms(dff):
+    puntos = []
+    for _, r in dff.iterrows():
+        nombre = ""
+        if g.COL_NAME and g.COL_NAME in r.index:
+            nombre = str(r.get(g.COL_NAME, "")).strip()
+        if not nombre:
+            nombre = str(r.get(g.COL_ATM, ""))
+
+        lat_v = float(r[g.COL_LAT])
+        lon_v = float(r[g.COL_LON])
+        puntos.append({
+            "lat": lat_v,
+            "lon": lon_v,
+            "atm": str(r.get(g.COL_ATM, "")),
+            "nombre": nombre,
+            "promedio": float(r.get(g.PROM_COL, 0.0)),
+            "division": str(r.get(g.COL_DIV, "")),
+            "tipo": str(r.get(g.COL_TIPO, "")),
+            "ubicacion": str(r.get(g.COL_UBIC, "")),
+            "departamento": str(r.get(g.COL_DEPT, "")),
+            "provincia": str(r.get(g.COL_PROV, "")),
+            "distrito": str(r.get(g.COL_DIST, "")),
+            "direccion": g.get_address(lat_v, lon_v),
+            "capa": "",
+        })
+    return puntos
+
+def iterrows_agentes(dff):
+    puntos = []
+    for _, r in dff.iterrows():
+        puntos.append({
+            "lat": float(r[g.COLA_LAT]),
+            "lon": float(r[g.COLA_LON]),
+            "atm": str(r.get(g.COLA_ID, "")),
+            "nombre": str(r.get(g.COLA_COM, "")),
+            "promedio": float(r.get(g.PROMA_COL, 0.0)),
+            "division": str(r.get(g.COLA_DIV, "")),
+            "tipo": "AGENTE",
+            "ubicacion": "AGENTE",
+            "departamento": str(r.get(g.COLA_DEPT, "")),
+            "provincia": str(r.get(g.COLA_PROV, "")),
+            "distrito": str(r.get(g.COLA_DIST, "")),
+            "direccion": str(r.get(g.COLA_DIR, "")),
+            "capa": str(r.get(g.COLA_CAPA, "")),
+            "trxs_oct": float(r.get(g.COLA_TRX_OCT, 0.0)) if g.COLA_TRX_OCT else 0.0,
+            "trxs_nov": float(r.get(g.COLA_TRX_NOV, 0.0)) if g.COLA_TRX_NOV else 0.0,
+        })
+    return puntos
+
+def iterrows_oficinas(dff):
+    puntos = []
+    for _, r in dff.iterrows():
+        puntos.append({
+            "lat": float(r[g.COLF_LAT]),
+            "lon": float(r[g.COLF_LON]),
+            "atm": str(r.get(g.COLF_ID, "")),
+            "nombre": str(r.get(g.COLF_NAME, "")),
+            "promedio": float(r.get(g.COLF_TRX, 0.0)),
+            "division": str(r.get(g.COLF_DIV, "")),
+            "tipo": "OFICINA",
+            "ubicacion": "OFICINA",
+            "departamento": str(r.get(g.COLF_DEPT, "")),
+            "provincia": str(r.get(g.COLF_PROV, "")),
+            "distrito": str(r.get(g.COLF_DIST, "")),
+            "direccion": "No disponible (a incorporar)",
+            "capa": "",
+            "estructura_as": float(r.get(g.COLF_EAS, 0.0)),
+            "estructura_ebp": float(r.get(g.COLF_EBP, 0.0)),
+            "estructura_ad": float(r.get(g.COLF_EAD, 0.0)),
+            "clientes_unicos": int(r.get(g.COLF_CLI, 0)),
+            "total_tickets": int(r.get(g.COLF_TKT, 0)),
+            "red_lines": float(r.get(g.COLF_RED, 0.0)),
+        })
+    return puntos
+
+# -------------------------
+# Medición
+# -------------------------
+def medir(fn, *args):
+    mejor = float("inf")
+    out = None
+    for _ in range(REPS):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        mejor = min(mejor, time.perf_counter() - t0)
+    return mejor, out
+
+# la referencia queda fija: campos que el endpoint agregó después no se
+# comparan, ni la dirección de oficinas (antes "No disponible")
+CASOS = [
+    ("ATMs", g.df, iterrows_atms, g.registros_atms, set()),
+    ("Agentes", g.df_agentes, iterrows_agentes, g.registros_agentes, set()),
+    ("Oficinas", g.df_oficinas, iterrows_oficinas, g.registros_oficinas, {"direccion"}),
+]
+
+def comparable(puntos, claves):
+    return [{k: p.get(k) for k in claves} for p in puntos]
+
+print(f"Benchmark nacional sin filtros (mejor de {REPS})")
+print(f"{'capa':10s} {'filas':>7s} {'iterrows ms':>12s} {'vector ms':>10s} {'speedup':>8s}")
+
+payload = {}
+for nombre, frame, ref, nuevo, ignorar in CASOS:
+    t_ref, out_ref = medir(ref, frame)
+    t_new, out_new = medir(nuevo, frame)
+    claves = [k for k in (out_ref[0] if out_ref else {}) if k not in ignorar]
+    if comparable(out_ref, claves) != comparable(out_new, claves):
+        raise SystemExit(f"❌ {nombre}: el resultado vectorizado no coincide con iterrows")
+    payload[nombre] = out_new
+    print(f"{nombre:10s} {len(frame):7d} {t_ref*1000:12.1f} {t_new*1000:10.1f} {t_ref/max(t_new, 1e-9):7.1f}x")
+
+t_json, _ = medir(lambda: json.dumps(payload, ensure_ascii=False))
+print(f"\njson.dumps: {t_json*1000:.1f} ms")
+if g.orjson is not None:
+    t_orjson, _ = medir(lambda: g.orjson.dumps(payload))
+    print(f"orjson.dumps: {t_orjson*1000:.1f} ms ({t_json/max(t_orjson, 1e-9):.1f}x)")
+else:
+    print("orjson no instalado (se usa jsonify)")
@@ -15,6 +15,17 @@ import os
 import re
 import unicodedata
 import json
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.request import pathname2url
+import tempfile
+import sqlite3
+import shutil
+import struct
+import math
 import pandas as pd
 import numpy as np
 from flask import (
@@ -22,20 +33,17 @@ from flask import (
     render_template_string,
     request,
     jsonify,
+    make_response,
     redirect,
     url_for,
     session,
 )
 from functools import wraps
 
-# ============================================
-# RECOMENDACIONES – CARGA BÁSICA
-# ============================================
 try:
-    recomendaciones = pd.read_csv("data/recomendaciones.csv")
-except Exception as e:
-    print("⚠ No se pudo cargar recomendaciones.csv:", e)
-    recomendaciones = pd.DataFrame()
+    import orjson
+except ImportError:  # fallback: jsonify estándar
+    orjson = None
 
 # ============================================================
 # NUEVO — Cargar base de clientes
@@ -48,21 +56,234 @@ df_clientes = df_clientes[
 SEGMENTOS_CLIENTES = sorted(df_clientes["segmento"].dropna().astype(str).unique().tolist())
 
 # ============================================================
-# 1. CACHE DE DIRECCIONES
+# 1. CACHE DE DIRECCIONES ✅ (SQLite compartido, clave entera)
+#   - Clave canónica: lat/lon cuantizadas a 1e-6 grados en un solo entero,
+#     así "-12.09375" y "-12.093750" son la misma ubicación
+#   - address_cache.json (lo escribe precache_addresses.py) se migra a
+#     ADDRESS_DB al arrancar, solo si el JSON cambió desde la última migración
+#   - Cada hilo abre la base en solo lectura: los workers de gunicorn
+#     comparten el cache de páginas del SO en vez de un dict por proceso
 # ============================================================
 CACHE_FILE = "address_cache.json"
-if os.path.exists(CACHE_FILE):
-    with open(CACHE_FILE, "r", encoding="utf-8") as f:
-        address_cache = json.load(f)
-else:
-    address_cache = {}
+ADDRESS_DB = os.getenv("ADDRESS_DB", os.path.join("data", "address_cache.sqlite"))
+DIRECCION_NO_ENCONTRADA = "Dirección no encontrada"
+DIRECCIONES_STATS = {"hits": 0, "misses": 0, "aproximadas": 0}
+_DIRECCIONES_LOCK = threading.Lock()
+_direcciones_local = threading.local()
+
+def _escribir_atomico(path, escribir):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+    os.close(fd)
+    try:
+        escribir(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
 
-def get_address(lat, lon):
+def clave_direccion(lat, lon):
+    """
+    Entero canónico de (lat, lon) cuantizadas a 1e-6 grados. Acepta arrays.
+    """
+    qlat = np.rint(np.asarray(lat, dtype=float) * 1e6).astype(np.int64) + 90_000_000
+    qlon = np.rint(np.asarray(lon, dtype=float) * 1e6).astype(np.int64) + 180_000_000
+    return qlat * 400_000_000 + qlon
+
+def _huella_json(path):
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+def _fuente_migrada(db_path):
     try:
-        key = f"{float(lat):.6f},{float(lon):.6f}"
-    except Exception:
-        key = f"{lat},{lon}"
-    return address_cache.get(key, "Dirección no encontrada")
+        con = sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro", uri=True)
+        try:
+            fila = con.execute("SELECT v FROM meta WHERE k = 'fuente'").fetchone()
+        finally:
+            con.close()
+        return fila[0] if fila else None
+    except sqlite3.Error:
+        return None
+
+def migrar_direcciones(json_path, db_path):
+    """
+    Importa address_cache.json (claves "lat,lon" en cualquier formato) a la
+    tabla direcciones(clave, direccion). Devuelve cuántas quedaron.
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        crudo = json.load(f)
+    filas = {}
+    for k, v in crudo.items():
+        try:
+            lat, lon = (float(x) for x in k.split(","))
+        except ValueError:
+            continue
+        filas[int(clave_direccion(lat, lon))] = v
+
+    def escribir(tmp):
+        con = sqlite3.connect(tmp)
+        try:
+            con.execute("CREATE TABLE direcciones (clave INTEGER PRIMARY KEY, direccion TEXT NOT NULL)")
+            con.execute("CREATE TABLE meta (k TEXT PRIMARY KEY, v TEXT)")
+            con.executemany("INSERT INTO direcciones VALUES (?, ?)", sorted(filas.items()))
+            con.execute("INSERT INTO meta VALUES ('fuente', ?)", (_huella_json(json_path),))
+            con.commit()
+        finally:
+            con.close()
+
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    _escribir_atomico(db_path, escribir)
+    return len(filas)
+
+if os.path.exists(CACHE_FILE) and _fuente_migrada(ADDRESS_DB) != _huella_json(CACHE_FILE):
+    try:
+        n = migrar_direcciones(CACHE_FILE, ADDRESS_DB)
+        print(f"✅ Direcciones migradas a SQLite: {n} ({ADDRESS_DB})")
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print("⚠ No se pudo migrar address_cache.json:", e)
+
+def _conexion_direcciones():
+    con = getattr(_direcciones_local, "con", None)
+    # con gunicorn --preload el worker hereda la conexión abierta al importar:
+    # SQLite no admite usarla tras fork(), se abre una propia por proceso
+    if con is not None and getattr(_direcciones_local, "pid", None) != os.getpid():
+        con = None
+    if con is None and os.path.exists(ADDRESS_DB):
+        con = sqlite3.connect(f"file:{pathname2url(os.path.abspath(ADDRESS_DB))}?mode=ro", uri=True)
+        _direcciones_local.con = con
+        _direcciones_local.pid = os.getpid()
+    return con
+
+def _contar_direcciones(hits, misses, aproximadas=0):
+    with _DIRECCIONES_LOCK:
+        DIRECCIONES_STATS["hits"] += hits
+        DIRECCIONES_STATS["misses"] += misses
+        DIRECCIONES_STATS["aproximadas"] += aproximadas
+
+def _buscar_claves(con, claves):
+    encontradas = {}
+    unicas = list(set(claves))
+    for i in range(0, len(unicas), 500):
+        lote = unicas[i:i + 500]
+        encontradas.update(con.execute(
+            f"SELECT clave, direccion FROM direcciones WHERE clave IN ({','.join('?' * len(lote))})", lote
+        ).fetchall())
+    return encontradas
+
+# ------------------------------------------------------------
+# 1B. VECINO MÁS CERCANO (fallback sin red) ✅
+#   - Grilla de celdas del tamaño del radio sobre las coordenadas con
+#     dirección: un fallo exacto mira solo las 3x3 celdas vecinas
+#   - Dentro de ADDRESS_NN_RADIO_M metros devuelve la más cercana,
+#     marcada como aproximada (0 desactiva el fallback)
+# ------------------------------------------------------------
+ADDRESS_NN_RADIO_M = float(os.getenv("ADDRESS_NN_RADIO_M", "30"))
+_M_POR_GRADO = 111_320.0
+
+def construir_vecinos(con):
+    claves = np.fromiter((r[0] for r in con.execute("SELECT clave FROM direcciones")), dtype=np.int64)
+    if len(claves) == 0 or ADDRESS_NN_RADIO_M <= 0:
+        return None
+    lats = (claves // 400_000_000 - 90_000_000) / 1e6
+    lons = (claves % 400_000_000 - 180_000_000) / 1e6
+    # celda >= radio también en longitud (los grados de lon se achican con la latitud)
+    celda = ADDRESS_NN_RADIO_M / (_M_POR_GRADO * np.cos(np.radians(min(np.abs(lats).max(), 80.0))))
+    cid = np.floor(lats / celda).astype(np.int64) * 10_000_000 + np.floor(lons / celda).astype(np.int64)
+    orden = np.argsort(cid, kind="stable")
+    return {"celda": celda, "cid": cid[orden], "claves": claves[orden], "lats": lats[orden], "lons": lons[orden]}
+
+def vecino_direccion(lat, lon):
+    """
+    Clave de la dirección en cache más cercana a (lat, lon) dentro del
+    radio, o None.
+    """
+    v = DIRECCIONES_VECINOS
+    if v is None or not (np.isfinite(lat) and np.isfinite(lon)):
+        return None
+    iy = int(np.floor(lat / v["celda"]))
+    ix = int(np.floor(lon / v["celda"]))
+    filas = (np.arange(iy - 1, iy + 2, dtype=np.int64)) * 10_000_000
+    lo = np.searchsorted(v["cid"], filas + ix - 1, side="left")
+    hi = np.searchsorted(v["cid"], filas + ix + 1, side="right")
+    cand = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)])
+    if len(cand) == 0:
+        return None
+    dy = (v["lats"][cand] - lat) * _M_POR_GRADO
+    dx = (v["lons"][cand] - lon) * _M_POR_GRADO * np.cos(np.radians(lat))
+    d2 = dx * dx + dy * dy
+    j = int(np.argmin(d2))
+    return int(v["claves"][cand[j]]) if d2[j] <= ADDRESS_NN_RADIO_M ** 2 else None
+
+_con = _conexion_direcciones()
+DIRECCIONES_VECINOS = construir_vecinos(_con) if _con is not None else None
+
+def resolver_direcciones(lats, lons):
+    """
+    (direcciones, aproximadas) para listas de coordenadas: búsqueda exacta
+    en lotes de 500 claves y, para las que fallan, el vecino más cercano.
+    """
+    try:
+        claves = clave_direccion(lats, lons).tolist()
+    except (TypeError, ValueError):
+        pares = [resolver_direccion(la, lo) for la, lo in zip(lats, lons)]
+        return [p[0] for p in pares], [p[1] for p in pares]
+    con = _conexion_direcciones()
+    if con is None:
+        _contar_direcciones(0, len(claves))
+        return [DIRECCION_NO_ENCONTRADA] * len(claves), [False] * len(claves)
+
+    encontradas = _buscar_claves(con, claves)
+    vecinos = {}
+    for k, la, lo in zip(claves, lats, lons):
+        if k not in encontradas and k not in vecinos:
+            vecinos[k] = vecino_direccion(float(la), float(lo))
+    cercanas = _buscar_claves(con, [c for c in vecinos.values() if c is not None])
+
+    out, aprox = [], []
+    hits = aproximadas = 0
+    for k in claves:
+        if k in encontradas:
+            out.append(encontradas[k])
+            aprox.append(False)
+            hits += 1
+        elif vecinos.get(k) in cercanas:
+            out.append(cercanas[vecinos[k]])
+            aprox.append(True)
+            aproximadas += 1
+        else:
+            out.append(DIRECCION_NO_ENCONTRADA)
+            aprox.append(False)
+    _contar_direcciones(hits, len(claves) - hits, aproximadas)
+    return out, aprox
+
+def get_addresses(lats, lons):
+    return resolver_direcciones(lats, lons)[0]
+
+def resolver_direccion(lat, lon):
+    """
+    (direccion, aproximada) de una coordenada.
+    """
+    try:
+        # mismo redondeo que clave_direccion (round() y np.rint son half-even)
+        lat, lon = float(lat), float(lon)
+        clave = (round(lat * 1e6) + 90_000_000) * 400_000_000 + round(lon * 1e6) + 180_000_000
+    except (TypeError, ValueError, OverflowError):
+        _contar_direcciones(0, 1)
+        return DIRECCION_NO_ENCONTRADA, False
+    con = _conexion_direcciones()
+    if con is None:
+        _contar_direcciones(0, 1)
+        return DIRECCION_NO_ENCONTRADA, False
+    fila = con.execute("SELECT direccion FROM direcciones WHERE clave = ?", (clave,)).fetchone()
+    if fila:
+        _contar_direcciones(1, 0)
+        return fila[0], False
+    cercana = vecino_direccion(lat, lon)
+    fila = con.execute("SELECT direccion FROM direcciones WHERE clave = ?", (cercana,)).fetchone() if cercana else None
+    _contar_direcciones(0, 1, 1 if fila else 0)
+    return (fila[0], True) if fila else (DIRECCION_NO_ENCONTRADA, False)
+
+def get_address(lat, lon):
+    return resolver_direccion(lat, lon)[0]
 
 # ============================================================
 # HELPERS
@@ -106,39 +327,115 @@ def norm_txt(s):
     s = re.sub(r"\s+", " ", s).strip()
     return s
 
-def nodo_categoria(nombre: str) -> str:
+# ------------------------------------------------------------
+# Reglas de categoría de NODOS (Panel Comercial)
+#   - Se evalúan en orden: gana la primera regla que calza
+#   - "contiene": subcadenas; "palabra": palabras completas
+#   - "resumen": clave del conteo en /api/nodos
+#   - NODO_REGLAS_FILE=reglas.json reemplaza la lista (mismo formato)
+# ------------------------------------------------------------
+NODO_REGLAS = [
+    {"categoria": "PLAZA_VEA", "resumen": "plaza_vea", "contiene": ["PLAZA VEA", "PLAZAVEA"]},
+    {"categoria": "SODIMAC", "resumen": "sodimac", "contiene": ["SODIMAC"]},
+    # METRO (supermercado) -> palabra completa
+    {"categoria": "METRO", "resumen": "metro", "palabra": ["METRO"]},
+    {"categoria": "TOTTUS", "resumen": "tottus", "contiene": ["TOTTUS"]},
+    {"categoria": "WONG", "resumen": "wong", "contiene": ["WONG"]},
+    # categorías generales
+    {"categoria": "HOSPITAL", "resumen": "hospitales", "contiene": ["HOSPITAL"]},
+    {"categoria": "CLINICA", "resumen": "clinicas", "contiene": ["CLINICA", "CLINIC"]},
+    {"categoria": "UNIVERSIDAD", "resumen": "universidades", "contiene": ["UNIVERSIDAD"], "palabra": ["UNIV"]},
+    {"categoria": "MERCADO", "resumen": "mercados", "contiene": ["MERCADO", "MARKET", "FERIA"]},
+    {"categoria": "CENTRO_COMERCIAL", "resumen": "centros_comerciales",
+     "contiene": ["CENTRO COMERCIAL", "C.C", "MALL", "SHOPPING"]},
+]
+NODO_OTRO = "OTRO"
+
+NODO_REGLAS_FILE = os.getenv("NODO_REGLAS_FILE", "")
+
+def validar_reglas_nodos(reglas):
     """
-    Clasifica NODOS1.xlsx por el campo NOMBRE (heurística por keywords).
-    Devuelve categorías usadas por el Panel Comercial.
+    ValueError si las reglas no tienen el formato de NODO_REGLAS.
     """
-    n = norm_txt(nombre)
+    if not isinstance(reglas, list) or not reglas:
+        raise ValueError("se esperaba una lista de reglas no vacía")
+    for i, r in enumerate(reglas):
+        if not isinstance(r, dict):
+            raise ValueError(f"regla {i}: no es un objeto")
+        if not isinstance(r.get("categoria"), str) or not r["categoria"].strip():
+            raise ValueError(f"regla {i}: falta 'categoria'")
+        if "resumen" in r and not isinstance(r["resumen"], str):
+            raise ValueError(f"regla {i}: 'resumen' debe ser texto")
+        claves = []
+        for campo in ("contiene", "palabra"):
+            v = r.get(campo, [])
+            if not isinstance(v, list) or not all(isinstance(k, str) and k.strip() for k in v):
+                raise ValueError(f"regla {i}: '{campo}' debe ser una lista de textos")
+            claves += v
+        if not claves:
+            raise ValueError(f"regla {i}: necesita 'contiene' o 'palabra'")
+
+if NODO_REGLAS_FILE:
+    try:
+        with open(NODO_REGLAS_FILE, "r", encoding="utf-8") as f:
+            _reglas = json.load(f)
+        validar_reglas_nodos(_reglas)
+        NODO_REGLAS = _reglas
+        print(f"✅ Reglas de nodos: {len(NODO_REGLAS)} desde {NODO_REGLAS_FILE}")
+    except Exception as e:
+        print("⚠ No se pudieron leer las reglas de nodos, uso las de fábrica:", e)
 
-    # orden importa
-    if "PLAZA VEA" in n or "PLAZAVEA" in n:
-        return "PLAZA_VEA"
-    if "SODIMAC" in n:
-        return "SODIMAC"
-    # METRO (supermercado) -> palabra completa
-    if re.search(r"\bMETRO\b", n):
-        return "METRO"
-    if "TOTTUS" in n:
-        return "TOTTUS"
-    if "WONG" in n:
-        return "WONG"
+def compilar_reglas_nodos(reglas):
+    """
+    Un solo regex para todas las reglas: una alternativa anclada al inicio
+    por regla, cada una con lookahead. La alternancia se prueba en orden,
+    así que el grupo que calza es el de la primera regla (misma prioridad
+    que los if encadenados).
+    """
+    alternativas = []
+    for i, r in enumerate(reglas):
+        partes = [re.escape(norm_txt(k)) for k in r.get("contiene", [])]
+        partes += [rf"\b{re.escape(norm_txt(k))}\b" for k in r.get("palabra", [])]
+        if partes:
+            alternativas.append(rf"(?=.*?(?:{'|'.join(partes)}))(?P<r{i}>)")
+    return re.compile(rf"^(?:{'|'.join(alternativas)})" if alternativas else r"(?!)")
+
+NODO_PATRON = compilar_reglas_nodos(NODO_REGLAS)
+# varias reglas pueden compartir categoría: código de categoría por regla
+NODO_CATEGORIAS = list(dict.fromkeys([r["categoria"] for r in NODO_REGLAS] + [NODO_OTRO]))
+NODO_CODIGO_REGLA = np.array([NODO_CATEGORIAS.index(r["categoria"]) for r in NODO_REGLAS], dtype=np.int64)
+NODO_CODIGO_OTRO = NODO_CATEGORIAS.index(NODO_OTRO)
+
+def norm_txt_series(s):
+    """
+    norm_txt vectorizado sobre una Serie.
+    """
+    s = s.astype(str).str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("utf-8")
+    return s.str.upper().str.replace(r"\s+", " ", regex=True).str.strip()
 
-    # categorías generales
-    if "HOSPITAL" in n:
-        return "HOSPITAL"
-    if "CLINICA" in n or "CLINIC" in n:
-        return "CLINICA"
-    if "UNIVERSIDAD" in n or re.search(r"\bUNIV\b", n):
-        return "UNIVERSIDAD"
-    if "MERCADO" in n or "MARKET" in n or "FERIA" in n:
-        return "MERCADO"
-    if "CENTRO COMERCIAL" in n or "C.C" in n or "MALL" in n or "SHOPPING" in n:
-        return "CENTRO_COMERCIAL"
+def categorizar_nodos(nombres):
+    """
+    Clasifica NODOS1.xlsx por el campo NOMBRE (heurística por keywords)
+    sobre la Serie completa: Categorical con NODO_CATEGORIAS.
+    Cada nombre distinto se normaliza y evalúa una sola vez.
+    """
+    codigos_nombre, unicos = pd.factorize(pd.Series(nombres, dtype=object).astype(str))
+    orden = {f"r{i}": int(c) for i, c in enumerate(NODO_CODIGO_REGLA)}
+    por_unico = np.array(
+        [orden[m.lastgroup] if m else NODO_CODIGO_OTRO
+         for m in map(NODO_PATRON.match, norm_txt_series(pd.Series(unicos, dtype=object)))],
+        dtype=np.int64,
+    )
+    return pd.Categorical.from_codes(por_unico[codigos_nombre], categories=NODO_CATEGORIAS)
 
-    return "OTRO"
+def nodo_categoria(nombre: str) -> str:
+    """
+    Categoría de un solo NOMBRE (mismas reglas que categorizar_nodos).
+    """
+    m = NODO_PATRON.match(norm_txt(nombre))
+    if m is None:
+        return NODO_OTRO
+    return NODO_REGLAS[int(m.lastgroup[1:])]["categoria"]
 
 # ============================================================
 # 2. CARGAR EXCEL PRINCIPAL (ISLAS / ATMs)
@@ -148,57 +445,61 @@ excel_main = os.path.join(BASE_DIR, "data", "Mapa Geoespacial ATM (1) (1).xlsx")
 if not os.path.exists(excel_main):
     raise FileNotFoundError("No encontré archivo Excel de ATMs.")
 
-raw = pd.read_excel(excel_main)
-norm_map = {normalize_col(c): c for c in raw.columns}
-
-def find_col(keys):
-    for norm, orig in norm_map.items():
-        for k in keys:
-            if k in norm:
-                return orig
-    return None
-
-COL_ATM  = find_col(["COD_ATM", "ATM"]) or "ATM"
-COL_NAME = find_col(["NOMBRE", "CAJERO"]) or None
-COL_DEPT = find_col(["DEPARTAMENTO"]) or "DEPARTAMENTO"
-COL_PROV = find_col(["PROVINCIA"]) or "PROVINCIA"
-COL_DIST = find_col(["DISTRITO"]) or "DISTRITO"
-COL_LAT  = find_col(["LATITUD", "LAT"]) or "LATITUD"
-COL_LON  = find_col(["LONGITUD", "LON"]) or "LONGITUD"
-COL_DIV  = find_col(["DIVISION", "DIVISIÓN"]) or "DIVISIÓN"
-COL_TIPO = find_col(["TIPO"]) or "TIPO"
-COL_UBIC = find_col(["UBICACION", "UBICACIÓN", "UBICACION INTERNA"]) or "UBICACION_INTERNA"
-PROM_COL = find_col(["PROMEDIO", "PROM"]) or None
-
-if PROM_COL is None:
-    raw["PROM_FAKE"] = 0.0
-    PROM_COL = "PROM_FAKE"
-
-for c in [COL_ATM, COL_DEPT, COL_PROV, COL_DIST, COL_LAT, COL_LON, COL_DIV, COL_TIPO, COL_UBIC, PROM_COL]:
-    if c not in raw.columns:
-        raw[c] = ""
-
-df = raw.copy()
-
-df[COL_LAT] = (
-    df[COL_LAT].astype(str)
-    .str.replace(",", ".", regex=False)
-    .str.replace(r"[^\d\.\-]", "", regex=True)
-    .replace("", np.nan)
-    .astype(float)
-)
-df[COL_LON] = (
-    df[COL_LON].astype(str)
-    .str.replace(",", ".", regex=False)
-    .str.replace(r"[^\d\.\-]", "", regex=True)
-    .replace("", np.nan)
-    .astype(float)
-)
-df = df.dropna(subset=[COL_LAT, COL_LON]).reset_index(drop=True)
+def _cargar_atms(path):
+    raw = pd.read_excel(path)
+    norm_map = {normalize_col(c): c for c in raw.columns}
+
+    def find_col(keys):
+        for norm, orig in norm_map.items():
+            for k in keys:
+                if k in norm:
+                    return orig
+        return None
+
+    cols = {}
+    cols["COL_ATM"]  = find_col(["COD_ATM", "ATM"]) or "ATM"
+    cols["COL_NAME"] = find_col(["NOMBRE", "CAJERO"]) or None
+    cols["COL_DEPT"] = find_col(["DEPARTAMENTO"]) or "DEPARTAMENTO"
+    cols["COL_PROV"] = find_col(["PROVINCIA"]) or "PROVINCIA"
+    cols["COL_DIST"] = find_col(["DISTRITO"]) or "DISTRITO"
+    cols["COL_LAT"]  = find_col(["LATITUD", "LAT"]) or "LATITUD"
+    cols["COL_LON"]  = find_col(["LONGITUD", "LON"]) or "LONGITUD"
+    cols["COL_DIV"]  = find_col(["DIVISION", "DIVISIÓN"]) or "DIVISIÓN"
+    cols["COL_TIPO"] = find_col(["TIPO"]) or "TIPO"
+    cols["COL_UBIC"] = find_col(["UBICACION", "UBICACIÓN", "UBICACION INTERNA"]) or "UBICACION_INTERNA"
+    cols["PROM_COL"] = find_col(["PROMEDIO", "PROM"]) or None
+
+    if cols["PROM_COL"] is None:
+        raw["PROM_FAKE"] = 0.0
+        cols["PROM_COL"] = "PROM_FAKE"
+
+    for k in ["COL_ATM", "COL_DEPT", "COL_PROV", "COL_DIST", "COL_LAT", "COL_LON", "COL_DIV", "COL_TIPO", "COL_UBIC", "PROM_COL"]:
+        if cols[k] not in raw.columns:
+            raw[cols[k]] = ""
+
+    c_lat, c_lon = cols["COL_LAT"], cols["COL_LON"]
+    out = raw.copy()
+
+    out[c_lat] = (
+        out[c_lat].astype(str)
+        .str.replace(",", ".", regex=False)
+        .str.replace(r"[^\d\.\-]", "", regex=True)
+        .replace("", np.nan)
+        .astype(float)
+    )
+    out[c_lon] = (
+        out[c_lon].astype(str)
+        .str.replace(",", ".", regex=False)
+        .str.replace(r"[^\d\.\-]", "", regex=True)
+        .replace("", np.nan)
+        .astype(float)
+    )
+    out = out.dropna(subset=[c_lat, c_lon]).reset_index(drop=True)
 
-df[PROM_COL] = pd.to_numeric(df[PROM_COL], errors="coerce").fillna(0.0)
-df[COL_TIPO] = df[COL_TIPO].astype(str).fillna("")
-df[COL_UBIC] = df[COL_UBIC].astype(str).fillna("")
+    out[cols["PROM_COL"]] = pd.to_numeric(out[cols["PROM_COL"]], errors="coerce").fillna(0.0)
+    out[cols["COL_TIPO"]] = out[cols["COL_TIPO"]].astype(str).fillna("")
+    out[cols["COL_UBIC"]] = out[cols["COL_UBIC"]].astype(str).fillna("")
+    return out, cols
 
 # ============================================================
 # 2B. CARGAR EXCEL DE AGENTES
@@ -207,52 +508,56 @@ excel_agentes = os.path.join(BASE_DIR, "data", "AGENTES.xlsx")
 if not os.path.exists(excel_agentes):
     raise FileNotFoundError("No encontré Excel de AGENTES.xlsx.")
 
-raw_ag = pd.read_excel(excel_agentes)
-norm_map_ag = {normalize_col(c): c for c in raw_ag.columns}
-
-def find_col_ag(keys):
-    for norm, orig in norm_map_ag.items():
-        for k in keys:
-            if k in norm:
-                return orig
-    return None
-
-COLA_ID   = find_col_ag(["TERMINAL", "ID"]) or "TERMINAL"
-COLA_COM  = find_col_ag(["COMERCIO"]) or "COMERCIO"
-COLA_DEPT = find_col_ag(["DEPARTAMENTO"]) or "DEPARTAMENTO"
-COLA_PROV = find_col_ag(["PROVINCIA"]) or "PROVINCIA"
-COLA_DIST = find_col_ag(["DISTRITO"]) or "DISTRITO"
-COLA_LAT  = find_col_ag(["LATITUD", "LAT"]) or "LATITUD"
-COLA_LON  = find_col_ag(["LONGITUD", "LON"]) or "LONGITUD"
-COLA_DIV  = find_col_ag(["DIVISION", "DIVISIÓN"]) or "DIVISION"
-COLA_DIR  = find_col_ag(["DIRECCION", "DIRECCIÓN"]) or "DIRECCION"
-COLA_CAPA = find_col_ag(["CAPA"]) or "CAPA"
-COLA_TRX_OCT = find_col_ag(["TRXS OCTUBRE", "TRX OCTUBRE"]) or None
-COLA_TRX_NOV = find_col_ag(["TRXS NOV", "TRXS NOVIEMBRE"]) or None
-PROMA_COL = find_col_ag(["PROMEDIO", "PROM"]) or None
-
-if PROMA_COL is None:
-    raw_ag["PROM_FAKE"] = 0.0
-    PROMA_COL = "PROM_FAKE"
-
-raw_ag[COLA_LAT] = (
-    raw_ag[COLA_LAT].astype(str)
-    .str.replace(",", ".", regex=False)
-    .str.replace(r"[^\d\.\-]", "", regex=True)
-    .replace("", np.nan)
-    .astype(float)
-)
-raw_ag[COLA_LON] = (
-    raw_ag[COLA_LON].astype(str)
-    .str.replace(",", ".", regex=False)
-    .str.replace(r"[^\d\.\-]", "", regex=True)
-    .replace("", np.nan)
-    .astype(float)
-)
+def _cargar_agentes(path):
+    raw_ag = pd.read_excel(path)
+    norm_map_ag = {normalize_col(c): c for c in raw_ag.columns}
+
+    def find_col_ag(keys):
+        for norm, orig in norm_map_ag.items():
+            for k in keys:
+                if k in norm:
+                    return orig
+        return None
+
+    cols = {}
+    cols["COLA_ID"]   = find_col_ag(["TERMINAL", "ID"]) or "TERMINAL"
+    cols["COLA_COM"]  = find_col_ag(["COMERCIO"]) or "COMERCIO"
+    cols["COLA_DEPT"] = find_col_ag(["DEPARTAMENTO"]) or "DEPARTAMENTO"
+    cols["COLA_PROV"] = find_col_ag(["PROVINCIA"]) or "PROVINCIA"
+    cols["COLA_DIST"] = find_col_ag(["DISTRITO"]) or "DISTRITO"
+    cols["COLA_LAT"]  = find_col_ag(["LATITUD", "LAT"]) or "LATITUD"
+    cols["COLA_LON"]  = find_col_ag(["LONGITUD", "LON"]) or "LONGITUD"
+    cols["COLA_DIV"]  = find_col_ag(["DIVISION", "DIVISIÓN"]) or "DIVISION"
+    cols["COLA_DIR"]  = find_col_ag(["DIRECCION", "DIRECCIÓN"]) or "DIRECCION"
+    cols["COLA_CAPA"] = find_col_ag(["CAPA"]) or "CAPA"
+    cols["COLA_TRX_OCT"] = find_col_ag(["TRXS OCTUBRE", "TRX OCTUBRE"]) or None
+    cols["COLA_TRX_NOV"] = find_col_ag(["TRXS NOV", "TRXS NOVIEMBRE"]) or None
+    cols["PROMA_COL"] = find_col_ag(["PROMEDIO", "PROM"]) or None
+
+    if cols["PROMA_COL"] is None:
+        raw_ag["PROM_FAKE"] = 0.0
+        cols["PROMA_COL"] = "PROM_FAKE"
+
+    c_lat, c_lon = cols["COLA_LAT"], cols["COLA_LON"]
+    raw_ag[c_lat] = (
+        raw_ag[c_lat].astype(str)
+        .str.replace(",", ".", regex=False)
+        .str.replace(r"[^\d\.\-]", "", regex=True)
+        .replace("", np.nan)
+        .astype(float)
+    )
+    raw_ag[c_lon] = (
+        raw_ag[c_lon].astype(str)
+        .str.replace(",", ".", regex=False)
+        .str.replace(r"[^\d\.\-]", "", regex=True)
+        .replace("", np.nan)
+        .astype(float)
+    )
 
-df_agentes = raw_ag.dropna(subset=[COLA_LAT, COLA_LON]).reset_index(drop=True)
-df_agentes[PROMA_COL] = pd.to_numeric(df_agentes[PROMA_COL], errors="coerce").fillna(0.0)
-df_agentes[COLA_CAPA] = df_agentes[COLA_CAPA].astype(str).fillna("")
+    out = raw_ag.dropna(subset=[c_lat, c_lon]).reset_index(drop=True)
+    out[cols["PROMA_COL"]] = pd.to_numeric(out[cols["PROMA_COL"]], errors="coerce").fillna(0.0)
+    out[cols["COLA_CAPA"]] = out[cols["COLA_CAPA"]].astype(str).fillna("")
+    return out, cols
 
 # ============================================================
 # 2C. CARGAR EXCEL DE OFICINAS  ✅ (AHORA CON COLUMNAS NUEVAS)
@@ -261,62 +566,62 @@ excel_oficinas = os.path.join(BASE_DIR, "data", "OFICINAS.xlsx")
 if not os.path.exists(excel_oficinas):
     raise FileNotFoundError("No encontré Excel de OFICINAS.xlsx.")
 
-raw_of = pd.read_excel(excel_oficinas)
-norm_map_of = {normalize_col(c): c for c in raw_of.columns}
-
-def find_col_of(keys):
-    for norm, orig in norm_map_of.items():
-        for k in keys:
-            if k in norm:
-                return orig
-    return None
-
-COLF_ID   = find_col_of(["COD OFIC", "COD. OFIC", "COD_OFIC"]) or "COD OFIC."
-COLF_NAME = find_col_of(["OFICINA"]) or "OFICINA"
-COLF_DIV  = find_col_of(["DIVISION", "DIVISIÓN"]) or "DIVISION"
-COLF_DEPT = find_col_of(["DEPARTAMENTO"]) or "DEPARTAMENTO"
-COLF_PROV = find_col_of(["PROVINCIA"]) or "PROVINCIA"
-COLF_DIST = find_col_of(["DISTRITO"]) or "DISTRITO"
-COLF_LAT  = find_col_of(["LATITUD", "LAT"]) or "LATITUD"
-COLF_LON  = find_col_of(["LONGITUD", "LON"]) or "LONGITUD"
-COLF_TRX  = find_col_of(["TRX", "TRXS"]) or "TRX"
-
-# ✅ NUEVAS COLUMNAS (PROMEDIOS)
-COLF_EAS = find_col_of(["ESTRUCTURA AS", "ESTRUCTURA_AS"]) or "ESTRUCTURA AS"
-COLF_EBP = find_col_of(["ESTRUCTURA EBP", "ESTRUCTURA_EBP"]) or "ESTRUCTURA EBP"
-COLF_EAD = find_col_of(["ESTRUCTURA AD", "ESTRUCTURA_AD"]) or "ESTRUCTURA AD"
-COLF_CLI = find_col_of(["CLIENTES UNICOS", "CLIENTES ÚNICOS", "CLIENTES_UNICOS"]) or "CLIENTES UNICOS"
-COLF_TKT = find_col_of(["TOTAL_TICKETS", "TOTAL TICKETS"]) or "TOTAL_TICKETS"
-COLF_RED = find_col_of(["RED LINES", "REDLINES", "RED_LINES"]) or "RED LINES"
-
-for c in [COLF_EAS, COLF_EBP, COLF_EAD, COLF_CLI, COLF_TKT, COLF_RED]:
-    if c not in raw_of.columns:
-        raw_of[c] = 0
-
-raw_of[COLF_LAT] = (
-    raw_of[COLF_LAT].astype(str)
-    .str.replace(",", ".", regex=False)
-    .str.replace(r"[^\d\.\-]", "", regex=True)
-    .replace("", np.nan)
-    .astype(float)
-)
-raw_of[COLF_LON] = (
-    raw_of[COLF_LON].astype(str)
-    .str.replace(",", ".", regex=False)
-    .str.replace(r"[^\d\.\-]", "", regex=True)
-    .replace("", np.nan)
-    .astype(float)
-)
+def _cargar_oficinas(path):
+    raw_of = pd.read_excel(path)
+    norm_map_of = {normalize_col(c): c for c in raw_of.columns}
+
+    def find_col_of(keys):
+        for norm, orig in norm_map_of.items():
+            for k in keys:
+                if k in norm:
+                    return orig
+        return None
+
+    cols = {}
+    cols["COLF_ID"]   = find_col_of(["COD OFIC", "COD. OFIC", "COD_OFIC"]) or "COD OFIC."
+    cols["COLF_NAME"] = find_col_of(["OFICINA"]) or "OFICINA"
+    cols["COLF_DIV"]  = find_col_of(["DIVISION", "DIVISIÓN"]) or "DIVISION"
+    cols["COLF_DEPT"] = find_col_of(["DEPARTAMENTO"]) or "DEPARTAMENTO"
+    cols["COLF_PROV"] = find_col_of(["PROVINCIA"]) or "PROVINCIA"
+    cols["COLF_DIST"] = find_col_of(["DISTRITO"]) or "DISTRITO"
+    cols["COLF_LAT"]  = find_col_of(["LATITUD", "LAT"]) or "LATITUD"
+    cols["COLF_LON"]  = find_col_of(["LONGITUD", "LON"]) or "LONGITUD"
+    cols["COLF_TRX"]  = find_col_of(["TRX", "TRXS"]) or "TRX"
+
+    # ✅ NUEVAS COLUMNAS (PROMEDIOS)
+    cols["COLF_EAS"] = find_col_of(["ESTRUCTURA AS", "ESTRUCTURA_AS"]) or "ESTRUCTURA AS"
+    cols["COLF_EBP"] = find_col_of(["ESTRUCTURA EBP", "ESTRUCTURA_EBP"]) or "ESTRUCTURA EBP"
+    cols["COLF_EAD"] = find_col_of(["ESTRUCTURA AD", "ESTRUCTURA_AD"]) or "ESTRUCTURA AD"
+    cols["COLF_CLI"] = find_col_of(["CLIENTES UNICOS", "CLIENTES ÚNICOS", "CLIENTES_UNICOS"]) or "CLIENTES UNICOS"
+    cols["COLF_TKT"] = find_col_of(["TOTAL_TICKETS", "TOTAL TICKETS"]) or "TOTAL_TICKETS"
+    cols["COLF_RED"] = find_col_of(["RED LINES", "REDLINES", "RED_LINES"]) or "RED LINES"
+
+    for k in ["COLF_EAS", "COLF_EBP", "COLF_EAD", "COLF_CLI", "COLF_TKT", "COLF_RED"]:
+        if cols[k] not in raw_of.columns:
+            raw_of[cols[k]] = 0
+
+    c_lat, c_lon = cols["COLF_LAT"], cols["COLF_LON"]
+    raw_of[c_lat] = (
+        raw_of[c_lat].astype(str)
+        .str.replace(",", ".", regex=False)
+        .str.replace(r"[^\d\.\-]", "", regex=True)
+        .replace("", np.nan)
+        .astype(float)
+    )
+    raw_of[c_lon] = (
+        raw_of[c_lon].astype(str)
+        .str.replace(",", ".", regex=False)
+        .str.replace(r"[^\d\.\-]", "", regex=True)
+        .replace("", np.nan)
+        .astype(float)
+    )
 
-df_oficinas = raw_of.dropna(subset=[COLF_LAT, COLF_LON]).reset_index(drop=True)
+    out = raw_of.dropna(subset=[c_lat, c_lon]).reset_index(drop=True)
 
-df_oficinas[COLF_TRX] = pd.to_numeric(df_oficinas[COLF_TRX], errors="coerce").fillna(0.0)
-df_oficinas[COLF_EAS] = pd.to_numeric(df_oficinas[COLF_EAS], errors="coerce").fillna(0.0)
-df_oficinas[COLF_EBP] = pd.to_numeric(df_oficinas[COLF_EBP], errors="coerce").fillna(0.0)
-df_oficinas[COLF_EAD] = pd.to_numeric(df_oficinas[COLF_EAD], errors="coerce").fillna(0.0)
-df_oficinas[COLF_CLI] = pd.to_numeric(df_oficinas[COLF_CLI], errors="coerce").fillna(0.0)
-df_oficinas[COLF_TKT] = pd.to_numeric(df_oficinas[COLF_TKT], errors="coerce").fillna(0.0)
-df_oficinas[COLF_RED] = parse_percent_series(df_oficinas[COLF_RED])
+    for k in ["COLF_TRX", "COLF_EAS", "COLF_EBP", "COLF_EAD", "COLF_CLI", "COLF_TKT"]:
+        out[cols[k]] = pd.to_numeric(out[cols[k]], errors="coerce").fillna(0.0)
+    out[cols["COLF_RED"]] = parse_percent_series(out[cols["COLF_RED"]])
+    return out, cols
 
 # ============================================================
 # 2D. CARGAR ZONAS (URBANA / RURAL) ✅ NUEVO (ZONAS.xlsx)
@@ -325,15 +630,23 @@ excel_zonas_local = os.path.join(BASE_DIR, "data", "ZONAS.xlsx")
 excel_zonas_alt = "/mnt/data/ZONAS.xlsx"
 excel_zonas = excel_zonas_local if os.path.exists(excel_zonas_local) else (excel_zonas_alt if os.path.exists(excel_zonas_alt) else "")
 
-df_zonas = pd.DataFrame(columns=[
+ZONAS_COLUMNS = [
     "DEPARTAMENTO", "PROVINCIA", "DISTRITO",
     "UBIGEO_DIST", "CENTRO_POBLADO", "UBIGEO_CP",
     "TIPO_ZONA", "LATITUD", "LONGITUD"
-])
+]
+
+# fuentes cuyo cargador cayó al frame vacío por un error de lectura:
+# esa carga no se guarda en el snapshot (se reintenta al próximo arranque)
+CARGAS_FALLIDAS = set()
+
+def _cargar_zonas(path):
+    if not path:
+        print("⚠ No existe ZONAS.xlsx (bordes rural/urbano desactivados).")
+        return pd.DataFrame(columns=ZONAS_COLUMNS)
 
-if excel_zonas:
     try:
-        raw_z = pd.read_excel(excel_zonas)
+        raw_z = pd.read_excel(path)
 
         for c in [
             "DEPARTAMENTO","PROVINCIA","DISTRITO","UBIGEO DEL DISTRITO",
@@ -368,74 +681,15 @@ if excel_zonas:
             .astype(float)
         )
 
-        df_zonas = raw_z.dropna(subset=["LATITUD", "LONGITUD"]).reset_index(drop=True)
-        df_zonas = df_zonas[[
-            "DEPARTAMENTO","PROVINCIA","DISTRITO",
-            "UBIGEO_DIST","CENTRO_POBLADO","UBIGEO_CP",
-            "TIPO_ZONA","LATITUD","LONGITUD"
-        ]].copy()
+        out = raw_z.dropna(subset=["LATITUD", "LONGITUD"]).reset_index(drop=True)
+        out = out[ZONAS_COLUMNS].copy()
 
-        print(f"✅ ZONAS.xlsx cargado: {len(df_zonas)} filas ({excel_zonas})")
+        print(f"✅ ZONAS.xlsx cargado: {len(out)} filas ({path})")
+        return out
     except Exception as e:
         print("⚠ No se pudo cargar ZONAS.xlsx:", e)
-else:
-    print("⚠ No existe ZONAS.xlsx (bordes rural/urbano desactivados).")
-
-ZONAS_HULL_CACHE = {}
-
-def _convex_hull_xy(points_xy):
-    pts = sorted(set(points_xy))
-    if len(pts) <= 1:
-        return pts
-
-    def cross(o, a, b):
-        return (a[0]-o[0])*(b[1]-o[1]) - (a[1]-o[1])*(b[0]-o[0])
-
-    lower = []
-    for p in pts:
-        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
-            lower.pop()
-        lower.append(p)
-
-    upper = []
-    for p in reversed(pts):
-        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
-            upper.pop()
-        upper.append(p)
-
-    return lower[:-1] + upper[:-1]
-
-def _rect_from_points(points_xy, pad_min=0.01):
-    xs = [p[0] for p in points_xy]
-    ys = [p[1] for p in points_xy]
-    minx, maxx = min(xs), max(xs)
-    miny, maxy = min(ys), max(ys)
-
-    if minx == maxx and miny == maxy:
-        padx = pady = pad_min
-    else:
-        padx = max(pad_min, (maxx - minx) * 0.05)
-        pady = max(pad_min, (maxy - miny) * 0.05)
-
-    minx -= padx; maxx += padx
-    miny -= pady; maxy += pady
-    return [(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy)]
-
-def _zona_polygon_latlon(dff):
-    if dff is None or dff.empty:
-        return []
-
-    pts_xy = list(zip(dff["LONGITUD"].astype(float).tolist(), dff["LATITUD"].astype(float).tolist()))
-    if len(pts_xy) < 3:
-        rect = _rect_from_points(pts_xy) if len(pts_xy) > 0 else []
-        return [[y, x] for (x, y) in rect]
-
-    hull = _convex_hull_xy(pts_xy)
-    if len(hull) < 3:
-        rect = _rect_from_points(pts_xy)
-        return [[y, x] for (x, y) in rect]
-
-    return [[y, x] for (x, y) in hull]
+        CARGAS_FALLIDAS.add("zonas")
+        return pd.DataFrame(columns=ZONAS_COLUMNS)
 
 # ============================================================
 # 2E. CARGAR NODOS (NODOS1.xlsx) ✅ NUEVO
@@ -444,11 +698,15 @@ excel_nodos_local = os.path.join(BASE_DIR, "data", "NODOS1.xlsx")
 excel_nodos_alt = "/mnt/data/NODOS1.xlsx"
 excel_nodos = excel_nodos_local if os.path.exists(excel_nodos_local) else (excel_nodos_alt if os.path.exists(excel_nodos_alt) else "")
 
-df_nodos = pd.DataFrame(columns=["UBIGEO","DEPARTAMENTO","PROVINCIA","DISTRITO","NOMBRE","LATITUD","LONGITUD"])
+NODOS_COLUMNS = ["UBIGEO","DEPARTAMENTO","PROVINCIA","DISTRITO","NOMBRE","LATITUD","LONGITUD"]
+
+def _cargar_nodos(path):
+    if not path:
+        print("⚠ No existe NODOS1.xlsx (comercial/nodos desactivados).")
+        return pd.DataFrame(columns=NODOS_COLUMNS)
 
-if excel_nodos:
     try:
-        raw_n = pd.read_excel(excel_nodos)
+        raw_n = pd.read_excel(path)
         norm_map_n = {normalize_col(c): c for c in raw_n.columns}
 
         def find_col_n(keys):
@@ -496,9 +754,9 @@ if excel_nodos:
             .astype(float)
         )
 
-        df_nodos = raw_n.dropna(subset=[COLN_LAT, COLN_LON]).copy()
+        out = raw_n.dropna(subset=[COLN_LAT, COLN_LON]).copy()
 
-        df_nodos = df_nodos.rename(columns={
+        out = out.rename(columns={
             COLN_UBI: "UBIGEO",
             COLN_DEP: "DEPARTAMENTO",
             COLN_PRO: "PROVINCIA",
@@ -508,12 +766,355 @@ if excel_nodos:
             COLN_LON: "LONGITUD",
         })
 
-        df_nodos = df_nodos[["UBIGEO","DEPARTAMENTO","PROVINCIA","DISTRITO","NOMBRE","LATITUD","LONGITUD"]].copy()
-        print(f"✅ NODOS1.xlsx cargado: {len(df_nodos)} filas ({excel_nodos})")
+        out = out[NODOS_COLUMNS].copy()
+        print(f"✅ NODOS1.xlsx cargado: {len(out)} filas ({path})")
+        return out
     except Exception as e:
         print("⚠ No se pudo cargar NODOS1.xlsx:", e)
+        CARGAS_FALLIDAS.add("nodos")
+        return pd.DataFrame(columns=NODOS_COLUMNS)
+
+# ============================================================
+# 2F. SNAPSHOT COMPILADO DE LOS EXCEL ✅
+#   - La primera carga guarda los DataFrames ya normalizados y el
+#     mapeo de columnas (COL_*, COLA_*, COLF_*) en data/.snapshot
+#   - Los siguientes arranques leen el snapshot (pickle binario) si
+#     ningún Excel cambió: mismo mtime/tamaño, o mismo sha1
+#   - ...y si no cambió el código que los produce: todo lo que está antes
+#     de esta sección (_cargar_*, find_col*, clean_str, constantes)
+# ============================================================
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(BASE_DIR, "data", ".snapshot"))
+# subir si cambia el formato en disco (pickles / meta.json); los cambios de
+# los loaders ya los detecta SNAPSHOT_CARGA
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_FRAMES = ["df", "df_agentes", "df_oficinas", "df_zonas", "df_nodos"]
+
+SNAPSHOT_FUENTES = {
+    "atms": excel_main,
+    "agentes": excel_agentes,
+    "oficinas": excel_oficinas,
+    "zonas": excel_zonas,
+    "nodos": excel_nodos,
+}
+
+def _version_carga():
+    # sha1 del fuente hasta esta sección: lo que define los frames y COLUMNAS
+    with open(os.path.abspath(__file__), "r", encoding="utf-8") as f:
+        texto = f.read()
+    fin = texto.find("# 2F. SNAPSHOT COMPILADO")
+    return hashlib.sha1(texto[:fin if fin >= 0 else len(texto)].encode("utf-8")).hexdigest()[:12]
+
+SNAPSHOT_CARGA = _version_carga()
+
+def _sha1_archivo(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _huella_fuente(path, previa=None):
+    """
+    Huella de un Excel fuente: mtime + tamaño + sha1.
+    Si mtime y tamaño coinciden con la huella previa, se reutiliza su sha1
+    (no se vuelve a leer el archivo).
+    """
+    if not path or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    huella = {"path": os.path.abspath(path), "mtime": st.st_mtime_ns, "size": st.st_size}
+    if (previa and previa.get("path") == huella["path"]
+            and previa.get("mtime") == huella["mtime"] and previa.get("size") == huella["size"]):
+        huella["sha1"] = previa.get("sha1")
+    else:
+        huella["sha1"] = _sha1_archivo(path)
+    return huella
+
+def _version_snapshot(huellas):
+    h = hashlib.sha1()
+    for k in sorted(huellas):
+        v = huellas[k]
+        h.update(f"{k}={v['sha1'] if v else ''};".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+def snapshot_cargar():
+    """
+    Devuelve {"frames", "columnas", "huellas", "version"} si el snapshot
+    en disco corresponde a los Excel actuales; si no, None.
+    """
+    meta_path = os.path.join(SNAPSHOT_DIR, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format") != SNAPSHOT_FORMAT or meta.get("pandas") != pd.__version__:
+            return None
+        if meta.get("carga") != SNAPSHOT_CARGA:
+            print("⚠ Snapshot de otra versión de los loaders, se recompila desde Excel")
+            return None
+
+        previas = meta.get("huellas", {})
+        huellas = {k: _huella_fuente(p, previas.get(k)) for k, p in SNAPSHOT_FUENTES.items()}
+        for k, h in huellas.items():
+            prev = previas.get(k)
+            if (h is None) != (prev is None):
+                return None
+            if h is not None and h["sha1"] != prev.get("sha1"):
+                return None
+
+        frames = {
+            name: pd.read_pickle(os.path.join(SNAPSHOT_DIR, f"{name}.pkl"))
+            for name in SNAPSHOT_FRAMES
+        }
+        return {
+            "frames": frames,
+            "columnas": meta["columnas"],
+            "huellas": huellas,
+            "version": meta["version"],
+        }
+    except Exception as e:
+        print("⚠ Snapshot inválido, se recompila desde Excel:", e)
+        return None
+
+def snapshot_guardar(frames, columnas, huellas):
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        for name in SNAPSHOT_FRAMES:
+            _escribir_atomico(
+                os.path.join(SNAPSHOT_DIR, f"{name}.pkl"),
+                lambda tmp, fr=frames[name]: fr.to_pickle(tmp, compression=None),
+            )
+
+        meta = {
+            "format": SNAPSHOT_FORMAT,
+            "pandas": pd.__version__,
+            "carga": SNAPSHOT_CARGA,
+            "version": _version_snapshot(huellas),
+            "huellas": huellas,
+            "columnas": columnas,
+        }
+
+        def escribir_meta(tmp):
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False, indent=2)
+
+        # meta.json va al final: si existe, los .pkl ya están completos
+        _escribir_atomico(os.path.join(SNAPSHOT_DIR, "meta.json"), escribir_meta)
+    except Exception as e:
+        print("⚠ No se pudo guardar el snapshot:", e)
+
+_snapshot = snapshot_cargar()
+if _snapshot is not None:
+    df = _snapshot["frames"]["df"]
+    df_agentes = _snapshot["frames"]["df_agentes"]
+    df_oficinas = _snapshot["frames"]["df_oficinas"]
+    df_zonas = _snapshot["frames"]["df_zonas"]
+    df_nodos = _snapshot["frames"]["df_nodos"]
+    COLUMNAS = _snapshot["columnas"]
+    SNAPSHOT_FUENTES_HUELLAS = _snapshot["huellas"]
+    SNAPSHOT_VERSION = _snapshot["version"]
+    print(f"✅ Snapshot cargado: {SNAPSHOT_VERSION} ({SNAPSHOT_DIR})")
 else:
-    print("⚠ No existe NODOS1.xlsx (comercial/nodos desactivados).")
+    df, _cols_atm = _cargar_atms(excel_main)
+    df_agentes, _cols_ag = _cargar_agentes(excel_agentes)
+    df_oficinas, _cols_of = _cargar_oficinas(excel_oficinas)
+    df_zonas = _cargar_zonas(excel_zonas)
+    df_nodos = _cargar_nodos(excel_nodos)
+    COLUMNAS = {**_cols_atm, **_cols_ag, **_cols_of}
+
+    SNAPSHOT_FUENTES_HUELLAS = {k: _huella_fuente(p) for k, p in SNAPSHOT_FUENTES.items()}
+    SNAPSHOT_VERSION = _version_snapshot(SNAPSHOT_FUENTES_HUELLAS)
+    if CARGAS_FALLIDAS:
+        # un frame vacío por error no debe quedar fijado bajo el sha1 válido
+        print(f"⚠ Snapshot no guardado: falló la carga de {', '.join(sorted(CARGAS_FALLIDAS))}")
+    else:
+        snapshot_guardar(
+            {"df": df, "df_agentes": df_agentes, "df_oficinas": df_oficinas,
+             "df_zonas": df_zonas, "df_nodos": df_nodos},
+            COLUMNAS,
+            SNAPSHOT_FUENTES_HUELLAS,
+        )
+del _snapshot
+
+COL_ATM  = COLUMNAS["COL_ATM"]
+COL_NAME = COLUMNAS["COL_NAME"]
+COL_DEPT = COLUMNAS["COL_DEPT"]
+COL_PROV = COLUMNAS["COL_PROV"]
+COL_DIST = COLUMNAS["COL_DIST"]
+COL_LAT  = COLUMNAS["COL_LAT"]
+COL_LON  = COLUMNAS["COL_LON"]
+COL_DIV  = COLUMNAS["COL_DIV"]
+COL_TIPO = COLUMNAS["COL_TIPO"]
+COL_UBIC = COLUMNAS["COL_UBIC"]
+PROM_COL = COLUMNAS["PROM_COL"]
+
+COLA_ID   = COLUMNAS["COLA_ID"]
+COLA_COM  = COLUMNAS["COLA_COM"]
+COLA_DEPT = COLUMNAS["COLA_DEPT"]
+COLA_PROV = COLUMNAS["COLA_PROV"]
+COLA_DIST = COLUMNAS["COLA_DIST"]
+COLA_LAT  = COLUMNAS["COLA_LAT"]
+COLA_LON  = COLUMNAS["COLA_LON"]
+COLA_DIV  = COLUMNAS["COLA_DIV"]
+COLA_DIR  = COLUMNAS["COLA_DIR"]
+COLA_CAPA = COLUMNAS["COLA_CAPA"]
+COLA_TRX_OCT = COLUMNAS["COLA_TRX_OCT"]
+COLA_TRX_NOV = COLUMNAS["COLA_TRX_NOV"]
+PROMA_COL = COLUMNAS["PROMA_COL"]
+
+COLF_ID   = COLUMNAS["COLF_ID"]
+COLF_NAME = COLUMNAS["COLF_NAME"]
+COLF_DIV  = COLUMNAS["COLF_DIV"]
+COLF_DEPT = COLUMNAS["COLF_DEPT"]
+COLF_PROV = COLUMNAS["COLF_PROV"]
+COLF_DIST = COLUMNAS["COLF_DIST"]
+COLF_LAT  = COLUMNAS["COLF_LAT"]
+COLF_LON  = COLUMNAS["COLF_LON"]
+COLF_TRX  = COLUMNAS["COLF_TRX"]
+COLF_EAS  = COLUMNAS["COLF_EAS"]
+COLF_EBP  = COLUMNAS["COLF_EBP"]
+COLF_EAD  = COLUMNAS["COLF_EAD"]
+COLF_CLI  = COLUMNAS["COLF_CLI"]
+COLF_TKT  = COLUMNAS["COLF_TKT"]
+COLF_RED  = COLUMNAS["COLF_RED"]
+
+# ============================================================
+# 2G. DIRECCIONES POR CANAL (unidas una vez al cargar) ✅
+#   - ATMs, oficinas y nodos resuelven su dirección contra el cache
+#     SQLite al arrancar (exacta o vecino más cercano)
+#   - Quedan como columnas DIRECCION / DIRECCION_APROX: los endpoints
+#     solo las leen, sin búsquedas por fila
+#   - Agentes traen su dirección en el Excel (COLA_DIR)
+# ============================================================
+def unir_direcciones(frame, col_lat, col_lon):
+    if frame is None:
+        return
+    if frame.empty:
+        frame["DIRECCION"] = pd.Series(dtype=object)
+        frame["DIRECCION_APROX"] = pd.Series(dtype=bool)
+        return
+    direcciones, aprox = resolver_direcciones(
+        frame[col_lat].astype(float).tolist(), frame[col_lon].astype(float).tolist()
+    )
+    frame["DIRECCION"] = direcciones
+    frame["DIRECCION_APROX"] = np.asarray(aprox, dtype=bool)
+
+unir_direcciones(df, COL_LAT, COL_LON)
+unir_direcciones(df_oficinas, COLF_LAT, COLF_LON)
+unir_direcciones(df_nodos, "LATITUD", "LONGITUD")
+
+# ============================================================
+# 2H. CENTRO POBLADO MÁS CERCANO (CRUCE CANALES x ZONAS) ✅
+#   - Cada ATM / agente / oficina queda con UBIGEO_CP, ZONA_CP
+#     (RURAL / URBANA) y DIST_CP_M de su centro poblado más cercano
+#   - Búsqueda exacta en grilla (sin scipy): bloques de celdas que crecen
+#     hasta que el mejor candidato queda más cerca que el borde del bloque
+#   - "Más cercano" es por distancia de gran círculo (la de haversine_m):
+#     entre candidatos se compara la cuerda 3D, que tiene el mismo orden
+#   - Una sola vez al cargar; /api/points filtra y cuenta por ZONA_CP
+# ============================================================
+CP_CELDA_GRADOS = 0.05
+_CP_FILA = 100_000  # cid = iy * _CP_FILA + ix (|ix| < 50.000 con celdas de 0.05°)
+_RADIO_TIERRA_M = 6_371_008.8
+NN_LOTE = 2048
+
+def construir_indice_cercania(lats, lons, celda=CP_CELDA_GRADOS):
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    kx = math.cos(math.radians(float(np.median(lats)))) if len(lats) else 1.0
+    x, y = lons * kx, lats
+    cid = np.floor(y / celda).astype(np.int64) * _CP_FILA + np.floor(x / celda).astype(np.int64)
+    orden = np.argsort(cid, kind="stable")
+    return {"x": x[orden], "y": y[orden], "cid": cid[orden], "orden": orden, "kx": kx, "celda": celda,
+            "xyz": _vector_unitario(lats[orden], lons[orden]),
+            "lat_max": float(np.nanmax(np.abs(lats))) if np.isfinite(lats).any() else 0.0}
+
+def _vector_unitario(lats, lons):
+    la, lo = np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+    return np.column_stack([np.cos(la) * np.cos(lo), np.cos(la) * np.sin(lo), np.sin(la)])
+
+def _angulo_fuera_del_bloque(r, celda, kx, lat_max):
+    """
+    Cota inferior (radianes) de la distancia de gran círculo de una
+    consulta a cualquier punto fuera de su bloque de r celdas.
+    """
+    # fuera en y: |dlat| >= r * celda; fuera en x: |dlon| >= r * celda / kx,
+    # y sin(d/2) >= cos(lat_max) * sin(dlon/2)
+    dlat = math.radians(r * celda)
+    dlon = math.radians(min(r * celda / kx, 180.0))
+    return min(dlat, 2 * math.asin(min(1.0, math.cos(math.radians(min(lat_max, 90.0))) * math.sin(dlon / 2))))
+
+def vecinos_cercanos(indice, lats, lons):
+    """
+    (posición en el frame indexado, distancia en metros) del punto más
+    cercano a cada coordenada; (-1, inf) si el índice está vacío.
+    """
+    n = len(lats)
+    mejor = np.full(n, -1, dtype=np.int64)
+    dist = np.full(n, np.inf)
+    if n == 0 or len(indice["cid"]) == 0:
+        return mejor, dist
+
+    celda, cids = indice["celda"], indice["cid"]
+    qx = np.asarray(lons, dtype=float) * indice["kx"]
+    qy = np.asarray(lats, dtype=float)
+    qxyz = _vector_unitario(qy, lons)
+    lat_max = max(indice["lat_max"], float(np.abs(qy).max()))
+    qix = np.floor(qx / celda).astype(np.int64)
+    qiy = np.floor(qy / celda).astype(np.int64)
+    # radio que ya cubre todo el índice: ahí el resultado es exacto siempre
+    iy_all, ix_all = np.floor(indice["y"] / celda), np.floor(indice["x"] / celda)
+    r_max = int(max(np.abs(qiy[:, None] - [iy_all.min(), iy_all.max()]).max(),
+                    np.abs(qix[:, None] - [ix_all.min(), ix_all.max()]).max())) + 1
+
+    celdas_q, grupo = np.unique(qiy * _CP_FILA + qix, return_inverse=True)
+    orden_q = np.argsort(grupo, kind="stable")
+    lotes = []
+    for q in np.split(orden_q, np.flatnonzero(np.diff(grupo[orden_q])) + 1):
+        # celdas muy densas en lotes: la matriz de distancias queda acotada
+        lotes += [q[i:i + NN_LOTE] for i in range(0, len(q), NN_LOTE)]
+    for q in lotes:
+        cy, cx = qiy[q[0]], qix[q[0]]
+        r = 1
+        while True:
+            filas = (cy + np.arange(-r, r + 1)) * _CP_FILA + cx
+            ini = np.searchsorted(cids, filas - r, side="left")
+            fin = np.searchsorted(cids, filas + r, side="right")
+            cand = np.concatenate([np.arange(a, b) for a, b in zip(ini, fin)])
+            if len(cand):
+                # mayor producto escalar = menor cuerda = menor gran círculo
+                cos_d = qxyz[q] @ indice["xyz"][cand].T
+                k = np.argmax(cos_d, axis=1)
+                cuerda = np.linalg.norm(qxyz[q] - indice["xyz"][cand[k]], axis=1)
+                ang = 2 * np.arcsin(np.minimum(cuerda / 2, 1.0))
+                # fuera del bloque todo está a >= esa cota: el mejor es exacto
+                if r >= r_max or np.all(ang <= _angulo_fuera_del_bloque(r, celda, indice["kx"], lat_max)):
+                    mejor[q] = indice["orden"][cand[k]]
+                    dist[q] = ang * _RADIO_TIERRA_M
+                    break
+            r = min(2 * r, r_max)
+    return mejor, dist
+
+def _zona_normalizada(tipos):
+    t = pd.Series(tipos, dtype=object).astype(str).str.upper()
+    return np.where(t.str.contains("RURAL", na=False), "RURAL",
+                    np.where(t.str.contains("URBAN", na=False), "URBANA", ""))
+
+CP_INDICE = construir_indice_cercania(df_zonas["LATITUD"], df_zonas["LONGITUD"])
+CP_ZONA = _zona_normalizada(df_zonas["TIPO_ZONA"])
+CP_UBIGEO = df_zonas["UBIGEO_CP"].astype(str).to_numpy()
+
+def unir_centro_poblado(frame, col_lat, col_lon):
+    pos, dist = vecinos_cercanos(CP_INDICE, frame[col_lat].to_numpy(dtype=float), frame[col_lon].to_numpy(dtype=float))
+    ok = pos >= 0
+    frame["UBIGEO_CP"] = np.where(ok, CP_UBIGEO[np.maximum(pos, 0)] if len(CP_UBIGEO) else "", "")
+    frame["ZONA_CP"] = pd.Categorical(np.where(ok, CP_ZONA[np.maximum(pos, 0)] if len(CP_ZONA) else "", ""))
+    frame["DIST_CP_M"] = np.round(dist, 1)
+
+unir_centro_poblado(df, COL_LAT, COL_LON)
+unir_centro_poblado(df_agentes, COLA_LAT, COLA_LON)
+unir_centro_poblado(df_oficinas, COLF_LAT, COLF_LON)
 
 # ============================================================
 # 3. JERARQUÍA TOTAL UNIFICADA (CLIENTES + TODOS LOS CANALES + NODOS)
@@ -556,56 +1157,1646 @@ for dep in DEPARTAMENTOS:
     provs = geo_all.loc[geo_all["departamento"] == dep, "provincia"].unique().tolist()
     PROVINCIAS_BY_DEPT[dep] = sorted([p for p in provs if p])
 
-DIST_BY_PROV = {}
-provincias_unicas = sorted(geo_all["provincia"].unique())
-for prov in provincias_unicas:
-    dists = geo_all.loc[geo_all["provincia"] == prov, "distrito"].unique().tolist()
-    DIST_BY_PROV[prov] = sorted([d for d in dists if d])
+DIST_BY_PROV = {}
+provincias_unicas = sorted(geo_all["provincia"].unique())
+for prov in provincias_unicas:
+    dists = geo_all.loc[geo_all["provincia"] == prov, "distrito"].unique().tolist()
+    DIST_BY_PROV[prov] = sorted([d for d in dists if d])
+
+# ============================================================
+# UNIFICACIÓN DE DIVISIONES (Islas + Oficinas + Agentes)
+# ============================================================
+div_frames = []
+div_frames.append(
+    df[[COL_DEPT, COL_PROV, COL_DIST, COL_DIV]].rename(
+        columns={COL_DEPT: "departamento", COL_PROV: "provincia", COL_DIST: "distrito", COL_DIV: "division"}
+    )
+)
+div_frames.append(
+    df_agentes[[COLA_DEPT, COLA_PROV, COLA_DIST, COLA_DIV]].rename(
+        columns={COLA_DEPT: "departamento", COLA_PROV: "provincia", COLA_DIST: "distrito", COLA_DIV: "division"}
+    )
+)
+div_frames.append(
+    df_oficinas[[COLF_DEPT, COLF_PROV, COLF_DIST, COLF_DIV]].rename(
+        columns={COLF_DEPT: "departamento", COLF_PROV: "provincia", COLF_DIST: "distrito", COLF_DIV: "division"}
+    )
+)
+
+div_all = pd.concat(div_frames, ignore_index=True)
+div_all["departamento"] = div_all["departamento"].apply(clean_str)
+div_all["provincia"] = div_all["provincia"].apply(clean_str)
+div_all["distrito"] = div_all["distrito"].apply(clean_str)
+div_all["division"] = div_all["division"].apply(clean_str)
+
+DIVISIONES = sorted(div_all["division"].dropna().unique())
+
+DIVISIONES_BY_DEPT = {}
+for dep in DEPARTAMENTOS:
+    divs = div_all.loc[div_all["departamento"] == dep, "division"].dropna().unique().tolist()
+    DIVISIONES_BY_DEPT[dep] = sorted(set(divs))
+
+DIVISIONES_BY_PROV = {}
+for dep, prov_list in PROVINCIAS_BY_DEPT.items():
+    for p in prov_list:
+        divs = div_all.loc[div_all["provincia"] == p, "division"].dropna().unique().tolist()
+        DIVISIONES_BY_PROV[p] = sorted(set(divs))
+
+DIVISIONES_BY_DIST = {}
+for prov, dists in DIST_BY_PROV.items():
+    for d in dists:
+        divs = div_all.loc[div_all["distrito"] == d, "division"].dropna().unique().tolist()
+        DIVISIONES_BY_DIST[d] = sorted(set(divs))
+
+# ============================================================
+# 3B. COLUMNAS DE FILTRO PRE-NORMALIZADAS ✅
+#   - UPPER/strip una sola vez al cargar, guardadas como Categorical
+#   - Los endpoints filtran sobre estas columnas sin copiar el DataFrame
+# ============================================================
+def _canonizar(frame, cols):
+    for c in cols:
+        frame[c] = frame[c].astype(str).str.upper().str.strip().astype("category")
+
+_canonizar(df, [COL_DEPT, COL_PROV, COL_DIST, COL_DIV, COL_UBIC, COL_TIPO])
+_canonizar(df_agentes, [COLA_DEPT, COLA_PROV, COLA_DIST, COLA_DIV, COLA_CAPA])
+_canonizar(df_oficinas, [COLF_DEPT, COLF_PROV, COLF_DIST, COLF_DIV])
+_canonizar(df_nodos, ["DEPARTAMENTO", "PROVINCIA", "DISTRITO"])
+
+# categoría comercial de cada nodo, una vez (NODO_REGLAS)
+df_nodos["CATEGORIA"] = categorizar_nodos(df_nodos["NOMBRE"])
+
+# ============================================================
+# 3C. ÍNDICE GEOGRÁFICO JERÁRQUICO ✅
+#   - Por canal: {(dpto, prov, dist, división|segmento): posiciones}
+#   - "" es comodín (igual que en los filtros de los endpoints), así que
+#     cada combinación de filtros es un solo lookup + take()
+# ============================================================
+def construir_indice_geo(claves):
+    """
+    claves: lista de arrays de texto canónico (mismo largo).
+    Devuelve {tupla: np.ndarray int32 de posiciones (orden original)}.
+    """
+    n = len(claves[0]) if claves else 0
+    idx = {("",) * len(claves): np.arange(n, dtype=np.int32)}
+    if n == 0:
+        return idx
+
+    codigos, valores = [], []
+    for c in claves:
+        cod, uniq = pd.factorize(np.asarray(c, dtype=object))
+        codigos.append(cod.astype(np.int64))
+        valores.append(np.asarray(uniq, dtype=object))
+
+    for usados in itertools.product([False, True], repeat=len(claves)):
+        cols = [i for i, u in enumerate(usados) if u]
+        if not cols:
+            continue
+
+        # código combinado por fila -> orden estable -> cortes por grupo
+        comb = np.zeros(n, dtype=np.int64)
+        for i in cols:
+            comb = comb * (len(valores[i]) + 1) + codigos[i]
+        orden = np.argsort(comb, kind="stable")
+        cortes = np.flatnonzero(np.diff(comb[orden])) + 1
+
+        for pos in np.split(orden, cortes):
+            k = tuple(valores[i][codigos[i][pos[0]]] if u else "" for i, u in enumerate(usados))
+            if any(k[i] == "" for i in cols):
+                continue  # "" se reserva para el comodín
+            idx[k] = pos.astype(np.int32)
+    return idx
+
+def _claves_canonicas(frame, cols):
+    return [frame[c].astype(str).str.upper().str.strip().to_numpy() for c in cols]
+
+INDICE_GEO = {
+    "atm": (df, construir_indice_geo(_claves_canonicas(df, [COL_DEPT, COL_PROV, COL_DIST, COL_DIV]))),
+    "agente": (df_agentes, construir_indice_geo(_claves_canonicas(df_agentes, [COLA_DEPT, COLA_PROV, COLA_DIST, COLA_DIV]))),
+    "oficina": (df_oficinas, construir_indice_geo(_claves_canonicas(df_oficinas, [COLF_DEPT, COLF_PROV, COLF_DIST, COLF_DIV]))),
+    "nodo": (df_nodos, construir_indice_geo(_claves_canonicas(df_nodos, ["DEPARTAMENTO", "PROVINCIA", "DISTRITO"]))),
+    "zona": (df_zonas, construir_indice_geo(_claves_canonicas(df_zonas, ["DEPARTAMENTO", "PROVINCIA", "DISTRITO"]))),
+    # mismas claves + ZONA_CP del centro poblado más cercano (filtro zona de /api/points)
+    "atm_zona": (df, construir_indice_geo(_claves_canonicas(df, [COL_DEPT, COL_PROV, COL_DIST, COL_DIV, "ZONA_CP"]))),
+    "agente_zona": (df_agentes, construir_indice_geo(_claves_canonicas(df_agentes, [COLA_DEPT, COLA_PROV, COLA_DIST, COLA_DIV, "ZONA_CP"]))),
+    "oficina_zona": (df_oficinas, construir_indice_geo(_claves_canonicas(df_oficinas, [COLF_DEPT, COLF_PROV, COLF_DIST, COLF_DIV, "ZONA_CP"]))),
+    "cliente": (df_clientes, construir_indice_geo(_claves_canonicas(df_clientes, ["departamento", "provincia", "distrito", "segmento"]))),
+}
+
+def posiciones_geo(canal, *claves):
+    """
+    Posiciones del canal para la combinación de filtros (None si no hay).
+    """
+    return INDICE_GEO[canal][1].get(tuple(claves))
+
+def seleccionar(canal, *claves):
+    """
+    Filas del canal para la combinación de filtros (valores "" = todos).
+    Sin filtros devuelve el frame original, sin copia.
+    """
+    frame = INDICE_GEO[canal][0]
+    pos = posiciones_geo(canal, *claves)
+    if pos is None:
+        return frame.iloc[0:0]
+    if len(pos) == len(frame):
+        return frame
+    return frame.take(pos)
+
+ZONAS_CP = ["RURAL", "URBANA"]
+
+def zona_param(valor):
+    """
+    "RURAL" / "URBANA" (acepta URBANO) o "" si no hay filtro válido.
+    """
+    v = (valor or "").upper().strip()
+    if v.startswith("URBAN"):
+        return "URBANA"
+    return "RURAL" if v == "RURAL" else ""
+
+def conteo_zonas(canal, claves, zona="", dff=None):
+    """
+    {"total_rural", "total_urbana"} de la selección: lookups en el índice
+    <canal>_zona, o conteo sobre dff si hubo filtros fuera del índice.
+    """
+    if dff is not None:
+        zc = dff["ZONA_CP"]
+        return {f"total_{z.lower()}": int((zc == z).sum()) for z in ZONAS_CP}
+    idx = INDICE_GEO[f"{canal}_zona"][1]
+    return {
+        f"total_{z.lower()}": 0 if zona and zona != z else len(idx.get(tuple(claves) + (z,), ()))
+        for z in ZONAS_CP
+    }
+
+# ============================================================
+# 3D. ÍNDICE ESPACIAL EN GRILLA (VIEWPORT / BBOX) ✅
+#   - Celdas lat/lon de GRID_CELDA grados; filas ordenadas por celda
+#   - Una consulta bbox = un searchsorted por fila de celdas + filtro exacto
+# ============================================================
+GRID_CELDA = 0.05
+
+def construir_grilla(lats, lons, celda=GRID_CELDA):
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    if len(lats) == 0:
+        return {"n": 0}
+
+    lat0 = float(np.floor(lats.min()))
+    lon0 = float(np.floor(lons.min()))
+    ix = ((lons - lon0) / celda).astype(np.int64)
+    iy = ((lats - lat0) / celda).astype(np.int64)
+    nx = int(ix.max()) + 1
+    ny = int(iy.max()) + 1
+
+    cid = iy * nx + ix
+    orden = np.argsort(cid, kind="stable")
+    return {
+        "n": len(lats), "celda": celda, "lat0": lat0, "lon0": lon0, "nx": nx, "ny": ny,
+        "orden": orden.astype(np.int32), "cid": cid[orden], "lats": lats, "lons": lons,
+    }
+
+def consultar_grilla(grilla, bbox):
+    """
+    bbox = (oeste, sur, este, norte). Devuelve posiciones ordenadas de los
+    puntos dentro del rectángulo.
+    """
+    if grilla["n"] == 0:
+        return np.empty(0, dtype=np.int32)
+    w, s, e, n = bbox
+    c = grilla["celda"]
+    ix0 = max(int(np.floor((w - grilla["lon0"]) / c)), 0)
+    ix1 = min(int(np.floor((e - grilla["lon0"]) / c)), grilla["nx"] - 1)
+    iy0 = max(int(np.floor((s - grilla["lat0"]) / c)), 0)
+    iy1 = min(int(np.floor((n - grilla["lat0"]) / c)), grilla["ny"] - 1)
+    if ix0 > ix1 or iy0 > iy1:
+        return np.empty(0, dtype=np.int32)
+
+    filas = np.arange(iy0, iy1 + 1, dtype=np.int64) * grilla["nx"]
+    lo = np.searchsorted(grilla["cid"], filas + ix0, side="left")
+    hi = np.searchsorted(grilla["cid"], filas + ix1, side="right")
+    cand = np.concatenate([grilla["orden"][a:b] for a, b in zip(lo, hi) if b > a] or [np.empty(0, dtype=np.int32)])
+
+    la = grilla["lats"][cand]
+    lo_ = grilla["lons"][cand]
+    dentro = (la >= s) & (la <= n) & (lo_ >= w) & (lo_ <= e)
+    return np.sort(cand[dentro])
+
+GRILLAS = {
+    "atm": construir_grilla(df[COL_LAT], df[COL_LON]),
+    "agente": construir_grilla(df_agentes[COLA_LAT], df_agentes[COLA_LON]),
+    "oficina": construir_grilla(df_oficinas[COLF_LAT], df_oficinas[COLF_LON]),
+    "nodo": construir_grilla(df_nodos["LATITUD"], df_nodos["LONGITUD"]),
+    "cliente": construir_grilla(df_clientes["latitud"], df_clientes["longitud"]),
+}
+
+def parse_bbox(bbox_str, zoom_str=""):
+    """
+    bbox "oeste,sur,este,norte" (formato de Leaflet toBBoxString).
+    Con zoom, el rectángulo se expande a una malla de 1/4 de tile para que
+    vistas casi iguales compartan la misma respuesta. None si no hay bbox.
+    """
+    try:
+        w, s, e, n = [float(v) for v in bbox_str.split(",")]
+    except Exception:
+        return None
+    # "nan" / "inf" pasan por float(): sin bbox
+    if not all(math.isfinite(v) for v in (w, s, e, n)) or w > e or s > n:
+        return None
+    try:
+        z = min(max(int(float(zoom_str)), 0), 22)
+        paso = 360.0 / (2 ** z) / 4.0
+        w, s = np.floor(w / paso) * paso, np.floor(s / paso) * paso
+        e, n = np.ceil(e / paso) * paso, np.ceil(n / paso) * paso
+    except Exception:
+        pass
+    w, e = min(max(w, -180.0), 180.0), min(max(e, -180.0), 180.0)
+    s, n = min(max(s, -90.0), 90.0), min(max(n, -90.0), 90.0)
+    return (round(float(w), 6), round(float(s), 6), round(float(e), 6), round(float(n), 6))
+
+def recortar_vista(canal, dff, bbox):
+    """
+    Deja solo las filas de dff (subconjunto del frame del canal, con su
+    RangeIndex original) que caen dentro del bbox.
+    """
+    if bbox is None or dff.empty:
+        return dff
+    grilla = GRILLAS[canal]
+    dentro = np.zeros(grilla["n"], dtype=bool)
+    dentro[consultar_grilla(grilla, bbox)] = True
+    return dff[dentro[dff.index.to_numpy()]]
+
+def limites(dff, col_lat, col_lon):
+    if dff.empty:
+        return None
+    la = dff[col_lat].to_numpy(dtype=float)
+    lo = dff[col_lon].to_numpy(dtype=float)
+    return [[float(la.min()), float(lo.min())], [float(la.max()), float(lo.max())]]
+
+# ============================================================
+# 3E. CLÚSTERES JERÁRQUICOS POR ZOOM (estilo supercluster) ✅
+#   - Celdas de CLUSTER_RADIO_PX px en coordenadas Web Mercator:
+#     en zoom z hay (256 / radio) * 2^z celdas por eje, así cada celda
+#     de z es la unión exacta de 4 celdas de z+1
+#   - El nivel CLUSTER_ZMAX se agrupa desde los puntos y cada nivel
+#     inferior desde el anterior (conteo, sumas, extensión)
+#   - Vista nacional precalculada al cargar; con filtros se agrupa la
+#     selección solo en el zoom pedido
+# ============================================================
+CLUSTER_RADIO_PX = 64
+CLUSTER_ZMAX = 16
+CLUSTER_CELDAS_TILE = 256 // CLUSTER_RADIO_PX
+
+def _mercator_xy(lats, lons):
+    lats = np.clip(np.asarray(lats, dtype=float), -85.05112878, 85.05112878)
+    lons = np.asarray(lons, dtype=float)
+    x = (lons + 180.0) / 360.0
+    s = np.sin(np.radians(lats))
+    y = 0.5 - np.log((1 + s) / (1 - s)) / (4 * np.pi)
+    return np.clip(x, 0.0, 1.0 - 1e-12), np.clip(y, 0.0, 1.0 - 1e-12)
+
+def tile_bbox(z, x, y):
+    """
+    (oeste, sur, este, norte) del tile XYZ.
+    """
+    n = 2 ** z
+    lat = lambda t: float(np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * t / n)))))
+    return (x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y))
+
+def _agregar_celdas(cx, cy, nceldas, campos, grupo=None):
+    """
+    Agrupa filas (puntos o celdas hijas) por (grupo, celda).
+    campos = {nombre: (valores, ufunc de reducción)}.
+    Devuelve el nivel ordenado por clave = (grupo * nceldas + cy) * nceldas + cx.
+    """
+    clave = cy * nceldas + cx
+    if grupo is not None:
+        clave = clave + grupo * nceldas * nceldas
+    orden = np.argsort(clave, kind="stable")
+    clave = clave[orden]
+    ini = np.flatnonzero(np.r_[True, np.diff(clave) != 0])
+    nivel = {"nceldas": nceldas, "clave": clave[ini]}
+    for k, (v, op) in campos.items():
+        nivel[k] = op.reduceat(v[orden], ini)
+    return nivel
+
+def _nivel_desde_puntos(lats, lons, campos, z, celdas_tile, grupo=None):
+    nceldas = celdas_tile * (2 ** z)
+    x, y = _mercator_xy(lats, lons)
+    cx = (x * nceldas).astype(np.int64)
+    cy = (y * nceldas).astype(np.int64)
+    return _agregar_celdas(cx, cy, nceldas, campos, grupo)
+
+def construir_niveles(lats, lons, campos, zmax, celdas_tile, grupo=None):
+    """
+    Jerarquía completa {z: nivel} para z = 0..zmax; cada nivel se agrega
+    desde el siguiente con las mismas ufuncs de campos.
+    """
+    if len(lats) == 0:
+        return {}
+    niveles = {zmax: _nivel_desde_puntos(lats, lons, campos, zmax, celdas_tile, grupo)}
+    for z in range(zmax - 1, -1, -1):
+        h = niveles[z + 1]
+        nc = h["nceldas"]
+        cx, cy, g = h["clave"] % nc, (h["clave"] // nc) % nc, h["clave"] // (nc * nc)
+        niveles[z] = _agregar_celdas(cx // 2, cy // 2, nc // 2,
+                                     {k: (h[k], op) for k, (_, op) in campos.items()}, g)
+    return niveles
+
+def consultar_clusters(nivel, bbox):
+    """
+    Índices (en el nivel) de las celdas que tocan el bbox (oeste, sur, este, norte).
+    """
+    nc = nivel["nceldas"]
+    w, s, e, n = bbox
+    if not all(math.isfinite(v) for v in (w, s, e, n)):
+        return np.empty(0, dtype=np.int64)
+    (x0, x1), (y1, y0) = _mercator_xy([s, n], [w, e])
+    ix0, ix1 = int(x0 * nc), int(x1 * nc)
+    iy0, iy1 = int(y0 * nc), int(y1 * nc)
+
+    filas = np.arange(iy0, iy1 + 1, dtype=np.int64) * nc
+    lo = np.searchsorted(nivel["clave"], filas + ix0, side="left")
+    hi = np.searchsorted(nivel["clave"], filas + ix1, side="right")
+    return np.concatenate([np.arange(a, b) for a, b in zip(lo, hi) if b > a] or [np.empty(0, dtype=np.int64)])
+
+CLUSTER_CAPAS = {
+    "atm": (COL_LAT, COL_LON, PROM_COL),
+    "agente": (COLA_LAT, COLA_LON, PROMA_COL),
+    "oficina": (COLF_LAT, COLF_LON, COLF_TRX),
+    "nodo": ("LATITUD", "LONGITUD", None),
+}
+
+def _cluster_columnas(frame, capa):
+    """
+    (lats, lons, campos) del canal: conteo, sumas para centroide y
+    promedio, y extensión de cada clúster.
+    """
+    col_lat, col_lon, col_prom = CLUSTER_CAPAS[capa]
+    lats = frame[col_lat].to_numpy(dtype=float)
+    lons = frame[col_lon].to_numpy(dtype=float)
+    prom = frame[col_prom].to_numpy(dtype=float) if col_prom else np.zeros(len(frame))
+    return lats, lons, {
+        "n": (np.ones(len(lats), dtype=np.int64), np.add),
+        "slat": (lats, np.add),
+        "slon": (lons, np.add),
+        "sprom": (prom, np.add),
+        "s": (lats, np.minimum),
+        "w": (lons, np.minimum),
+        "no": (lats, np.maximum),
+        "e": (lons, np.maximum),
+    }
+
+CLUSTERS = {}
+for _capa, (_frame, _) in INDICE_GEO.items():
+    if _capa in CLUSTER_CAPAS and _frame is not None:
+        CLUSTERS[_capa] = construir_niveles(*_cluster_columnas(_frame, _capa), CLUSTER_ZMAX, CLUSTER_CELDAS_TILE)
+
+# ============================================================
+# 3F. GRILLAS DE DENSIDAD DE CLIENTES (HEATMAP) ✅
+#   - Misma jerarquía de celdas que 3E, con celdas de HEAT_CELDA_PX
+#     (menores que el radio del heatmap) hasta HEAT_ZMAX
+#   - Cada celda está separada por grupo hoja (dpto, prov, dist, segmento),
+#     así cualquier combinación de filtros suma celdas ya agregadas
+#   - Se guarda conteo + centroide por celda (int32 / float32)
+# ============================================================
+HEAT_CELDA_PX = 4
+HEAT_ZMAX = 14
+HEAT_CELDAS_TILE = 256 // HEAT_CELDA_PX
+
+def construir_densidad(lats, lons, grupo):
+    niveles = construir_niveles(lats, lons, {
+        "n": (np.ones(len(lats), dtype=np.int64), np.add),
+        "slat": (lats, np.add),
+        "slon": (lons, np.add),
+    }, HEAT_ZMAX, HEAT_CELDAS_TILE, grupo)
+    return {z: {
+        "nceldas": v["nceldas"],
+        "clave": v["clave"],
+        "n": v["n"].astype(np.int32),
+        "lat": (v["slat"] / v["n"]).astype(np.float32),
+        "lon": (v["slon"] / v["n"]).astype(np.float32),
+    } for z, v in niveles.items()}
+
+# grupo hoja de cada cliente (también lo usa el cubo de 3G)
+_hojas = pd.MultiIndex.from_arrays(_claves_canonicas(df_clientes, ["departamento", "provincia", "distrito", "segmento"]))
+CLIENTES_GRUPO, _hojas = _hojas.factorize()
+CLIENTES_GRUPO = CLIENTES_GRUPO.astype(np.int64)
+CLIENTES_HOJAS = [_hojas.get_level_values(i).to_numpy() for i in range(4)]
+
+HEAT_NIVELES = construir_densidad(
+    df_clientes["latitud"].to_numpy(dtype=float),
+    df_clientes["longitud"].to_numpy(dtype=float),
+    CLIENTES_GRUPO,
+)
+
+def consultar_densidad(z, filtros, bbox=None):
+    """
+    Celdas (lats, lons, conteos) del zoom z para filtros (dpto, prov, dist,
+    segmento) con "" como comodín, opcionalmente recortadas al bbox.
+    """
+    nivel = HEAT_NIVELES.get(min(max(z, 0), HEAT_ZMAX))
+    vacio = (np.empty(0), np.empty(0), np.empty(0))
+    if nivel is None:
+        return vacio
+
+    elegidos = np.ones(len(CLIENTES_HOJAS[0]), dtype=bool)
+    for hojas, f in zip(CLIENTES_HOJAS, filtros):
+        if f:
+            elegidos &= hojas == f
+    grupos = np.flatnonzero(elegidos)
+    if len(grupos) == 0:
+        return vacio
+
+    # la clave empieza por el grupo: cada grupo es un tramo contiguo
+    nc = nivel["nceldas"]
+    lo = np.searchsorted(nivel["clave"], grupos * nc * nc, side="left")
+    hi = np.searchsorted(nivel["clave"], (grupos + 1) * nc * nc, side="left")
+    i = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi) if b > a] or [np.empty(0, dtype=np.int64)])
+
+    celda = nivel["clave"][i] % (nc * nc)
+    if bbox is not None:
+        w, s, e, n = bbox
+        (x0, x1), (y1, y0) = _mercator_xy([s, n], [w, e])
+        cx, cy = celda % nc, celda // nc
+        dentro = (cx >= int(x0 * nc)) & (cx <= int(x1 * nc)) & (cy >= int(y0 * nc)) & (cy <= int(y1 * nc))
+        i, celda = i[dentro], celda[dentro]
+
+    cnt = nivel["n"][i].astype(float)
+    if len(grupos) > 1:
+        # varios grupos en la misma celda -> una sola celda, centroide ponderado
+        celda, inv = np.unique(celda, return_inverse=True)
+        lat = np.bincount(inv, nivel["lat"][i] * cnt)
+        lon = np.bincount(inv, nivel["lon"][i] * cnt)
+        cnt = np.bincount(inv, cnt)
+        return lat / cnt, lon / cnt, cnt
+    return nivel["lat"][i].astype(float), nivel["lon"][i].astype(float), cnt
+
+# ============================================================
+# 3G. CUBO RESUMEN DE CLIENTES ✅
+#   - Por grupo hoja: total, suma y no-nulos de cada métrica, conteo y
+#     primera fila de cada segmento
+#   - Roll-up a todas las combinaciones con comodín "" (mismas claves
+#     que el índice 3C), así /api/resumen_clientes es un solo lookup
+#   - Reconstruir = agregar hojas (un bincount) + roll-up sobre las hojas
+# ============================================================
+CUBO_METRICAS = ["flag_digital", "edad", "ingresos", "deuda"]
+
+def agregar_hojas_clientes(frame, grupo, nhojas):
+    """
+    DataFrame con una fila por grupo hoja: total, s_/n_<métrica> y
+    c_/p_<segmento> (conteo y primera posición). Devuelve también los
+    valores originales de segmento.
+    """
+    n = len(frame)
+    hojas = {"total": np.bincount(grupo, minlength=nhojas).astype(float)}
+    for col in CUBO_METRICAS:
+        if col in frame.columns:
+            v = frame[col].to_numpy(dtype=float)
+            ok = ~np.isnan(v)
+            hojas[f"s_{col}"] = np.bincount(grupo, weights=np.where(ok, v, 0.0), minlength=nhojas)
+            hojas[f"n_{col}"] = np.bincount(grupo, weights=ok, minlength=nhojas)
+
+    segmentos = []
+    if "segmento" in frame.columns:
+        segc, segmentos = pd.factorize(frame["segmento"])
+        nseg = len(segmentos)
+        valido = segc >= 0
+        clave = grupo[valido] * nseg + segc[valido]
+        conteo = np.bincount(clave, minlength=nhojas * nseg).reshape(nhojas, nseg)
+        primera = np.full(nhojas * nseg, n, dtype=np.int64)
+        np.minimum.at(primera, clave, np.flatnonzero(valido))
+        primera = primera.reshape(nhojas, nseg)
+        for j in range(nseg):
+            hojas[f"c_{j}"] = conteo[:, j].astype(float)
+            hojas[f"p_{j}"] = primera[:, j].astype(float)
+    return pd.DataFrame(hojas), list(segmentos)
+
+def construir_cubo_clientes(hojas, claves_hojas):
+    """
+    {(dpto, prov, dist, segmento): fila de agregados} con "" como comodín.
+    """
+    nombres = ["departamento", "provincia", "distrito", "segmento"]
+    t = hojas.copy()
+    for nombre, v in zip(nombres, claves_hojas):
+        t[nombre] = v
+    agg = {c: ("min" if c.startswith("p_") else "sum") for c in hojas.columns}
+
+    cubo = {("",) * 4: t[list(hojas.columns)].agg(agg).to_numpy(dtype=float)}
+    for usados in itertools.product([False, True], repeat=4):
+        cols = [nombres[i] for i, u in enumerate(usados) if u]
+        if not cols:
+            continue
+        g = t.groupby(cols, sort=False, observed=True).agg(agg)
+        for k, fila in zip(g.index, g.to_numpy(dtype=float)):
+            k = k if isinstance(k, tuple) else (k,)
+            if any(v == "" for v in k):
+                continue  # "" se reserva para el comodín
+            it = iter(k)
+            cubo[tuple(next(it) if u else "" for u in usados)] = fila
+    return cubo
+
+CUBO_HOJAS, CUBO_SEGMENTOS = agregar_hojas_clientes(df_clientes, CLIENTES_GRUPO, len(CLIENTES_HOJAS[0]))
+CUBO_POS = {c: i for i, c in enumerate(CUBO_HOJAS.columns)}
+CUBO_CLIENTES = construir_cubo_clientes(CUBO_HOJAS, CLIENTES_HOJAS)
+
+def resumen_desde_cubo(fila):
+    def prom(col, escala, dec):
+        if f"s_{col}" not in CUBO_POS:
+            return 0
+        s, c = fila[CUBO_POS[f"s_{col}"]], fila[CUBO_POS[f"n_{col}"]]
+        return round(escala * (s / c), dec) if c else float("nan")
+
+    top_segmento = "—"
+    if CUBO_SEGMENTOS:
+        conteo = np.array([fila[CUBO_POS[f"c_{j}"]] for j in range(len(CUBO_SEGMENTOS))])
+        primera = np.array([fila[CUBO_POS[f"p_{j}"]] for j in range(len(CUBO_SEGMENTOS))])
+        if conteo.max() > 0:
+            # empate: el segmento que aparece primero (igual que value_counts().idxmax())
+            empatados = np.flatnonzero(conteo == conteo.max())
+            top_segmento = CUBO_SEGMENTOS[empatados[np.argmin(primera[empatados])]]
+
+    return {
+        "total": int(fila[CUBO_POS["total"]]),
+        "digital_pct": prom("flag_digital", 100, 1),
+        "edad_prom": prom("edad", 1, 1),
+        "ingreso_prom": prom("ingresos", 1, 2),
+        "deuda_prom": prom("deuda", 1, 2),
+        "top_segmento": top_segmento,
+    }
+
+def grupos_comodin(hojas):
+    """
+    Para cada combinación con comodín "" de las claves hoja (MultiIndex),
+    (clave, posiciones de las hojas que cubre). Las claves con un valor
+    "" real se omiten: "" se reserva para el comodín.
+    """
+    ndim = hojas.nlevels
+    niveles = [hojas.get_level_values(i).to_numpy() for i in range(ndim)]
+    for usados in itertools.product([False, True], repeat=ndim):
+        cols = [niveles[i] for i, u in enumerate(usados) if u]
+        if cols:
+            grupo, valores = pd.factorize(pd.MultiIndex.from_arrays(cols))
+        else:
+            grupo, valores = np.zeros(len(hojas), dtype=np.int64), [()]
+        orden = np.argsort(grupo, kind="stable")
+        por_grupo = np.split(orden, np.flatnonzero(np.diff(grupo[orden])) + 1)
+        for k, hijos in zip(valores, por_grupo):
+            k = k if isinstance(k, tuple) else (k,)
+            if any(v == "" for v in k):
+                continue
+            it = iter(k)
+            yield tuple(next(it) if u else "" for u in usados), hijos
+
+# ============================================================
+# 3H. CUBO DE NODOS POR CATEGORÍA ✅
+#   - Conteo por (dpto, prov, dist) hoja y categoría (NODO_CATEGORIAS)
+#   - Roll-up a las combinaciones con comodín "" (mismas claves que
+#     INDICE_GEO["nodo"]): el resumen del Panel Comercial es un lookup
+# ============================================================
+def construir_cubo_nodos(frame):
+    """
+    {(dpto, prov, dist): np.ndarray de conteos por categoría}.
+    """
+    ncat = len(NODO_CATEGORIAS)
+    cubo = {("",) * 3: np.zeros(ncat, dtype=np.int64)}
+    if frame is None or frame.empty:
+        return cubo
+
+    claves = _claves_canonicas(frame, ["DEPARTAMENTO", "PROVINCIA", "DISTRITO"])
+    hoja, hojas = pd.factorize(pd.MultiIndex.from_arrays(claves))
+    cat = frame["CATEGORIA"].cat.codes.to_numpy(dtype=np.int64)
+    conteo = np.bincount(hoja * ncat + cat, minlength=len(hojas) * ncat).reshape(len(hojas), ncat)
+    for clave, hijos in grupos_comodin(hojas):
+        cubo[clave] = conteo[hijos].sum(axis=0)
+    return cubo
+
+CUBO_NODOS = construir_cubo_nodos(df_nodos)
+
+# clave del resumen por categoría: la de la primera regla de esa categoría
+NODO_RESUMEN_CLAVES = {}
+for _codigo, _r in zip(NODO_CODIGO_REGLA.tolist(), NODO_REGLAS):
+    if _codigo != NODO_CODIGO_OTRO:
+        NODO_RESUMEN_CLAVES.setdefault(_codigo, _r.get("resumen") or _r["categoria"].lower())
+
+def resumen_nodos(dpto="", prov="", dist=""):
+    """
+    Resumen del Panel Comercial ({"total", <clave de regla>..., "otros"}).
+    """
+    fila = CUBO_NODOS.get((dpto, prov, dist))
+    if fila is None:
+        fila = np.zeros(len(NODO_CATEGORIAS), dtype=np.int64)
+    resumen = {"total": int(fila.sum())}
+    for codigo, clave in NODO_RESUMEN_CLAVES.items():
+        resumen[clave] = resumen.get(clave, 0) + int(fila[codigo])
+    resumen["otros"] = int(fila[NODO_CODIGO_OTRO])
+    return resumen
+
+# ============================================================
+# 3I. CONTORNOS CÓNCAVOS DE ZONAS RURAL / URBANA ✅
+#   - Forma = unión de discos de radio ZONAS_ALPHA_KM alrededor de cada
+#     centro poblado (equivalente raster de un alpha-shape), sobre una
+#     grilla nacional de celdas de ZONAS_ALPHA_KM / 4
+#   - Roll-up: las celdas de un nivel son la unión de las de sus hijos
+#     (mismas claves con comodín "" que INDICE_GEO["zona"])
+#   - Bordes de celda -> anillos -> Douglas-Peucker con la tolerancia de
+#     cada zoom de ZONAS_ZOOMS (~1.5 px, nunca menos de una celda)
+#   - Se guardan junto al snapshot (zonas_cascos.pkl); /api/zonas es un
+#     lookup de solo lectura por (dpto, prov, dist) y nivel de zoom
+# ============================================================
+ZONAS_TIPOS = {"rural": "RURAL", "urbano": "URBAN"}
+ZONAS_ALPHA_KM = float(os.getenv("ZONAS_ALPHA_KM", "3"))
+ZONAS_CELDA_KM = ZONAS_ALPHA_KM / 4
+ZONAS_ZOOMS = [5, 8, 11]
+ZONAS_CASCOS_FORMAT = 2
+ZONAS_CASCOS_PATH = os.path.join(SNAPSHOT_DIR, "zonas_cascos.pkl")
+
+def grilla_zonas(lats, lons, celda_km=ZONAS_CELDA_KM, radio_km=ZONAS_ALPHA_KM):
+    """
+    Grilla equirectangular en km que cubre todos los puntos con margen
+    para el disco: {"x0", "y0", "kx", "ky", "ancho", "alto", "celda"}.
+    """
+    lat_ref = float(np.median(lats))
+    kx = _M_POR_GRADO / 1000 * math.cos(math.radians(lat_ref))
+    ky = _M_POR_GRADO / 1000
+    margen = radio_km + 2 * celda_km
+    x0 = float(np.min(lons)) * kx - margen
+    y0 = float(np.min(lats)) * ky - margen
+    ancho = int(math.ceil((float(np.max(lons)) * kx + margen - x0) / celda_km)) + 1
+    alto = int(math.ceil((float(np.max(lats)) * ky + margen - y0) / celda_km)) + 1
+    return {"x0": x0, "y0": y0, "kx": kx, "ky": ky, "ancho": ancho, "alto": alto, "celda": celda_km}
+
+def celdas_disco(grilla, lats, lons, radio_km=ZONAS_ALPHA_KM):
+    """
+    Ids (iy * ancho + ix) de las celdas a menos de radio_km de algún punto.
+    """
+    c, ancho = grilla["celda"], grilla["ancho"]
+    ix = np.floor((np.asarray(lons, dtype=float) * grilla["kx"] - grilla["x0"]) / c).astype(np.int64)
+    iy = np.floor((np.asarray(lats, dtype=float) * grilla["ky"] - grilla["y0"]) / c).astype(np.int64)
+    base = np.unique(iy * ancho + ix)
+    r = int(math.ceil(radio_km / c))
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    dentro = dx * dx + dy * dy <= (radio_km / c) ** 2
+    offsets = (dy[dentro] * ancho + dx[dentro]).astype(np.int64)
+    return np.unique((base[:, None] + offsets[None, :]).ravel())
+
+def anillos_celdas(ids, ancho):
+    """
+    Contornos de un conjunto de celdas: lista de anillos [(x, y), ...] en
+    esquinas de celda (exteriores antihorarios, huecos horarios), sin
+    vértices colineales.
+    """
+    if len(ids) == 0:
+        return []
+    iy, ix = np.divmod(ids, ancho)
+    oy, ox = int(iy.min()) - 1, int(ix.min()) - 1
+    h, w = int(iy.max()) - oy + 2, int(ix.max()) - ox + 2
+    m = np.zeros((h, w), dtype=bool)
+    m[iy - oy, ix - ox] = True
+
+    # aristas dirigidas con la zona a la izquierda; vértice = y * (w + 1) + x
+    W = w + 1
+    aristas = []
+    i, j = np.nonzero(m[1:, :] & ~m[:-1, :])        # borde inferior
+    aristas.append(((i + 1) * W + j, (i + 1) * W + j + 1))
+    i, j = np.nonzero(m[:-1, :] & ~m[1:, :])        # borde superior
+    aristas.append(((i + 1) * W + j + 1, (i + 1) * W + j))
+    i, j = np.nonzero(m[:, 1:] & ~m[:, :-1])        # borde izquierdo
+    aristas.append(((i + 1) * W + j + 1, i * W + j + 1))
+    i, j = np.nonzero(m[:, :-1] & ~m[:, 1:])        # borde derecho
+    aristas.append((i * W + j + 1, (i + 1) * W + j + 1))
+    ini = np.concatenate([a for a, _ in aristas]).tolist()
+    fin = np.concatenate([b for _, b in aristas]).tolist()
+
+    salidas = {}
+    for k, v in enumerate(ini):
+        salidas.setdefault(v, []).append(k)
+    usada = [False] * len(ini)
+
+    anillos = []
+    for k0 in range(len(ini)):
+        if usada[k0]:
+            continue
+        vertices = []
+        k = k0
+        while not usada[k]:
+            usada[k] = True
+            vertices.append(ini[k])
+            v = fin[k]
+            opciones = [e for e in salidas[v] if not usada[e]]
+            if not opciones:
+                break
+            if len(opciones) > 1:
+                # punto de silla: girar a la izquierda (celdas en diagonal
+                # quedan como anillos separados)
+                dx0, dy0 = v % W - ini[k] % W, v // W - ini[k] // W
+                opciones.sort(key=lambda e: -(dx0 * (fin[e] // W - v // W) - dy0 * (fin[e] % W - v % W)))
+            k = opciones[0]
+        p = np.array(vertices, dtype=np.int64)
+        xy = np.column_stack([p % W + ox, p // W + oy])
+        # solo las esquinas donde cambia la dirección
+        d = np.diff(np.vstack([xy, xy[:1]]), axis=0)
+        giro = np.any(d != np.roll(d, 1, axis=0), axis=1)
+        anillos.append(xy[giro])
+    return anillos
+
+def douglas_peucker(pts, tol):
+    """
+    Índices a conservar de una polilínea abierta (iterativo; tramos
+    largos con numpy, cortos en Python puro).
+    """
+    n = len(pts)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    xs, ys = pts[:, 0].tolist(), pts[:, 1].tolist()
+    pila = [(0, n - 1)]
+    while pila:
+        a, b = pila.pop()
+        if b <= a + 1:
+            continue
+        sx, sy = xs[b] - xs[a], ys[b] - ys[a]
+        largo = math.hypot(sx, sy)
+        if b - a > 64:
+            rel = pts[a + 1:b] - pts[a]
+            if largo == 0:
+                dist = np.hypot(rel[:, 0], rel[:, 1])
+            else:
+                dist = np.abs(sx * rel[:, 1] - sy * rel[:, 0]) / largo
+            k = int(np.argmax(dist))
+            dmax = float(dist[k])
+            k += a + 1
+        else:
+            k, dmax = a, -1.0
+            ax, ay = xs[a], ys[a]
+            for i in range(a + 1, b):
+                rx, ry = xs[i] - ax, ys[i] - ay
+                d = abs(sx * ry - sy * rx) / largo if largo else math.hypot(rx, ry)
+                if d > dmax:
+                    k, dmax = i, d
+        if dmax > tol:
+            keep[k] = True
+            pila.append((a, k))
+            pila.append((k, b))
+    return np.flatnonzero(keep)
+
+def simplificar_anillo(xy, tol):
+    """
+    Douglas-Peucker sobre un anillo cerrado; None si colapsa.
+    """
+    if len(xy) < 4:
+        return xy if len(xy) == 3 else None
+    lejos = int(np.argmax(np.hypot(*(xy - xy[0]).T)))
+    ida = xy[:lejos + 1]
+    vuelta = np.vstack([xy[lejos:], xy[:1]])
+    out = np.vstack([ida[douglas_peucker(ida, tol)][:-1], vuelta[douglas_peucker(vuelta, tol)][:-1]])
+    return out if len(out) >= 3 else None
+
+def tolerancia_zoom_km(z, lat_ref):
+    # ~1.5 px de Web Mercator en el zoom z
+    return 1.5 * 40075.016686 * math.cos(math.radians(lat_ref)) / (256 * 2 ** z)
+
+def niveles_contorno(ids, grilla, lat_ref):
+    """
+    {zoom: [anillo [[lat, lon], ...]]} para cada zoom de ZONAS_ZOOMS.
+    """
+    c = grilla["celda"]
+    anillos = anillos_celdas(ids, grilla["ancho"])
+    niveles = {}
+    anillos = [xy.astype(float) for xy in anillos]
+    # del zoom más fino al más grueso: cada nivel simplifica el anterior
+    for z in sorted(ZONAS_ZOOMS, reverse=True):
+        tol = max(1.0, tolerancia_zoom_km(z, lat_ref) / c)
+        anillos = [s for s in (simplificar_anillo(xy, tol) for xy in anillos) if s is not None]
+        out = []
+        for s in anillos:
+            lon = (grilla["x0"] + s[:, 0] * c) / grilla["kx"]
+            lat = (grilla["y0"] + s[:, 1] * c) / grilla["ky"]
+            out.append(np.round(np.column_stack([lat, lon]), 5).tolist())
+        niveles[z] = out
+    return niveles
+
+def construir_cascos_zonas(frame):
+    """
+    {(dpto, prov, dist): {"rural": {"count", "niveles"}, "urbano": {...}}}.
+    """
+    cascos = {}
+    if frame is None or frame.empty:
+        return cascos
+    claves = _claves_canonicas(frame, ["DEPARTAMENTO", "PROVINCIA", "DISTRITO"])
+    lats = frame["LATITUD"].to_numpy(dtype=float)
+    lons = frame["LONGITUD"].to_numpy(dtype=float)
+    tipos = frame["TIPO_ZONA"].astype(str)
+    grilla = grilla_zonas(lats, lons)
+
+    for nombre, patron in ZONAS_TIPOS.items():
+        filas = np.flatnonzero(tipos.str.contains(patron, na=False).to_numpy())
+        if len(filas) == 0:
+            continue
+        hoja, hojas = pd.factorize(pd.MultiIndex.from_arrays([c[filas] for c in claves]))
+        orden = np.argsort(hoja, kind="stable")
+        grupos = np.split(filas[orden], np.flatnonzero(np.diff(hoja[orden])) + 1)
+        conteos = np.array([len(g) for g in grupos], dtype=np.int64)
+        celdas = [celdas_disco(grilla, lats[g], lons[g]) for g in grupos]
+        hechos = {}
+
+        for clave, hijos in grupos_comodin(hojas):
+            # claves con las mismas hojas (p.ej. distrito con y sin
+            # dpto/prov) comparten el mismo resultado
+            firma = tuple(hijos.tolist())
+            if firma not in hechos:
+                ids = np.unique(np.concatenate([celdas[h] for h in hijos]))
+                filas_k = np.concatenate([grupos[h] for h in hijos])
+                hechos[firma] = {
+                    "count": int(conteos[hijos].sum()),
+                    "niveles": niveles_contorno(ids, grilla, float(np.median(lats[filas_k]))),
+                }
+            cascos.setdefault(clave, {})[nombre] = hechos[firma]
+    return cascos
+
+def cargar_cascos_zonas():
+    if "zonas" in CARGAS_FALLIDAS:
+        return construir_cascos_zonas(df_zonas)  # sin leer ni guardar: la versión no es confiable
+    version = f"{SNAPSHOT_VERSION}-{ZONAS_ALPHA_KM:g}-{','.join(map(str, ZONAS_ZOOMS))}"
+    try:
+        if os.path.exists(ZONAS_CASCOS_PATH):
+            guardado = pd.read_pickle(ZONAS_CASCOS_PATH)
+            if guardado.get("format") == ZONAS_CASCOS_FORMAT and guardado.get("version") == version:
+                return guardado["cascos"]
+    except Exception as e:
+        print("⚠ Contornos de zonas inválidos, se recalculan:", e)
+
+    cascos = construir_cascos_zonas(df_zonas)
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        obj = {"format": ZONAS_CASCOS_FORMAT, "version": version, "cascos": cascos}
+        _escribir_atomico(ZONAS_CASCOS_PATH, lambda tmp: pd.to_pickle(obj, tmp, compression=None))
+    except Exception as e:
+        print("⚠ No se pudieron guardar los contornos de zonas:", e)
+    print(f"✅ Contornos de zonas: {len(cascos)} combinaciones")
+    return cascos
+
+ZONAS_CASCOS = cargar_cascos_zonas()
+
+def nivel_zonas(zoom):
+    """
+    Zoom de ZONAS_ZOOMS que corresponde al zoom del mapa (sin zoom: el más fino).
+    """
+    try:
+        z = int(float(zoom))
+    except (TypeError, ValueError):
+        return ZONAS_ZOOMS[-1]
+    elegibles = [n for n in ZONAS_ZOOMS if n <= z]
+    return elegibles[-1] if elegibles else ZONAS_ZOOMS[0]
+
+# ============================================================
+# 3J. BORDES DE DIVISIÓN PRECALCULADOS (ATMs / AGENTES / OFICINAS) ✅
+#   - Casco convexo por canal y combinación (dpto, prov, dist, división)
+#     con comodín "", por roll-up de los cascos de las hojas
+#   - /api/division_border une los cascos de las capas pedidas (pocos
+#     vértices) en vez de recorrer todos los puntos
+# ============================================================
+BORDE_TOL_GRADOS = 1e-4
+
+def _convex_hull_xy(points_xy):
+    pts = sorted(set(points_xy))
+    if len(pts) <= 1:
+        return pts
+
+    def cross(o, a, b):
+        return (a[0]-o[0])*(b[1]-o[1]) - (a[1]-o[1])*(b[0]-o[0])
+
+    lower = []
+    for p in pts:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+
+    upper = []
+    for p in reversed(pts):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+
+    return lower[:-1] + upper[:-1]
+
+def casco_convexo(xs, ys):
+    """
+    Vértices del casco convexo [(x, y), ...]. Con numpy se descartan
+    primero los puntos estrictamente dentro del polígono de extremos
+    (Akl-Toussaint); la cadena monótona solo recorre los que sobreviven.
+    """
+    pts = np.unique(np.column_stack([np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)]), axis=0)
+    if len(pts) > 8:
+        x, y = pts[:, 0], pts[:, 1]
+        extremos = [np.argmin(x), np.argmax(x), np.argmin(y), np.argmax(y),
+                    np.argmin(x + y), np.argmax(x + y), np.argmin(x - y), np.argmax(x - y)]
+        q = _convex_hull_xy([tuple(pts[i]) for i in extremos])
+        if len(q) >= 3:
+            dentro = np.ones(len(pts), dtype=bool)
+            for (ax, ay), (bx, by) in zip(q, q[1:] + q[:1]):
+                dentro &= (bx - ax) * (y - ay) - (by - ay) * (x - ax) > 0
+            pts = pts[~dentro]
+    return _convex_hull_xy([(float(a), float(b)) for a, b in pts])
+
+def construir_bordes(frame, col_lat, col_lon, cols_clave):
+    """
+    {(dpto, prov, dist, división): (n puntos, vértices [(lon, lat), ...])}.
+    """
+    bordes = {}
+    if frame is None or frame.empty:
+        return bordes
+    lats = frame[col_lat].to_numpy(dtype=float)
+    lons = frame[col_lon].to_numpy(dtype=float)
+    hoja, hojas = pd.factorize(pd.MultiIndex.from_arrays(_claves_canonicas(frame, cols_clave)))
+    orden = np.argsort(hoja, kind="stable")
+    grupos = np.split(orden, np.flatnonzero(np.diff(hoja[orden])) + 1)
+    cascos = [casco_convexo(lons[g], lats[g]) for g in grupos]
+
+    hechos = {}
+    for clave, hijos in grupos_comodin(hojas):
+        firma = tuple(hijos.tolist())
+        if firma not in hechos:
+            if len(hijos) == 1:
+                verts = cascos[hijos[0]]
+            else:
+                pts = [p for h in hijos for p in cascos[h]]
+                verts = casco_convexo([p[0] for p in pts], [p[1] for p in pts])
+            hechos[firma] = (int(sum(len(grupos[h]) for h in hijos)), verts)
+        bordes[clave] = hechos[firma]
+    return bordes
+
+BORDES_DIVISION = {
+    "atm": construir_bordes(df, COL_LAT, COL_LON, [COL_DEPT, COL_PROV, COL_DIST, COL_DIV]),
+    "agente": construir_bordes(df_agentes, COLA_LAT, COLA_LON, [COLA_DEPT, COLA_PROV, COLA_DIST, COLA_DIV]),
+    "oficina": construir_bordes(df_oficinas, COLF_LAT, COLF_LON, [COLF_DEPT, COLF_PROV, COLF_DIST, COLF_DIV]),
+}
+
+def borde_division(claves, capas):
+    """
+    [[lat, lon], ...] del borde de los puntos de esas capas: casco
+    convexo simplificado, o el rectángulo si hay < 3 puntos o son colineales.
+    """
+    n, pts = 0, []
+    for capa in capas:
+        cn, verts = BORDES_DIVISION[capa].get(claves, (0, []))
+        n += cn
+        pts += verts
+    if n == 0:
+        return []
+    verts = casco_convexo([p[0] for p in pts], [p[1] for p in pts]) if len(capas) > 1 else pts
+    if n < 3 or len(verts) < 3:
+        xs, ys = [p[0] for p in pts], [p[1] for p in pts]
+        verts = [(min(xs), min(ys)), (max(xs), min(ys)), (max(xs), max(ys)), (min(xs), max(ys))]
+    else:
+        simple = simplificar_anillo(np.array(verts, dtype=float), BORDE_TOL_GRADOS)
+        verts = simple if simple is not None else verts
+    return [[round(float(y), 6), round(float(x), 6)] for x, y in verts]
+
+# ============================================================
+# 3K. DISTANCIA AL CANAL MÁS CERCANO (COBERTURA) ✅
+#   - Una vez al cargar: para cada cliente y cada nodo, distancia al ATM,
+#     agente y oficina más cercanos (columnas DIST_<CANAL>_M, float32)
+#   - El vecino se elige con el índice en grilla de 2H; la distancia
+#     que se guarda es haversine
+#   - /api/cobertura solo selecciona filas y resume esas columnas
+# ============================================================
+COBERTURA_CANALES = {
+    "atm": (df, COL_LAT, COL_LON),
+    "agente": (df_agentes, COLA_LAT, COLA_LON),
+    "oficina": (df_oficinas, COLF_LAT, COLF_LON),
+}
+COBERTURA_BINS_KM = [0, 0.5, 1, 2, 5, 10, 20, 50]
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * _RADIO_TIERRA_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def unir_distancias_canales(frame, col_lat, col_lon):
+    """
+    Agrega DIST_<CANAL>_M y devuelve {canal: posición (int32) del canal
+    más cercano de cada fila} (-1 si el canal está vacío).
+    """
+    lats = frame[col_lat].to_numpy(dtype=float)
+    lons = frame[col_lon].to_numpy(dtype=float)
+    cercanos = {}
+    for canal, (fc, clat, clon) in COBERTURA_CANALES.items():
+        col = f"DIST_{canal.upper()}_M"
+        if fc is None or fc.empty:
+            frame[col] = np.full(len(frame), np.inf, dtype=np.float32)
+            cercanos[canal] = np.full(len(frame), -1, dtype=np.int32)
+            continue
+        clats, clons = fc[clat].to_numpy(dtype=float), fc[clon].to_numpy(dtype=float)
+        pos, _ = vecinos_cercanos(INDICES_CANALES[canal], lats, lons)
+        frame[col] = haversine_m(lats, lons, clats[pos], clons[pos]).astype(np.float32)
+        cercanos[canal] = pos.astype(np.int32)
+    return cercanos
+
+INDICES_CANALES = {
+    canal: construir_indice_cercania(fc[clat], fc[clon])
+    for canal, (fc, clat, clon) in COBERTURA_CANALES.items()
+}
+CERCANOS_CLIENTES = unir_distancias_canales(df_clientes, "latitud", "longitud")
+unir_distancias_canales(df_nodos, "LATITUD", "LONGITUD")
+
+def resumen_cobertura(dff, canales, radios_km):
+    """
+    Distribución de la distancia al canal más cercano (entre `canales`)
+    de las filas de dff, en km.
+    """
+    if len(dff) == 0 or not canales:
+        return _resumen_vacio(len(dff), radios_km)
+    d = dff[f"DIST_{canales[0].upper()}_M"].to_numpy(dtype=np.float32)
+    for c in canales[1:]:
+        d = np.minimum(d, dff[f"DIST_{c.upper()}_M"].to_numpy(dtype=np.float32))
+    return resumen_distancias(d, radios_km)
+
+def _resumen_vacio(n, radios_km):
+    return {"total": n, "promedio_km": 0, "percentiles_km": {}, "histograma": [],
+            "dentro": {f"{r:g}": 0 for r in radios_km}}
+
+def resumen_distancias(d, radios_km):
+    """
+    Distribución de un array de distancias en metros (ya combinado
+    entre canales), en km.
+    """
+    n = len(d)
+    if n == 0:
+        return _resumen_vacio(0, radios_km)
+    km = d.astype(float) / 1000.0
+
+    bordes = COBERTURA_BINS_KM + [np.inf]
+    conteo = np.histogram(km, bins=bordes)[0]
+    p = np.percentile(km, [25, 50, 75, 90, 95])
+    return {
+        "total": n,
+        "promedio_km": round(float(km.mean()), 3),
+        "percentiles_km": {f"p{q}": round(float(v), 3) for q, v in zip([25, 50, 75, 90, 95], p)},
+        "histograma": [
+            {"desde_km": a, "hasta_km": (None if np.isinf(b) else b), "n": int(c), "pct": round(100 * c / n, 2)}
+            for a, b, c in zip(bordes[:-1], bordes[1:], conteo)
+        ],
+        "dentro": {f"{r:g}": round(100 * float(np.count_nonzero(km <= r)) / n, 2) for r in radios_km},
+    }
+
+# ============================================================
+# 3L. MOTOR DE RECOMENDACIONES (HUECOS DE COBERTURA) ✅
+#   - Cliente "descubierto": su canal más cercano (DIST_*_M de 3K) está
+#     a más de RECO_RADIO_KM
+#   - DBSCAN en grilla sobre los descubiertos: celdas de RECO_CELDA_KM
+#     con al menos RECO_MIN_CLIENTES son núcleo, núcleos vecinos (8
+#     celdas) forman un clúster y el resto es ruido
+#   - Puntaje por clientes, densidad, % digital, ingreso y distancia al
+#     canal actual; salida con el esquema del antiguo recomendaciones.csv
+#     (cluster, lat, lon, canal, clientes_afectados, ubigeo, perfil, diagnóstico)
+#   - /api/recomendaciones lo calcula por filtro y queda en el cache de
+#     respuestas (4B), que cambia con la versión de la data
+# ============================================================
+RECO_RADIO_KM = float(os.getenv("RECO_RADIO_KM", "1"))
+RECO_CELDA_KM = float(os.getenv("RECO_CELDA_KM", "0.5"))
+RECO_MIN_CLIENTES = int(os.getenv("RECO_MIN_CLIENTES", "20"))
+RECO_MAX = int(os.getenv("RECO_MAX", "25"))
+RECO_DIGITAL_ALTO = 0.6
+RECO_DIGITAL_BAJO = 0.3
+RECO_EDAD_ADULTA = 45
+RECO_DIST_COLS = [f"DIST_{c.upper()}_M" for c in COBERTURA_CANALES]
+
+def _metrica_nacional(col, fn):
+    if col not in df_clientes.columns or df_clientes[col].notna().sum() == 0:
+        return 0.0
+    return float(fn(df_clientes[col].to_numpy(dtype=float)))
+
+# referencias nacionales: el puntaje no depende del filtro elegido
+RECO_INGRESO_REF = _metrica_nacional("ingresos", np.nanmean)
+RECO_INGRESO_ALTO = _metrica_nacional("ingresos", lambda v: np.nanpercentile(v, 75))
+
+def clusters_grilla(lats, lons, celda_km=RECO_CELDA_KM, min_pts=RECO_MIN_CLIENTES):
+    """
+    DBSCAN en grilla: (clúster de cada punto, -1 = ruido; celdas núcleo
+    de cada clúster).
+    """
+    if len(lats) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    g = grilla_zonas(lats, lons, celda_km, 0)
+    ix = np.floor((lons * g["kx"] - g["x0"]) / celda_km).astype(np.int64)
+    iy = np.floor((lats * g["ky"] - g["y0"]) / celda_km).astype(np.int64)
+    celdas, inv, conteo = np.unique(iy * g["ancho"] + ix, return_inverse=True, return_counts=True)
+    nucleo = conteo >= min_pts
+    ids = celdas[nucleo]
+    if len(ids) == 0:
+        return np.full(len(lats), -1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # aristas entre núcleos vecinos (media vecindad: cada par una vez);
+    # la grilla tiene margen, así que ix ± 1 nunca cambia de fila
+    a, b = [], []
+    for dy, dx in [(0, 1), (1, -1), (1, 0), (1, 1)]:
+        v = ids + dy * g["ancho"] + dx
+        p = np.minimum(np.searchsorted(ids, v), len(ids) - 1)
+        ok = ids[p] == v
+        a.append(np.flatnonzero(ok))
+        b.append(p[ok])
+    a, b = np.concatenate(a), np.concatenate(b)
+
+    # componentes conexas: propagación del mínimo + saltos de puntero
+    etiqueta = np.arange(len(ids))
+    while True:
+        nueva = etiqueta.copy()
+        np.minimum.at(nueva, a, etiqueta[b])
+        np.minimum.at(nueva, b, etiqueta[a])
+        nueva = nueva[nueva]
+        if np.array_equal(nueva, etiqueta):
+            break
+        etiqueta = nueva
+    _, comp = np.unique(etiqueta, return_inverse=True)
+
+    pos_nucleo = np.cumsum(nucleo) - 1
+    return np.where(nucleo[inv], comp[pos_nucleo[inv]], -1), np.bincount(comp)
+
+def moda_por_grupo(grupo, ngrupos, valores):
+    """
+    Valor más frecuente de cada grupo (empate: el que aparece primero).
+    """
+    cod, uniq = pd.factorize(np.asarray(valores, dtype=object))
+    if len(uniq) == 0:
+        return np.full(ngrupos, "", dtype=object)
+    ok = cod >= 0
+    tabla = np.bincount(grupo[ok] * len(uniq) + cod[ok], minlength=ngrupos * len(uniq))
+    return np.asarray(uniq, dtype=object)[tabla.reshape(ngrupos, len(uniq)).argmax(axis=1)]
+
+def diagnostico_hueco(densidad_alta, digital, ingreso, edad):
+    """
+    (canal sugerido, frases de diagnóstico) de un clúster.
+    """
+    frases = ["Zona con ALTA densidad de clientes." if densidad_alta else "Zona con densidad MEDIA de clientes."]
+    if digital >= RECO_DIGITAL_ALTO:
+        frases.append("Clientes altamente digitales → priorizar autoservicio.")
+    elif digital < RECO_DIGITAL_BAJO:
+        frases.append("Los clientes NO son digitales → requieren asistencia humana.")
+    else:
+        frases.append("Zona con nivel medio de digitalización.")
+    ingreso_alto = RECO_INGRESO_ALTO > 0 and ingreso >= RECO_INGRESO_ALTO
+    if ingreso_alto:
+        frases.append("Ingresos altos → potencial para oficina / servicios avanzados.")
+    adultos = edad >= RECO_EDAD_ADULTA
+    frases.append("Clientes adultos → baja afinidad a autoservicio." if adultos
+                  else "Clientes jóvenes → mayor afinidad a autoservicio.")
+
+    if ingreso_alto and densidad_alta:
+        canal = "oficina"
+    elif digital >= RECO_DIGITAL_ALTO or (digital >= RECO_DIGITAL_BAJO and not adultos):
+        canal = "atm"
+    else:
+        canal = "agente"
+    return canal, frases
+
+def recomendar_huecos(dff, maximo=RECO_MAX):
+    """
+    Huecos de cobertura de los clientes de dff, de mayor a menor puntaje,
+    como registros con las columnas del antiguo recomendaciones.csv
+    (+ puntaje y distancia media al canal actual).
+
+    puntaje = clientes * log(1 + km al canal) * (1 + % digital)
+              * ingreso / ingreso nacional * sqrt(densidad / densidad núcleo)
+    """
+    if dff.empty:
+        return []
+    dist_km = np.min([dff[c].to_numpy(dtype=float) for c in RECO_DIST_COLS], axis=0) / 1000.0
+    desc = np.flatnonzero(dist_km > RECO_RADIO_KM)
+    lats = dff["latitud"].to_numpy(dtype=float)[desc]
+    lons = dff["longitud"].to_numpy(dtype=float)[desc]
+    etiqueta, celdas = clusters_grilla(lats, lons)
+    ok = etiqueta >= 0
+    k = len(celdas)
+    if k == 0:
+        return []
+    grupo, filas = etiqueta[ok], desc[ok]
+    sub = dff.take(filas)
+
+    def prom(v):
+        v = np.asarray(v, dtype=float)
+        val = ~np.isnan(v)
+        s = np.bincount(grupo, weights=np.where(val, v, 0.0), minlength=k)
+        c = np.bincount(grupo, weights=val, minlength=k)
+        return np.divide(s, c, out=np.zeros(k), where=c > 0)
+
+    def prom_col(col):
+        return prom(sub[col].to_numpy(dtype=float)) if col in sub.columns else np.zeros(k)
+
+    n = np.bincount(grupo, minlength=k)
+    densidad = n / (celdas * RECO_CELDA_KM ** 2)
+    densidad_nucleo = RECO_MIN_CLIENTES / RECO_CELDA_KM ** 2
+    brecha_km = prom(dist_km[filas])
+    digital, ingreso, edad = prom_col("flag_digital"), prom_col("ingresos"), prom_col("edad")
+    puntaje = (n * np.log1p(brecha_km) * (1 + digital)
+               * (ingreso / RECO_INGRESO_REF if RECO_INGRESO_REF > 0 else 1.0)
+               * np.sqrt(densidad / densidad_nucleo))
+
+    lat_c, lon_c = prom(lats[ok]), prom(lons[ok])
+    geo = {c: moda_por_grupo(grupo, k, _claves_canonicas(sub, [c])[0]) for c in ["departamento", "provincia", "distrito"]}
+    perfil = moda_por_grupo(grupo, k, sub["segmento"].to_numpy()) if "segmento" in sub.columns else np.full(k, "", dtype=object)
+
+    registros = []
+    for i in np.argsort(-puntaje, kind="stable")[:maximo]:
+        canal, frases = diagnostico_hueco(densidad[i] >= 2 * densidad_nucleo, digital[i], ingreso[i], edad[i])
+        registros.append({
+            "cluster": len(registros),
+            "lat": round(float(lat_c[i]), 6),
+            "lon": round(float(lon_c[i]), 6),
+            "canal": canal,
+            "clientes_afectados": int(n[i]),
+            "departamento": geo["departamento"][i],
+            "provincia": geo["provincia"][i],
+            "distrito": geo["distrito"][i],
+            "perfil_top": str(perfil[i]),
+            "pct_digital": round(float(digital[i]), 4),
+            "ingreso_prom": round(float(ingreso[i]), 2),
+            "edad_prom": round(float(edad[i]), 1),
+            "diagnostico": str(frases),
+            "puntaje": round(float(puntaje[i]), 2),
+            "dist_canal_km": round(float(brecha_km[i]), 3),
+        })
+    return registros
+
+# ============================================================
+# 3M. SIMULACIÓN INCREMENTAL (QUÉ PASA SI) ✅
+#   - Agregar / quitar ATMs, agentes u oficinas hipotéticos y ver cómo
+#     cambia la distancia de los clientes al canal más cercano
+#   - Quitar: solo se recalculan los clientes cuyo vecino era el punto
+#     quitado (CERCANOS_CLIENTES), contra el índice del canal sin él
+#   - Agregar: solo se revisan las celdas de clientes cuya cota inferior
+#     de distancia al punto nuevo es menor que la mayor DIST_<CANAL>_M
+#     de la celda; en las demás ningún cliente puede mejorar
+#   - No modifica nada: devuelve las distancias nuevas de los afectados
+# ============================================================
+SIM_MAX_PUNTOS = int(os.getenv("SIM_MAX_PUNTOS", "50"))
+SIM_TOL_M = 25.0   # distancia máxima para reconocer el punto a quitar
+SIM_MARGEN = 1 - 1e-9  # la cota ya es de gran círculo: solo absorbe redondeo
+
+SIM_LATS = df_clientes["latitud"].to_numpy(dtype=float)
+SIM_LONS = df_clientes["longitud"].to_numpy(dtype=float)
+SIM_INDICE = construir_indice_cercania(SIM_LATS, SIM_LONS)
+
+def celdas_indice(indice):
+    """
+    Tramos [ini, fin) de cada celda no vacía del índice y su esquina (ix, iy).
+    """
+    cid = indice["cid"]
+    ini = np.flatnonzero(np.r_[True, cid[1:] != cid[:-1]]) if len(cid) else np.zeros(0, dtype=np.int64)
+    return {
+        "ini": ini,
+        "fin": np.r_[ini[1:], len(cid)].astype(np.int64),
+        "ix": np.floor(indice["x"][ini] / indice["celda"]),
+        "iy": np.floor(indice["y"][ini] / indice["celda"]),
+    }
+
+SIM_CELDAS = celdas_indice(SIM_INDICE)
+SIM_MAX_CELDA = {
+    canal: (np.maximum.reduceat(df_clientes[f"DIST_{canal.upper()}_M"].to_numpy(dtype=float)[SIM_INDICE["orden"]],
+                                SIM_CELDAS["ini"]) if len(SIM_CELDAS["ini"]) else np.zeros(0))
+    for canal in COBERTURA_CANALES
+}
+
+def indice_sin(indice, quitar):
+    """
+    Índice de cercanía sin las posiciones `quitar` (sigue ordenado por celda).
+    """
+    queda = ~np.isin(indice["orden"], quitar)
+    return dict(indice, x=indice["x"][queda], y=indice["y"][queda], xyz=indice["xyz"][queda],
+                cid=indice["cid"][queda], orden=indice["orden"][queda])
+
+def puntos_param(texto):
+    """
+    "canal,lat,lon;canal,lat,lon" -> [(canal, lat, lon)]; ValueError si
+    algún punto no se entiende.
+    """
+    puntos = []
+    for item in (texto or "").split(";"):
+        if not item.strip():
+            continue
+        partes = [p.strip() for p in item.split(",")]
+        if len(partes) != 3 or partes[0].lower() not in COBERTURA_CANALES:
+            raise ValueError(item)
+        lat, lon = float(partes[1]), float(partes[2])
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError(item)
+        puntos.append((partes[0].lower(), lat, lon))
+    return puntos
+
+def clientes_cerca_de(canal, lats, lons):
+    """
+    Posiciones (ordenadas) de los clientes que un punto nuevo del canal
+    podría acercar: celdas con cota inferior < su mayor DIST_<CANAL>_M.
+    """
+    c, kx = SIM_INDICE["celda"], SIM_INDICE["kx"]
+    qx = np.asarray(lons, dtype=float)[:, None] * kx
+    qy = np.asarray(lats, dtype=float)[:, None]
+    x0, y0 = SIM_CELDAS["ix"][None, :] * c, SIM_CELDAS["iy"][None, :] * c
+    dx = np.maximum(0.0, np.maximum(x0 - qx, qx - (x0 + c)))
+    dy = np.maximum(0.0, np.maximum(y0 - qy, qy - (y0 + c)))
+    # |dlat| >= dy, |dlon| >= dx / kx y cos(lat) >= cos(lat_max) en ambos
+    # extremos: en haversine, sin²(d/2) >= sin²(dlat/2) + cos²(lat_max) sin²(dlon/2)
+    cos_max = np.cos(np.radians(np.minimum(np.maximum(SIM_INDICE["lat_max"], np.abs(qy)), 90.0)))
+    dlat, dlon = np.radians(dy), np.radians(np.minimum(dx / kx, 180.0))
+    s2 = np.sin(dlat / 2) ** 2 + (cos_max * np.sin(dlon / 2)) ** 2
+    cota = (2 * np.arcsin(np.sqrt(np.minimum(s2, 1.0))) * _RADIO_TIERRA_M).min(axis=0) * SIM_MARGEN
+    filas = np.repeat(cota < SIM_MAX_CELDA[canal], SIM_CELDAS["fin"] - SIM_CELDAS["ini"])
+    return np.sort(SIM_INDICE["orden"][filas])
+
+def _coords_canal(pos, clats, clons):
+    """
+    Coordenadas de las posiciones del canal (NaN donde pos = -1).
+    """
+    ok = (pos >= 0) & (len(clats) > 0)
+    seguro = np.where(ok, pos, 0)
+    if len(clats) == 0:
+        return np.full(len(pos), np.nan), np.full(len(pos), np.nan)
+    return np.where(ok, clats[seguro], np.nan), np.where(ok, clons[seguro], np.nan)
+
+def simular_canales(agregar, quitar):
+    """
+    ({canal: (posiciones de clientes que cambian, DIST nueva en metros)},
+    puntos a quitar que no se encontraron). El resultado es el de
+    reconstruir todo con los puntos agregados / quitados.
+    """
+    cambios, no_encontrados = {}, []
+    for canal, (fc, clat, clon) in COBERTURA_CANALES.items():
+        nuevos = [(la, lo) for c, la, lo in agregar if c == canal]
+        viejos = [(la, lo) for c, la, lo in quitar if c == canal]
+        if not nuevos and not viejos:
+            continue
+        base = df_clientes[f"DIST_{canal.upper()}_M"].to_numpy()
+        clats, clons = fc[clat].to_numpy(dtype=float), fc[clon].to_numpy(dtype=float)
+
+        indice, quitados = INDICES_CANALES[canal], []
+        for la, lo in viejos:
+            pos, d = vecinos_cercanos(indice, [la], [lo])
+            if pos[0] < 0 or d[0] > SIM_TOL_M:
+                no_encontrados.append({"canal": canal, "lat": la, "lon": lo})
+                continue
+            quitados.append(int(pos[0]))
+            indice = indice_sin(indice, quitados)
+
+        # clientes que se quedan sin su canal más cercano
+        afectados = np.flatnonzero(np.isin(CERCANOS_CLIENTES[canal], quitados)) if quitados else np.zeros(0, dtype=np.int64)
+        vecino_afectados, _ = vecinos_cercanos(indice, SIM_LATS[afectados], SIM_LONS[afectados])
+
+        posiciones = afectados
+        vecino = vecino_afectados
+        if nuevos:
+            nlats, nlons = np.array(nuevos, dtype=float).T
+            posiciones = np.union1d(clientes_cerca_de(canal, nlats, nlons), afectados)
+            vecino = CERCANOS_CLIENTES[canal][posiciones].copy()
+            vecino[np.searchsorted(posiciones, afectados)] = vecino_afectados
+        vlat, vlon = _coords_canal(vecino, clats, clons)
+
+        final = haversine_m(SIM_LATS[posiciones], SIM_LONS[posiciones], vlat, vlon)
+        final[np.isnan(final)] = np.inf
+        for la, lo in nuevos:
+            final = np.minimum(final, haversine_m(SIM_LATS[posiciones], SIM_LONS[posiciones], la, lo))
+        final = final.astype(np.float32)
+        cambia = final != base[posiciones]
+        cambios[canal] = (posiciones[cambia], final[cambia])
+    return cambios, no_encontrados
+
+def cobertura_simulada(pos, canales, cambios):
+    """
+    Distancia al canal más cercano (entre `canales`) de los clientes en
+    `pos` (ordenadas), antes y después de la simulación, y cuántos
+    cambian por canal.
+    """
+    antes = np.full(len(pos), np.inf, dtype=np.float32)
+    despues = antes.copy()
+    por_canal = {}
+    for canal in canales:
+        base = df_clientes[f"DIST_{canal.upper()}_M"].to_numpy()[pos]
+        antes = np.minimum(antes, base)
+        nuevo = base
+        cp, cd = cambios.get(canal, (np.zeros(0, dtype=np.int64), None))
+        k = np.searchsorted(pos, cp)
+        dentro = k < len(pos)
+        dentro[dentro] = pos[k[dentro]] == cp[dentro]
+        if dentro.any():
+            nuevo = base.copy()
+            nuevo[k[dentro]] = cd[dentro]
+        por_canal[canal] = int(np.count_nonzero(dentro))
+        despues = np.minimum(despues, nuevo)
+    return antes, despues, por_canal
 
 # ============================================================
-# UNIFICACIÓN DE DIVISIONES (Islas + Oficinas + Agentes)
+# 3N. ÁREAS DE INFLUENCIA (VORONOI) POR CANAL ✅
+#   - Atribución: cada cliente pertenece a su ATM / agente / oficina más
+#     cercano (CERCANOS_CLIENTES de 3K, int32, calculado una vez)
+#   - Perfil por canal = agregar_hojas_clientes (3G) con el canal como
+#     grupo: una fila por ATM / agente / oficina, lookup O(1)
+#   - Polígono de Voronoi en la métrica del índice del canal (la misma
+#     de la atribución), recortando un cuadrado de CATCHMENT_MAX_KM con
+#     las bisectrices de los vecinos; se calcula al pedirlo y se memoiza
 # ============================================================
-div_frames = []
-div_frames.append(
-    df[[COL_DEPT, COL_PROV, COL_DIST, COL_DIV]].rename(
-        columns={COL_DEPT: "departamento", COL_PROV: "provincia", COL_DIST: "distrito", COL_DIV: "division"}
-    )
-)
-div_frames.append(
-    df_agentes[[COLA_DEPT, COLA_PROV, COLA_DIST, COLA_DIV]].rename(
-        columns={COLA_DEPT: "departamento", COLA_PROV: "provincia", COLA_DIST: "distrito", COLA_DIV: "division"}
-    )
-)
-div_frames.append(
-    df_oficinas[[COLF_DEPT, COLF_PROV, COLF_DIST, COLF_DIV]].rename(
-        columns={COLF_DEPT: "departamento", COLF_PROV: "provincia", COLF_DIST: "distrito", COLF_DIV: "division"}
-    )
-)
-
-div_all = pd.concat(div_frames, ignore_index=True)
-div_all["departamento"] = div_all["departamento"].apply(clean_str)
-div_all["provincia"] = div_all["provincia"].apply(clean_str)
-div_all["distrito"] = div_all["distrito"].apply(clean_str)
-div_all["division"] = div_all["division"].apply(clean_str)
+CATCHMENT_MAX_KM = float(os.getenv("CATCHMENT_MAX_KM", "50"))
+CATCHMENT_MAX_POLIGONOS = int(os.getenv("CATCHMENT_MAX_POLIGONOS", "3000"))
+CATCHMENT_CAMPOS = {
+    "atm": (COL_ATM, COL_NAME),
+    "agente": (COLA_ID, COLA_COM),
+    "oficina": (COLF_ID, COLF_NAME),
+}
+
+def construir_perfiles_canal(canal):
+    """
+    Matriz (canales x columnas de CUBO_HOJAS) con el perfil de los
+    clientes atribuidos a cada punto del canal.
+    """
+    frame = COBERTURA_CANALES[canal][0]
+    if frame is None or frame.empty:
+        return np.zeros((0, len(CUBO_POS)))
+    hojas, _ = agregar_hojas_clientes(df_clientes, CERCANOS_CLIENTES[canal].astype(np.int64), len(frame))
+    return hojas[list(CUBO_HOJAS.columns)].to_numpy(dtype=float)
+
+PERFILES_CANAL = {canal: construir_perfiles_canal(canal) for canal in COBERTURA_CANALES}
+FILA_INDICE_CANAL = {canal: np.argsort(ind["orden"]) for canal, ind in INDICES_CANALES.items()}
+POLIGONOS_CANAL = {canal: {} for canal in COBERTURA_CANALES}
+_POLIGONOS_LOCK = threading.Lock()
+
+def recortar_bisectriz(poly, ax, ay, bx, by):
+    """
+    Parte del polígono [(x, y), ...] más cerca de a que de b
+    (Sutherland-Hodgman contra la bisectriz).
+    """
+    nx, ny = bx - ax, by - ay
+    c = (bx * bx + by * by - ax * ax - ay * ay) / 2
+    salida = []
+    for k in range(len(poly)):
+        px, py = poly[k - 1]
+        qx, qy = poly[k]
+        fp, fq = nx * px + ny * py - c, nx * qx + ny * qy - c
+        if fp <= 0:
+            salida.append((px, py))
+        if (fp < 0 < fq) or (fq < 0 < fp):
+            t = fp / (fp - fq)
+            salida.append((px + t * (qx - px), py + t * (qy - py)))
+    return salida
+
+def poligono_voronoi(canal, pos):
+    """
+    Celda de Voronoi del punto `pos` del canal como [[lat, lon], ...],
+    acotada a CATCHMENT_MAX_KM alrededor del punto ([] si otro punto en
+    el mismo sitio se queda con sus clientes).
+    """
+    indice = INDICES_CANALES[canal]
+    celda, cids, kx = indice["celda"], indice["cid"], indice["kx"]
+    fila = FILA_INDICE_CANAL[canal][pos]
+    ax, ay = float(indice["x"][fila]), float(indice["y"][fila])
+    # x del índice usa el coseno de la latitud mediana; el polígono se arma
+    # con el de la latitud del punto, así sigue al vecino de gran círculo
+    escala = math.cos(math.radians(ay)) / kx
+    h = CATCHMENT_MAX_KM * 1000 / _M_POR_GRADO
+    poly = [(ax - h, ay - h), (ax + h, ay - h), (ax + h, ay + h), (ax - h, ay + h)]
+    cy, cx = math.floor(ay / celda), math.floor(ax / celda)
+
+    aplicados = {fila}
+    r = 1
+    while True:
+        # bloque de (2r+1)^2 celdas: contiene todo lo que está a <= r * celda
+        filas = (cy + np.arange(-r, r + 1)) * _CP_FILA + cx
+        ini = np.searchsorted(cids, filas - r, side="left")
+        fin = np.searchsorted(cids, filas + r, side="right")
+        cand = np.concatenate([np.arange(a, b) for a, b in zip(ini, fin)])
+        cx_loc = ax + (indice["x"][cand] - ax) * escala
+        d = np.hypot(cx_loc - ax, indice["y"][cand] - ay)
+        for k in np.argsort(d, kind="stable"):
+            radio = max(math.hypot(x - ax, y - ay) for x, y in poly)
+            if d[k] > 2 * radio:
+                break
+            j = int(cand[k])
+            if j in aplicados:
+                continue
+            if d[k] == 0:
+                # mismo sitio: la atribución se la lleva la primera posición
+                if indice["orden"][j] < pos:
+                    return []
+                continue
+            aplicados.add(j)
+            poly = recortar_bisectriz(poly, ax, ay, float(cx_loc[k]), float(indice["y"][j]))
+        radio = max(math.hypot(x - ax, y - ay) for x, y in poly)
+        if 2 * radio <= r * celda * min(1.0, escala):
+            break
+        r *= 2
+    return [[round(y, 6), round((ax + (x - ax) / escala) / kx, 6)] for x, y in poly]
+
+def poligono_canal(canal, pos):
+    with _POLIGONOS_LOCK:
+        poly = POLIGONOS_CANAL[canal].get(pos)
+    if poly is None:
+        poly = poligono_voronoi(canal, pos)
+        with _POLIGONOS_LOCK:
+            POLIGONOS_CANAL[canal][pos] = poly
+    return poly
+
+def perfil_catchment(canal, pos):
+    fila = PERFILES_CANAL[canal][pos]
+    if fila[CUBO_POS["total"]] == 0:
+        return {"total": 0, "digital_pct": 0, "edad_prom": 0,
+                "ingreso_prom": 0, "deuda_prom": 0, "top_segmento": "—"}
+    return resumen_desde_cubo(fila)
 
-DIVISIONES = sorted(div_all["division"].dropna().unique())
+# ============================================================
+# 3O. ANILLOS DE DISTANCIA POR CANAL (500 m / 1 km / 3 km) ✅
+#   - Una vez al cargar: clientes y nodos a <= cada radio de cada ATM,
+#     agente y oficina (columnas ANILLO_CLI_<r> / ANILLO_NOD_<r>, int32)
+#   - Grilla con celdas del radio mayor: bloque 3x3 alrededor de la celda
+#     del canal, más ancho si hay canales lejos de la latitud mediana;
+#     distancia equirectangular local
+#   - /api/points?anillos=1 las agrega a cada punto y /api/anillos sirve
+#     los círculos + conteos de un canal
+# ============================================================
+ANILLOS_RADIOS_M = [500, 1000, 3000]
+ANILLOS_VERTICES = 64
+ANILLOS_LOTE = 4_000_000  # pares canal x punto por bloque de cálculo
+ANILLOS_CAPAS = {
+    "clientes": ("ANILLO_CLI", SIM_LATS, SIM_LONS),
+    "nodos": ("ANILLO_NOD", df_nodos["LATITUD"].to_numpy(dtype=float), df_nodos["LONGITUD"].to_numpy(dtype=float)),
+}
+
+def contar_en_radios(lats, lons, plats, plons, radios_m=ANILLOS_RADIOS_M):
+    """
+    Matriz int32 (coordenadas x radios): cuántos de (plats, plons) hay a
+    <= cada radio de cada coordenada.
+    """
+    n = len(lats)
+    out = np.zeros((n, len(radios_m)), dtype=np.int32)
+    if n == 0 or len(plats) == 0:
+        return out
+    # mismo radio terrestre que haversine_m (DIST_<CANAL>_M)
+    r_grados = max(radios_m) / math.radians(_RADIO_TIERRA_M)
+    r2 = (np.asarray(radios_m, dtype=float) / math.radians(_RADIO_TIERRA_M)) ** 2
+    indice = construir_indice_cercania(plats, plons, r_grados)
+    cids, kx, celda = indice["cid"], indice["kx"], indice["celda"]
+    cand_lats = np.asarray(plats, dtype=float)[indice["orden"]]
+    cand_lons = np.asarray(plons, dtype=float)[indice["orden"]]
+
+    # el índice escala la longitud por el coseno de la latitud mediana (kx);
+    # a r_grados de una consulta a latitud φ hay |dlon| * kx <= r_grados * kx / cos φ,
+    # así que el bloque se ensancha con la consulta más alejada del ecuador
+    lat_max = float(np.nanmax(np.abs(lats))) if np.isfinite(lats).any() else 0.0
+    cos_min = math.cos(math.radians(min(lat_max, 89.9)))
+    b = int(r_grados * max(1.0, kx / cos_min) // celda) + 1
+    qix = np.floor(lons * kx / celda).astype(np.int64)
+    qiy = np.floor(lats / celda).astype(np.int64)
+    _, grupo = np.unique(qiy * _CP_FILA + qix, return_inverse=True)
+    orden_q = np.argsort(grupo, kind="stable")
+    for q in np.split(orden_q, np.flatnonzero(np.diff(grupo[orden_q])) + 1):
+        cy, cx = qiy[q[0]], qix[q[0]]
+        filas = (cy + np.arange(-b, b + 1)) * _CP_FILA + cx
+        ini = np.searchsorted(cids, filas - b, side="left")
+        fin = np.searchsorted(cids, filas + b, side="right")
+        cand = np.concatenate([np.arange(a, b) for a, b in zip(ini, fin)])
+        if len(cand) == 0:
+            continue
+        clat, clon = cand_lats[cand], cand_lons[cand]
+        lote = max(1, ANILLOS_LOTE // len(cand))
+        for i in range(0, len(q), lote):
+            qq = q[i:i + lote]
+            coslat = np.cos(np.radians(lats[qq]))[:, None]
+            d2 = (lats[qq, None] - clat) ** 2 + ((lons[qq, None] - clon) * coslat) ** 2
+            for j, r in enumerate(r2):
+                out[qq, j] = np.count_nonzero(d2 <= r, axis=1)
+    return out
+
+def unir_anillos(frame, col_lat, col_lon):
+    lats = frame[col_lat].to_numpy(dtype=float)
+    lons = frame[col_lon].to_numpy(dtype=float)
+    for prefijo, plats, plons in ANILLOS_CAPAS.values():
+        conteo = contar_en_radios(lats, lons, plats, plons)
+        for j, r in enumerate(ANILLOS_RADIOS_M):
+            frame[f"{prefijo}_{r}"] = conteo[:, j]
+
+for _fc, _clat, _clon in COBERTURA_CANALES.values():
+    unir_anillos(_fc, _clat, _clon)
+
+def campos_anillos(dff):
+    """
+    Por fila: {"clientes": {"500": n, ...}, "nodos": {...}}.
+    """
+    por_capa = {
+        capa: [dict(zip([str(r) for r in ANILLOS_RADIOS_M], fila))
+               for fila in dff[[f"{prefijo}_{r}" for r in ANILLOS_RADIOS_M]].to_numpy().tolist()]
+        for capa, (prefijo, _, _) in ANILLOS_CAPAS.items()
+    }
+    return [dict(zip(por_capa, filas)) for filas in zip(*por_capa.values())]
 
-DIVISIONES_BY_DEPT = {}
-for dep in DEPARTAMENTOS:
-    divs = div_all.loc[div_all["departamento"] == dep, "division"].dropna().unique().tolist()
-    DIVISIONES_BY_DEPT[dep] = sorted(set(divs))
+def circulo(lat, lon, radio_m, vertices=ANILLOS_VERTICES):
+    """
+    Círculo [[lat, lon], ...] de radio_m alrededor del punto.
+    """
+    ang = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    dlat = radio_m / _M_POR_GRADO * np.sin(ang)
+    dlon = radio_m / (_M_POR_GRADO * max(math.cos(math.radians(lat)), 1e-6)) * np.cos(ang)
+    return np.round(np.column_stack([lat + dlat, lon + dlon]), 6).tolist()
 
-DIVISIONES_BY_PROV = {}
-for dep, prov_list in PROVINCIAS_BY_DEPT.items():
-    for p in prov_list:
-        divs = div_all.loc[div_all["provincia"] == p, "division"].dropna().unique().tolist()
-        DIVISIONES_BY_PROV[p] = sorted(set(divs))
+def _posiciones_por_id(frame, col_id):
+    if frame is None or col_id not in frame.columns:
+        return {}
+    ids = frame[col_id].astype(str).tolist()
+    return {v: i for i, v in reversed(list(enumerate(ids)))}  # id repetido: la primera fila
 
-DIVISIONES_BY_DIST = {}
-for prov, dists in DIST_BY_PROV.items():
-    for d in dists:
-        divs = div_all.loc[div_all["distrito"] == d, "division"].dropna().unique().tolist()
-        DIVISIONES_BY_DIST[d] = sorted(set(divs))
+ANILLOS_ID_POS = {canal: _posiciones_por_id(COBERTURA_CANALES[canal][0], col_id)
+                  for canal, (col_id, _) in CATCHMENT_CAMPOS.items()}
 
 # ============================================================
 # 4. FLASK + LOGIN
@@ -618,6 +2809,11 @@ APP_PASS = os.getenv("APP_PASSWORD", "clave123")
 
 @app.after_request
 def add_header(resp):
+    if resp.headers.get("ETag"):
+        # respuestas de respuesta_cacheada(): el navegador puede guardarlas,
+        # pero debe revalidar con If-None-Match (304 si no cambió la data)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
     resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     resp.headers["Pragma"] = "no-cache"
     resp.headers["Expires"] = "0"
@@ -691,6 +2887,116 @@ def login_required(f):
         return f(*args, **kwargs)
     return wrapped
 
+# ============================================================
+# 4B. CACHE DE RESPUESTAS (LRU POR TAMAÑO) + ETAG ✅
+#   - Guarda el cuerpo serializado por (endpoint, filtros)
+#   - Expulsa las menos usadas cuando se supera RESPONSE_CACHE_MAX_MB
+#   - ETag / Last-Modified salen de la versión de la data cargada
+# ============================================================
+RESPONSE_CACHE_MAX_BYTES = int(float(os.getenv("RESPONSE_CACHE_MAX_MB", "64")) * 1024 * 1024)
+RESPONSE_CACHE = OrderedDict()
+RESPONSE_CACHE_STATS = {"bytes": 0, "hits": 0, "misses": 0, "evictions": 0}
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+# huella del código: un deploy que cambia la forma de las respuestas
+# invalida ETags y tiles en disco aunque los datos no cambien
+with open(os.path.abspath(__file__), "rb") as _f:
+    CODIGO_VERSION = hashlib.sha1(_f.read()).hexdigest()[:12]
+
+def _version_datos():
+    h = hashlib.sha1(f"{SNAPSHOT_VERSION}:{CODIGO_VERSION}".encode("utf-8"))
+    mtimes = [os.path.getmtime(p["path"]) for p in SNAPSHOT_FUENTES_HUELLAS.values() if p]
+    mtimes.append(os.path.getmtime(os.path.abspath(__file__)))
+    for path in ["data/clientes_huanuco_v6.csv", CACHE_FILE, NODO_REGLAS_FILE]:
+        if os.path.exists(path):
+            st = os.stat(path)
+            h.update(f"{path}:{st.st_mtime_ns}:{st.st_size};".encode("utf-8"))
+            mtimes.append(st.st_mtime)
+    ultimo = datetime.fromtimestamp(max(mtimes), tz=timezone.utc) if mtimes else datetime.now(timezone.utc)
+    return h.hexdigest()[:16], ultimo.replace(microsecond=0)
+
+DATA_VERSION, DATA_LAST_MODIFIED = _version_datos()
+
+def cache_respuesta_get(key):
+    with _RESPONSE_CACHE_LOCK:
+        hit = RESPONSE_CACHE.get(key)
+        if hit is None:
+            RESPONSE_CACHE_STATS["misses"] += 1
+            return None
+        RESPONSE_CACHE.move_to_end(key)
+        RESPONSE_CACHE_STATS["hits"] += 1
+        return hit
+
+def cache_respuesta_put(key, body, mimetype):
+    size = len(body)
+    if size > RESPONSE_CACHE_MAX_BYTES:
+        return
+    with _RESPONSE_CACHE_LOCK:
+        old = RESPONSE_CACHE.pop(key, None)
+        if old is not None:
+            RESPONSE_CACHE_STATS["bytes"] -= len(old[0])
+        RESPONSE_CACHE[key] = (body, mimetype)
+        RESPONSE_CACHE_STATS["bytes"] += size
+        while RESPONSE_CACHE_STATS["bytes"] > RESPONSE_CACHE_MAX_BYTES:
+            _, (b, _) = RESPONSE_CACHE.popitem(last=False)
+            RESPONSE_CACHE_STATS["bytes"] -= len(b)
+            RESPONSE_CACHE_STATS["evictions"] += 1
+
+# parámetros que no son filtros: se distinguen mayúsculas y van tal cual
+CLAVE_SIN_MAYUSCULAS = {"id", "agregar", "quitar"}
+
+def _clave_respuesta():
+    # filtros vacíos ("departamento=") equivalen a no enviarlos
+    args = tuple(sorted(
+        (k, v.strip() if k in CLAVE_SIN_MAYUSCULAS else v.strip().upper())
+        for k, v in request.args.items() if v.strip()
+    ))
+    return (request.endpoint, args)
+
+def respuesta_cacheada(f):
+    """
+    Cachea el cuerpo de respuestas 200 por endpoint + filtros normalizados
+    y responde 304 si el navegador ya tiene la misma versión.
+    """
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        key = _clave_respuesta()
+        etag = f"{DATA_VERSION}-{hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:12]}"
+
+        if etag in request.if_none_match or (
+            not request.if_none_match
+            and request.if_modified_since
+            and request.if_modified_since >= DATA_LAST_MODIFIED
+        ):
+            resp = app.response_class(status=304)
+            resp.set_etag(etag)
+            resp.last_modified = DATA_LAST_MODIFIED
+            return resp
+
+        hit = cache_respuesta_get(key)
+        if hit is not None:
+            resp = app.response_class(hit[0], mimetype=hit[1])
+            resp.headers["X-Cache"] = "HIT"
+        else:
+            resp = make_response(f(*args, **kwargs))
+            if resp.status_code == 200:
+                cache_respuesta_put(key, resp.get_data(), resp.mimetype)
+            resp.headers["X-Cache"] = "MISS"
+
+        resp.set_etag(etag)
+        resp.last_modified = DATA_LAST_MODIFIED
+        return resp
+    return wrapped
+
+@app.route("/api/metricas")
+@login_required
+def api_metricas():
+    with _RESPONSE_CACHE_LOCK:
+        respuestas = dict(RESPONSE_CACHE_STATS, entradas=len(RESPONSE_CACHE))
+    with _DIRECCIONES_LOCK:
+        direcciones = dict(DIRECCIONES_STATS)
+    return jsonify({"cache_respuestas": respuestas, "direcciones": direcciones})
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
@@ -769,39 +3075,33 @@ def selector():
 
 @app.route("/api/recomendaciones")
 @login_required
+@respuesta_cacheada
 def api_recomendaciones():
-    return jsonify(recomendaciones.to_dict(orient="records"))
+    dpto = request.args.get("departamento", "").upper().strip()
+    prov = request.args.get("provincia", "").upper().strip()
+    dist = request.args.get("distrito", "").upper().strip()
+    seg = request.args.get("segmento", "").upper().strip()
+    return responder_json(recomendar_huecos(seleccionar("cliente", dpto, prov, dist, seg)))
 
 # ============================================================
 # ✅ API ZONAS — /api/zonas (RURAL / URBANA)
 # ============================================================
 @app.route("/api/zonas")
 @login_required
+@respuesta_cacheada
 def api_zonas():
     dpto = request.args.get("departamento", "").upper().strip()
     prov = request.args.get("provincia", "").upper().strip()
     dist = request.args.get("distrito", "").upper().strip()
 
-    def build_for(tipo_key):
-        cache_key = (dpto, prov, dist, tipo_key)
-        if cache_key in ZONAS_HULL_CACHE:
-            return ZONAS_HULL_CACHE[cache_key]
-
-        dff = df_zonas
-        if dpto: dff = dff[dff["DEPARTAMENTO"] == dpto]
-        if prov: dff = dff[dff["PROVINCIA"] == prov]
-        if dist: dff = dff[dff["DISTRITO"] == dist]
+    nivel = nivel_zonas(request.args.get("zoom"))
 
-        dff_t = dff[dff["TIPO_ZONA"].astype(str).str.contains(tipo_key, na=False)]
-        poly = _zona_polygon_latlon(dff_t)
-        out = {"count": int(len(dff_t)), "poly": poly}
-        ZONAS_HULL_CACHE[cache_key] = out
-        return out
-
-    rural = build_for("RURAL")
-    urban = build_for("URBAN")
-
-    return jsonify({"rural": rural, "urbano": urban})
+    cascos = ZONAS_CASCOS.get((dpto, prov, dist), {})
+    out = {"nivel": nivel, "niveles": ZONAS_ZOOMS}
+    for nombre in ZONAS_TIPOS:
+        c = cascos.get(nombre)
+        out[nombre] = {"count": c["count"], "anillos": c["niveles"][nivel]} if c else {"count": 0, "anillos": []}
+    return responder_json(out)
 
 # ============================================================
 # ✅ API NODOS/COMERCIAL — /api/nodos
@@ -810,6 +3110,7 @@ def api_zonas():
 # ============================================================
 @app.route("/api/nodos")
 @login_required
+@respuesta_cacheada
 def api_nodos():
     dpto = request.args.get("departamento", "").upper().strip()
     prov = request.args.get("provincia", "").upper().strip()
@@ -818,72 +3119,26 @@ def api_nodos():
     if df_nodos is None or df_nodos.empty:
         return jsonify({"total": 0, "resumen": {}, "nodos": []})
 
-    dff = df_nodos.copy()
-    dff["DEPARTAMENTO"] = dff["DEPARTAMENTO"].astype(str).str.upper().str.strip()
-    dff["PROVINCIA"] = dff["PROVINCIA"].astype(str).str.upper().str.strip()
-    dff["DISTRITO"] = dff["DISTRITO"].astype(str).str.upper().str.strip()
-
-    if dpto: dff = dff[dff["DEPARTAMENTO"] == dpto]
-    if prov: dff = dff[dff["PROVINCIA"] == prov]
-    if dist: dff = dff[dff["DISTRITO"] == dist]
-
-    resumen = {
-        "total": 0,
-        "hospitales": 0,
-        "clinicas": 0,
-        "centros_comerciales": 0,
-        "plaza_vea": 0,
-        "sodimac": 0,
-        "metro": 0,
-        "tottus": 0,
-        "wong": 0,
-        "universidades": 0,
-        "mercados": 0,
-        "otros": 0,
-    }
-
-    nodos = []
-    for _, r in dff.iterrows():
-        nombre = str(r.get("NOMBRE","")).strip()
-        cat = nodo_categoria(nombre)
-
-        # conteos panel
-        resumen["total"] += 1
-        if cat == "HOSPITAL":
-            resumen["hospitales"] += 1
-        elif cat == "CLINICA":
-            resumen["clinicas"] += 1
-        elif cat == "CENTRO_COMERCIAL":
-            resumen["centros_comerciales"] += 1
-        elif cat == "PLAZA_VEA":
-            resumen["plaza_vea"] += 1
-        elif cat == "SODIMAC":
-            resumen["sodimac"] += 1
-        elif cat == "METRO":
-            resumen["metro"] += 1
-        elif cat == "TOTTUS":
-            resumen["tottus"] += 1
-        elif cat == "WONG":
-            resumen["wong"] += 1
-        elif cat == "UNIVERSIDAD":
-            resumen["universidades"] += 1
-        elif cat == "MERCADO":
-            resumen["mercados"] += 1
-        else:
-            resumen["otros"] += 1
-
-        nodos.append({
-            "ubigeo": str(r.get("UBIGEO","")).strip(),
-            "departamento": str(r.get("DEPARTAMENTO","")).strip(),
-            "provincia": str(r.get("PROVINCIA","")).strip(),
-            "distrito": str(r.get("DISTRITO","")).strip(),
-            "nombre": nombre,
-            "categoria": cat,
-            "lat": float(r.get("LATITUD", 0.0)),
-            "lon": float(r.get("LONGITUD", 0.0)),
-        })
+    resumen = resumen_nodos(dpto, prov, dist)
+    # solo_resumen=1: el panel sin la capa de marcadores
+    if request.args.get("solo_resumen", "") == "1":
+        return responder_json({"total": resumen["total"], "resumen": resumen, "nodos": []})
+
+    dff = seleccionar("nodo", dpto, prov, dist)
+    nodos = construir_registros({
+        "ubigeo": [v.strip() for v in _col_str(dff, "UBIGEO")],
+        "departamento": [v.strip() for v in _col_str(dff, "DEPARTAMENTO")],
+        "provincia": [v.strip() for v in _col_str(dff, "PROVINCIA")],
+        "distrito": [v.strip() for v in _col_str(dff, "DISTRITO")],
+        "nombre": [n.strip() for n in _col_str(dff, "NOMBRE")],
+        "categoria": _col_str(dff, "CATEGORIA"),
+        "lat": _col_float(dff, "LATITUD"),
+        "lon": _col_float(dff, "LONGITUD"),
+        "direccion": _col_str(dff, "DIRECCION"),
+        "direccion_aprox": _col_bool(dff, "DIRECCION_APROX"),
+    })
 
-    return jsonify({"total": len(nodos), "resumen": resumen, "nodos": nodos})
+    return responder_json({"total": len(nodos), "resumen": resumen, "nodos": nodos})
 
 # ============================================================
 # 6. RUTAS MAPA
@@ -928,11 +3183,142 @@ def mapa_tipo(tipo):
         initial_zoom=6,
     )
 
+# ============================================================
+# 7A. REGISTROS VECTORIZADOS + JSON RÁPIDO ✅
+#   - Arman la lista de puntos desde arrays de columnas (sin iterrows)
+#   - Mismo esquema JSON que antes; orjson si está instalado
+# ============================================================
+def _col_str(dff, col):
+    if not col or col not in dff.columns:
+        return [""] * len(dff)
+    return [str(v) for v in dff[col].tolist()]
+
+def _col_float(dff, col):
+    if not col or col not in dff.columns:
+        return [0.0] * len(dff)
+    return dff[col].astype(float).tolist()
+
+def _col_bool(dff, col):
+    if not col or col not in dff.columns:
+        return [False] * len(dff)
+    return dff[col].astype(bool).tolist()
+
+def _col_int(dff, col):
+    if not col or col not in dff.columns:
+        return [0] * len(dff)
+    return dff[col].astype(float).astype(np.int64).tolist()
+
+def construir_registros(campos):
+    """
+    campos: dict nombre -> lista (una por fila) o valor constante.
+    Devuelve la lista de dicts fila a fila.
+    """
+    n = max((len(v) for v in campos.values() if isinstance(v, list)), default=0)
+    nombres = list(campos.keys())
+    columnas = [v if isinstance(v, list) else itertools.repeat(v, n) for v in campos.values()]
+    return [dict(zip(nombres, fila)) for fila in zip(*columnas)]
+
+def registros_atms(dff, integral=False):
+    lats = _col_float(dff, COL_LAT)
+    lons = _col_float(dff, COL_LON)
+    atms = _col_str(dff, COL_ATM)
+
+    if integral:
+        nombres = _col_str(dff, COL_NAME) if COL_NAME in dff.columns else atms
+    else:
+        nombres = [n.strip() for n in _col_str(dff, COL_NAME)]
+        nombres = [n if n else a for n, a in zip(nombres, atms)]
+
+    campos = {}
+    if integral:
+        campos["tipo_canal"] = "ATM"
+    campos.update({
+        "lat": lats,
+        "lon": lons,
+        "atm": atms,
+        "nombre": nombres,
+        "promedio": _col_float(dff, PROM_COL),
+        "division": _col_str(dff, COL_DIV),
+        "tipo": _col_str(dff, COL_TIPO),
+        "ubicacion": _col_str(dff, COL_UBIC),
+        "departamento": _col_str(dff, COL_DEPT),
+        "provincia": _col_str(dff, COL_PROV),
+        "distrito": _col_str(dff, COL_DIST),
+        "direccion": _col_str(dff, "DIRECCION"),
+        "direccion_aprox": _col_bool(dff, "DIRECCION_APROX"),
+    })
+    if not integral:
+        campos["capa"] = ""
+    return construir_registros(campos)
+
+def registros_agentes(dff, integral=False):
+    campos = {}
+    if integral:
+        campos["tipo_canal"] = "AGENTE"
+    campos.update({
+        "lat": _col_float(dff, COLA_LAT),
+        "lon": _col_float(dff, COLA_LON),
+        "atm": _col_str(dff, COLA_ID),
+        "nombre": _col_str(dff, COLA_COM),
+        "promedio": _col_float(dff, PROMA_COL),
+        "division": _col_str(dff, COLA_DIV),
+        "tipo": "AGENTE",
+        "ubicacion": "AGENTE",
+        "departamento": _col_str(dff, COLA_DEPT),
+        "provincia": _col_str(dff, COLA_PROV),
+        "distrito": _col_str(dff, COLA_DIST),
+        "direccion": _col_str(dff, COLA_DIR),
+        "capa": _col_str(dff, COLA_CAPA),
+        "trxs_oct": _col_float(dff, COLA_TRX_OCT),
+        "trxs_nov": _col_float(dff, COLA_TRX_NOV),
+    })
+    return construir_registros(campos)
+
+def registros_oficinas(dff, integral=False):
+    campos = {}
+    if integral:
+        campos["tipo_canal"] = "OFICINA"
+    campos.update({
+        "lat": _col_float(dff, COLF_LAT),
+        "lon": _col_float(dff, COLF_LON),
+        "atm": _col_str(dff, COLF_ID),
+        "nombre": _col_str(dff, COLF_NAME),
+        "promedio": _col_float(dff, COLF_TRX),
+        "division": _col_str(dff, COLF_DIV),
+        "tipo": "OFICINA",
+        "ubicacion": "OFICINA",
+        "departamento": _col_str(dff, COLF_DEPT),
+        "provincia": _col_str(dff, COLF_PROV),
+        "distrito": _col_str(dff, COLF_DIST),
+        "direccion": _col_str(dff, "DIRECCION"),
+        "direccion_aprox": _col_bool(dff, "DIRECCION_APROX"),
+    })
+    if not integral:
+        campos["capa"] = ""
+    campos.update({
+        "estructura_as": _col_float(dff, COLF_EAS),
+        "estructura_ebp": _col_float(dff, COLF_EBP),
+        "estructura_ad": _col_float(dff, COLF_EAD),
+        "clientes_unicos": _col_int(dff, COLF_CLI),
+        "total_tickets": _col_int(dff, COLF_TKT),
+        "red_lines": _col_float(dff, COLF_RED),
+    })
+    return construir_registros(campos)
+
+def responder_json(obj):
+    if orjson is None:
+        return jsonify(obj)
+    return app.response_class(
+        orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY),
+        mimetype="application/json",
+    )
+
 # ============================================================
 # 7. API /api/points — ISLAS + AGENTES + OFICINAS
 # ============================================================
 @app.route("/api/points")
 @login_required
+@respuesta_cacheada
 def api_points():
     tipo_mapa = request.args.get("tipo", "").lower()
     dpto = request.args.get("departamento", "").upper().strip()
@@ -941,23 +3327,17 @@ def api_points():
     divi = request.args.get("division", "").upper().strip()
     tipo_atm = request.args.get("tipo_atm", "").upper().strip()
     ubic_atm = request.args.get("ubic_atm", "").upper().strip()
+    zona = zona_param(request.args.get("zona", ""))
+    bbox = parse_bbox(request.args.get("bbox", ""), request.args.get("zoom", ""))
+    con_anillos = request.args.get("anillos", "") == "1"
+    claves = (dpto, prov, dist, divi)
 
     # ---------------------- CAPA ISLAS (ATMs) ----------------------
     if tipo_mapa == "islas":
-        dff = df.copy()
-        dff[COL_DEPT] = dff[COL_DEPT].astype(str).str.upper().str.strip()
-        dff[COL_PROV] = dff[COL_PROV].astype(str).str.upper().str.strip()
-        dff[COL_DIST] = dff[COL_DIST].astype(str).str.upper().str.strip()
-        dff[COL_DIV] = dff[COL_DIV].astype(str).str.upper().str.strip()
-        dff[COL_UBIC] = dff[COL_UBIC].astype(str).str.upper().str.strip()
-        dff[COL_TIPO] = dff[COL_TIPO].astype(str).str.upper().str.strip()
-
-        if dpto: dff = dff[dff[COL_DEPT] == dpto]
-        if prov: dff = dff[dff[COL_PROV] == prov]
-        if dist: dff = dff[dff[COL_DIST] == dist]
-        if divi: dff = dff[dff[COL_DIV] == divi]
+        dff = seleccionar("atm_zona", *claves, zona)
         if tipo_atm: dff = dff[dff[COL_TIPO].str.contains(tipo_atm, na=False)]
         if ubic_atm: dff = dff[dff[COL_UBIC].str.contains(ubic_atm, na=False)]
+        zonas = conteo_zonas("atm", claves, zona, dff if (tipo_atm or ubic_atm) else None)
 
         total_atms = int(len(dff))
         suma_total = float(dff[PROM_COL].sum()) if total_atms > 0 else 0.0
@@ -968,34 +3348,17 @@ def api_points():
         total_mon = int(dff[COL_TIPO].str.contains("MONEDERO", na=False).sum())
         total_rec = int(dff[COL_TIPO].str.contains("RECICLADOR", na=False).sum())
 
-        puntos = []
-        for _, r in dff.iterrows():
-            nombre = ""
-            if COL_NAME and COL_NAME in r.index:
-                nombre = str(r.get(COL_NAME, "")).strip()
-            if not nombre:
-                nombre = str(r.get(COL_ATM, ""))
-
-            lat_v = float(r[COL_LAT])
-            lon_v = float(r[COL_LON])
-            puntos.append({
-                "lat": lat_v,
-                "lon": lon_v,
-                "atm": str(r.get(COL_ATM, "")),
-                "nombre": nombre,
-                "promedio": float(r.get(PROM_COL, 0.0)),
-                "division": str(r.get(COL_DIV, "")),
-                "tipo": str(r.get(COL_TIPO, "")),
-                "ubicacion": str(r.get(COL_UBIC, "")),
-                "departamento": str(r.get(COL_DEPT, "")),
-                "provincia": str(r.get(COL_PROV, "")),
-                "distrito": str(r.get(COL_DIST, "")),
-                "direccion": get_address(lat_v, lon_v),
-                "capa": "",
-            })
+        vista = recortar_vista("atm", dff, bbox)
+        puntos = registros_atms(vista)
+        if con_anillos:
+            for p, a in zip(puntos, campos_anillos(vista)):
+                p["anillos"] = a
 
-        return jsonify({
+        return responder_json({
             "puntos": puntos,
+            "bbox": bbox,
+            "bounds": limites(dff, COL_LAT, COL_LON),
+            "total_en_vista": len(puntos),
             "total_atms": total_atms,
             "total_oficinas": total_oficinas,
             "total_islas": total_islas,
@@ -1009,56 +3372,35 @@ def api_points():
             "total_capa_A3": 0,
             "total_capa_B": 0,
             "total_capa_C": 0,
+            **zonas,
         })
 
     # ---------------------- CAPA AGENTES ----------------------
     if tipo_mapa == "agentes":
-        dff = df_agentes.copy()
-        dff[COLA_DEPT] = dff[COLA_DEPT].astype(str).str.upper().str.strip()
-        dff[COLA_PROV] = dff[COLA_PROV].astype(str).str.upper().str.strip()
-        dff[COLA_DIST] = dff[COLA_DIST].astype(str).str.upper().str.strip()
-        dff[COLA_DIV] = dff[COLA_DIV].astype(str).str.upper().str.strip()
-        dff[COLA_CAPA] = dff[COLA_CAPA].astype(str).str.upper().str.strip()
-
-        if dpto: dff = dff[dff[COLA_DEPT] == dpto]
-        if prov: dff = dff[dff[COLA_PROV] == prov]
-        if dist: dff = dff[dff[COLA_DIST] == dist]
-        if divi: dff = dff[dff[COLA_DIV] == divi]
+        dff = seleccionar("agente_zona", *claves, zona)
+        zonas = conteo_zonas("agente", claves, zona)
 
         total_agentes = int(len(dff))
         suma_total = float(dff[PROMA_COL].sum()) if total_agentes > 0 else 0.0
 
-        capa_series = dff[COLA_CAPA].str.upper().fillna("")
+        capa_series = dff[COLA_CAPA]
         total_capa_A1 = int((capa_series == "A1").sum())
         total_capa_A2 = int((capa_series == "A2").sum())
         total_capa_A3 = int((capa_series == "A3").sum())
         total_capa_B = int((capa_series == "B").sum())
         total_capa_C = int((capa_series == "C").sum())
 
-        puntos = []
-        for _, r in dff.iterrows():
-            lat_v = float(r[COLA_LAT])
-            lon_v = float(r[COLA_LON])
-            puntos.append({
-                "lat": lat_v,
-                "lon": lon_v,
-                "atm": str(r.get(COLA_ID, "")),
-                "nombre": str(r.get(COLA_COM, "")),
-                "promedio": float(r.get(PROMA_COL, 0.0)),
-                "division": str(r.get(COLA_DIV, "")),
-                "tipo": "AGENTE",
-                "ubicacion": "AGENTE",
-                "departamento": str(r.get(COLA_DEPT, "")),
-                "provincia": str(r.get(COLA_PROV, "")),
-                "distrito": str(r.get(COLA_DIST, "")),
-                "direccion": str(r.get(COLA_DIR, "")),
-                "capa": str(r.get(COLA_CAPA, "")),
-                "trxs_oct": float(r.get(COLA_TRX_OCT, 0.0)) if COLA_TRX_OCT else 0.0,
-                "trxs_nov": float(r.get(COLA_TRX_NOV, 0.0)) if COLA_TRX_NOV else 0.0,
-            })
+        vista = recortar_vista("agente", dff, bbox)
+        puntos = registros_agentes(vista)
+        if con_anillos:
+            for p, a in zip(puntos, campos_anillos(vista)):
+                p["anillos"] = a
 
-        return jsonify({
+        return responder_json({
             "puntos": puntos,
+            "bbox": bbox,
+            "bounds": limites(dff, COLA_LAT, COLA_LON),
+            "total_en_vista": len(puntos),
             "total_atms": total_agentes,
             "total_oficinas": 0,
             "total_islas": 0,
@@ -1072,20 +3414,13 @@ def api_points():
             "total_capa_A3": total_capa_A3,
             "total_capa_B": total_capa_B,
             "total_capa_C": total_capa_C,
+            **zonas,
         })
 
     # ---------------------- CAPA OFICINAS ----------------------
     if tipo_mapa == "oficinas":
-        dff = df_oficinas.copy()
-        dff[COLF_DEPT] = dff[COLF_DEPT].astype(str).str.upper().str.strip()
-        dff[COLF_PROV] = dff[COLF_PROV].astype(str).str.upper().str.strip()
-        dff[COLF_DIST] = dff[COLF_DIST].astype(str).str.upper().str.strip()
-        dff[COLF_DIV] = dff[COLF_DIV].astype(str).str.upper().str.strip()
-
-        if dpto: dff = dff[dff[COLF_DEPT] == dpto]
-        if prov: dff = dff[dff[COLF_PROV] == prov]
-        if dist: dff = dff[dff[COLF_DIST] == dist]
-        if divi: dff = dff[dff[COLF_DIV] == divi]
+        dff = seleccionar("oficina_zona", *claves, zona)
+        zonas = conteo_zonas("oficina", claves, zona)
 
         total_oficinas = int(len(dff))
         suma_total = float(dff[COLF_TRX].sum()) if total_oficinas > 0 else 0.0
@@ -1097,32 +3432,17 @@ def api_points():
         prom_tkt = float(dff[COLF_TKT].mean()) if total_oficinas > 0 else 0.0
         prom_red = float(dff[COLF_RED].mean()) if total_oficinas > 0 else 0.0
 
-        puntos = []
-        for _, r in dff.iterrows():
-            puntos.append({
-                "lat": float(r[COLF_LAT]),
-                "lon": float(r[COLF_LON]),
-                "atm": str(r.get(COLF_ID, "")),
-                "nombre": str(r.get(COLF_NAME, "")),
-                "promedio": float(r.get(COLF_TRX, 0.0)),
-                "division": str(r.get(COLF_DIV, "")),
-                "tipo": "OFICINA",
-                "ubicacion": "OFICINA",
-                "departamento": str(r.get(COLF_DEPT, "")),
-                "provincia": str(r.get(COLF_PROV, "")),
-                "distrito": str(r.get(COLF_DIST, "")),
-                "direccion": "No disponible (a incorporar)",
-                "capa": "",
-                "estructura_as": float(r.get(COLF_EAS, 0.0)),
-                "estructura_ebp": float(r.get(COLF_EBP, 0.0)),
-                "estructura_ad": float(r.get(COLF_EAD, 0.0)),
-                "clientes_unicos": int(r.get(COLF_CLI, 0)),
-                "total_tickets": int(r.get(COLF_TKT, 0)),
-                "red_lines": float(r.get(COLF_RED, 0.0)),
-            })
+        vista = recortar_vista("oficina", dff, bbox)
+        puntos = registros_oficinas(vista)
+        if con_anillos:
+            for p, a in zip(puntos, campos_anillos(vista)):
+                p["anillos"] = a
 
-        return jsonify({
+        return responder_json({
             "puntos": puntos,
+            "bbox": bbox,
+            "bounds": limites(dff, COLF_LAT, COLF_LON),
+            "total_en_vista": len(puntos),
             "total_atms": total_oficinas,
             "total_oficinas": total_oficinas,
             "total_islas": 0,
@@ -1143,6 +3463,7 @@ def api_points():
             "prom_clientes_unicos": prom_cli,
             "prom_total_tickets": prom_tkt,
             "prom_redlines": prom_red,
+            **zonas,
         })
 
     return jsonify({
@@ -1160,13 +3481,16 @@ def api_points():
         "total_capa_A3": 0,
         "total_capa_B": 0,
         "total_capa_C": 0,
+        "total_rural": 0,
+        "total_urbana": 0,
     })
 
 # ============================================================
-# ENDPOINT DE CLIENTES CON MUESTREO DINÁMICO
+# ENDPOINT DE CLIENTES — DENSIDAD PRECALCULADA (SIN MUESTREO)
 # ============================================================
 @app.route("/api/clientes")
 @login_required
+@respuesta_cacheada
 def api_clientes():
     zoom_str = request.args.get("zoom", "10")
     try:
@@ -1179,15 +3503,15 @@ def api_clientes():
     dist = request.args.get("distrito", "").upper().strip()
     seg = request.args.get("segmento", "").upper().strip()
 
-    dff = df_clientes.copy()
-    if dpto: dff = dff[dff["departamento"].str.upper() == dpto]
-    if prov: dff = dff[dff["provincia"].str.upper() == prov]
-    if dist: dff = dff[dff["distrito"].str.upper() == dist]
-    if seg:  dff = dff[dff["segmento"].astype(str).str.upper() == seg]
+    bbox = parse_bbox(request.args.get("bbox", ""), zoom_str)
 
-    if dff.empty:
+    total = len(seleccionar("cliente", dpto, prov, dist, seg))
+    if total == 0:
         return jsonify([])
 
+    # puntos de referencia por zoom (los tamaños de la antigua muestra):
+    # el peso de cada celda es su conteo escalado a ese total, así la
+    # intensidad del heatmap se mantiene pero ahora cuenta a todos
     if zoom <= 5:
         sample_size = 1000
     elif zoom <= 9:
@@ -1196,110 +3520,69 @@ def api_clientes():
         sample_size = 7000
     else:
         sample_size = 12000
+    escala = min(sample_size, total) / total
 
-    sample_size = min(sample_size, len(dff))
-    df_sample = dff.sample(sample_size, replace=False, random_state=None)
+    lats, lons, cnt = consultar_densidad(zoom, (dpto, prov, dist, seg), bbox)
 
-    puntos = [{"lat": float(r.latitud), "lon": float(r.longitud)} for _, r in df_sample.iterrows()]
-    return jsonify(puntos)
+    puntos = construir_registros({
+        "lat": np.round(lats, 6).tolist(),
+        "lon": np.round(lons, 6).tolist(),
+        "peso": (cnt * escala).tolist(),
+    })
+    return responder_json(puntos)
 
 # ============================================================
 # API — RESUMEN DE CLIENTES VISIBLE SEGÚN FILTROS
 # ============================================================
 @app.route("/api/resumen_clientes")
 @login_required
+@respuesta_cacheada
 def api_resumen_clientes():
     dpto = request.args.get("departamento", "").upper().strip()
     prov = request.args.get("provincia", "").upper().strip()
     dist = request.args.get("distrito", "").upper().strip()
     segmento = request.args.get("segmento", "").upper().strip()
 
-    dff = df_clientes.copy()
-    if dpto: dff = dff[dff["departamento"].str.upper() == dpto]
-    if prov: dff = dff[dff["provincia"].str.upper() == prov]
-    if dist: dff = dff[dff["distrito"].str.upper() == dist]
-    if segmento: dff = dff[dff["segmento"].astype(str).str.upper() == segmento]
+    fila = CUBO_CLIENTES.get((dpto, prov, dist, segmento))
 
-    if dff.empty:
+    if fila is None or fila[CUBO_POS["total"]] == 0:
         return jsonify({
             "total": 0, "digital_pct": 0, "edad_prom": 0,
             "ingreso_prom": 0, "deuda_prom": 0, "top_segmento": "—"
         })
 
-    total = len(dff)
-    digital_pct = round(100 * dff["flag_digital"].mean(), 1) if "flag_digital" in dff.columns else 0
-    edad_prom = round(dff["edad"].mean(), 1) if "edad" in dff.columns else 0
-    ingreso_prom = round(dff["ingresos"].mean(), 2) if "ingresos" in dff.columns else 0
-    deuda_prom = round(dff["deuda"].mean(), 2) if "deuda" in dff.columns else 0
-    top_segmento = dff["segmento"].value_counts().idxmax() if "segmento" in dff.columns else "—"
-
-    return jsonify({
-        "total": total,
-        "digital_pct": digital_pct,
-        "edad_prom": edad_prom,
-        "ingreso_prom": ingreso_prom,
-        "deuda_prom": deuda_prom,
-        "top_segmento": top_segmento
-    })
+    return jsonify(resumen_desde_cubo(fila))
 
 # ============================================================
 # API INTEGRAL /api/points_integral — 3 CAPAS
 # ============================================================
 @app.route("/api/points_integral")
 @login_required
+@respuesta_cacheada
 def api_points_integral():
     dpto = request.args.get("departamento", "").upper().strip()
     prov = request.args.get("provincia", "").upper().strip()
     dist = request.args.get("distrito", "").upper().strip()
     divi = request.args.get("division", "").upper().strip()
+    bbox = parse_bbox(request.args.get("bbox", ""), request.args.get("zoom", ""))
+    # puntos=0: solo conteos y paneles (el mapa dibuja /api/clusters)
+    con_puntos = request.args.get("puntos", "1") != "0"
 
     # ------------ ATMs ------------
-    dfA = df.copy()
-    dfA[COL_DEPT] = dfA[COL_DEPT].astype(str).str.upper().str.strip()
-    dfA[COL_PROV] = dfA[COL_PROV].astype(str).str.upper().str.strip()
-    dfA[COL_DIST] = dfA[COL_DIST].astype(str).str.upper().str.strip()
-    dfA[COL_DIV]  = dfA[COL_DIV].astype(str).str.upper().str.strip()
-    dfA[COL_UBIC] = dfA[COL_UBIC].astype(str).str.upper().str.strip()
-    dfA[COL_TIPO] = dfA[COL_TIPO].astype(str).str.upper().str.strip()
-
-    if dpto: dfA = dfA[dfA[COL_DEPT] == dpto]
-    if prov: dfA = dfA[dfA[COL_PROV] == prov]
-    if dist: dfA = dfA[dfA[COL_DIST] == dist]
-    if divi: dfA = dfA[dfA[COL_DIV] == divi]
-
-    puntos_atm = []
+    dfA = seleccionar("atm", dpto, prov, dist, divi)
+
     suma_atm = float(dfA[PROM_COL].sum())
-    for _, r in dfA.iterrows():
-        lat = float(r[COL_LAT]); lon = float(r[COL_LON])
-        nombre = str(r.get(COL_NAME, r.get(COL_ATM, "")))
-        puntos_atm.append({
-            "tipo_canal": "ATM",
-            "lat": lat, "lon": lon,
-            "atm": str(r.get(COL_ATM, "")),
-            "nombre": nombre,
-            "promedio": float(r.get(PROM_COL, 0.0)),
-            "division": str(r.get(COL_DIV, "")),
-            "tipo": str(r.get(COL_TIPO, "")),
-            "ubicacion": str(r.get(COL_UBIC, "")),
-            "departamento": str(r.get(COL_DEPT, "")),
-            "provincia": str(r.get(COL_PROV, "")),
-            "distrito": str(r.get(COL_DIST, "")),
-            "direccion": get_address(lat, lon),
-        })
+    puntos_atm = registros_atms(recortar_vista("atm", dfA, bbox), integral=True) if con_puntos else []
+
+    # conteos del panel ATM sobre toda la selección (no solo lo visible)
+    atm_oficina = int(dfA[COL_UBIC].str.contains("OFICINA", na=False).sum())
+    atm_disp = int(dfA[COL_TIPO].str.contains("DISPENSADOR", na=False).sum())
+    atm_mon = int(dfA[COL_TIPO].str.contains("MONEDERO", na=False).sum())
+    atm_rec = int(dfA[COL_TIPO].str.contains("RECICLADOR", na=False).sum())
 
     # ------------ OFICINAS ------------
-    dfO = df_oficinas.copy()
-    dfO[COLF_DEPT] = dfO[COLF_DEPT].astype(str).str.upper().str.strip()
-    dfO[COLF_PROV] = dfO[COLF_PROV].astype(str).str.upper().str.strip()
-    dfO[COLF_DIST] = dfO[COLF_DIST].astype(str).str.upper().str.strip()
-    dfO[COLF_DIV]  = dfO[COLF_DIV].astype(str).str.upper().str.strip()
-
-    if dpto: dfO = dfO[dfO[COLF_DEPT] == dpto]
-    if prov: dfO = dfO[dfO[COLF_PROV] == prov]
-    if dist: dfO = dfO[dfO[COLF_DIST] == dist]
-    if divi: dfO = dfO[dfO[COLF_DIV] == divi]
-
-    puntos_of = []
+    dfO = seleccionar("oficina", dpto, prov, dist, divi)
+
     suma_of = float(dfO[COLF_TRX].sum())
 
     total_of = int(len(dfO))
@@ -1310,74 +3593,51 @@ def api_points_integral():
     prom_of_tkt = float(dfO[COLF_TKT].mean()) if total_of > 0 else 0.0
     prom_of_red = float(dfO[COLF_RED].mean()) if total_of > 0 else 0.0
 
-    for _, r in dfO.iterrows():
-        puntos_of.append({
-            "tipo_canal": "OFICINA",
-            "lat": float(r[COLF_LAT]),
-            "lon": float(r[COLF_LON]),
-            "atm": str(r.get(COLF_ID, "")),
-            "nombre": str(r.get(COLF_NAME, "")),
-            "promedio": float(r.get(COLF_TRX, 0.0)),
-            "division": str(r.get(COLF_DIV, "")),
-            "tipo": "OFICINA",
-            "ubicacion": "OFICINA",
-            "departamento": str(r.get(COLF_DEPT, "")),
-            "provincia": str(r.get(COLF_PROV, "")),
-            "distrito": str(r.get(COLF_DIST, "")),
-            "direccion": "No disponible (a incorporar)",
-            "estructura_as": float(r.get(COLF_EAS, 0.0)),
-            "estructura_ebp": float(r.get(COLF_EBP, 0.0)),
-            "estructura_ad": float(r.get(COLF_EAD, 0.0)),
-            "clientes_unicos": int(r.get(COLF_CLI, 0)),
-            "total_tickets": int(r.get(COLF_TKT, 0)),
-            "red_lines": float(r.get(COLF_RED, 0.0)),
-        })
+    puntos_of = registros_oficinas(recortar_vista("oficina", dfO, bbox), integral=True) if con_puntos else []
 
     # ------------ AGENTES ------------
-    dfG = df_agentes.copy()
-    dfG[COLA_DEPT] = dfG[COLA_DEPT].astype(str).str.upper().str.strip()
-    dfG[COLA_PROV] = dfG[COLA_PROV].astype(str).str.upper().str.strip()
-    dfG[COLA_DIST] = dfG[COLA_DIST].astype(str).str.upper().str.strip()
-    dfG[COLA_DIV]  = dfG[COLA_DIV].astype(str).str.upper().str.strip()
-    dfG[COLA_CAPA] = dfG[COLA_CAPA].astype(str).str.upper().str.strip()
-
-    if dpto: dfG = dfG[dfG[COLA_DEPT] == dpto]
-    if prov: dfG = dfG[dfG[COLA_PROV] == prov]
-    if dist: dfG = dfG[dfG[COLA_DIST] == dist]
-    if divi: dfG = dfG[dfG[COLA_DIV] == divi]
-
-    puntos_ag = []
+    dfG = seleccionar("agente", dpto, prov, dist, divi)
+
     suma_ag = float(dfG[PROMA_COL].sum())
-    for _, r in dfG.iterrows():
-        puntos_ag.append({
-            "tipo_canal": "AGENTE",
-            "lat": float(r[COLA_LAT]),
-            "lon": float(r[COLA_LON]),
-            "atm": str(r.get(COLA_ID, "")),
-            "nombre": str(r.get(COLA_COM, "")),
-            "promedio": float(r.get(PROMA_COL, 0.0)),
-            "division": str(r.get(COLA_DIV, "")),
-            "tipo": "AGENTE",
-            "ubicacion": "AGENTE",
-            "departamento": str(r.get(COLA_DEPT, "")),
-            "provincia": str(r.get(COLA_PROV, "")),
-            "distrito": str(r.get(COLA_DIST, "")),
-            "direccion": str(r.get(COLA_DIR, "")),
-            "capa": str(r.get(COLA_CAPA, "")),
-            "trxs_oct": float(r.get(COLA_TRX_OCT, 0.0)) if COLA_TRX_OCT else 0.0,
-            "trxs_nov": float(r.get(COLA_TRX_NOV, 0.0)) if COLA_TRX_NOV else 0.0,
-        })
+    puntos_ag = registros_agentes(recortar_vista("agente", dfG, bbox), integral=True) if con_puntos else []
+    capa_ag = dfG[COLA_CAPA]
+
+    bounds = [b for b in (
+        limites(dfA, COL_LAT, COL_LON),
+        limites(dfO, COLF_LAT, COLF_LON),
+        limites(dfG, COLA_LAT, COLA_LON),
+    ) if b]
+    if bounds:
+        bounds = [
+            [min(b[0][0] for b in bounds), min(b[0][1] for b in bounds)],
+            [max(b[1][0] for b in bounds), max(b[1][1] for b in bounds)],
+        ]
+    else:
+        bounds = None
 
-    return jsonify({
+    return responder_json({
         "atms": puntos_atm,
         "oficinas": puntos_of,
         "agentes": puntos_ag,
+        "bbox": bbox,
+        "bounds": bounds,
         "suma_atms": suma_atm,
         "suma_oficinas": suma_of,
         "suma_agentes": suma_ag,
-        "total_atms": len(puntos_atm),
-        "total_oficinas": len(puntos_of),
-        "total_agentes": len(puntos_ag),
+        "total_atms": int(len(dfA)),
+        "total_oficinas": int(len(dfO)),
+        "total_agentes": int(len(dfG)),
+
+        "atm_en_oficina": atm_oficina,
+        "atm_en_isla": int(len(dfA)) - atm_oficina,
+        "atm_disp": atm_disp,
+        "atm_mon": atm_mon,
+        "atm_rec": atm_rec,
+        "ag_capa_A1": int((capa_ag == "A1").sum()),
+        "ag_capa_A2": int((capa_ag == "A2").sum()),
+        "ag_capa_A3": int((capa_ag == "A3").sum()),
+        "ag_capa_B": int((capa_ag == "B").sum()),
+        "ag_capa_C": int((capa_ag == "C").sum()),
 
         "prom_ofi_estructura_as": prom_of_eas,
         "prom_ofi_estructura_ebp": prom_of_ebp,
@@ -1387,6 +3647,420 @@ def api_points_integral():
         "prom_ofi_redlines": prom_of_red,
     })
 
+# ============================================================
+# API /api/clusters — CLÚSTERES POR ZOOM Y TILE ✅
+#   - capas=atm,agente,oficina,nodo (por defecto todas)
+#   - tile z/x/y  o  bbox=oeste,sur,este,norte&zoom=z
+#   - mismos filtros departamento/provincia/distrito/division
+# ============================================================
+@app.route("/api/clusters")
+@login_required
+@respuesta_cacheada
+def api_clusters():
+    dpto = request.args.get("departamento", "").upper().strip()
+    prov = request.args.get("provincia", "").upper().strip()
+    dist = request.args.get("distrito", "").upper().strip()
+    divi = request.args.get("division", "").upper().strip()
+    capas = [c for c in request.args.get("capas", "atm,agente,oficina,nodo").lower().split(",") if c in CLUSTERS]
+
+    try:
+        if request.args.get("x", "") != "":
+            z = int(request.args.get("z", ""))
+            bbox = tile_bbox(z, int(request.args.get("x")), int(request.args.get("y", "")))
+        else:
+            z = int(float(request.args.get("zoom", "")))
+            bbox = parse_bbox(request.args.get("bbox", ""), str(z)) or (-180.0, -85.0, 180.0, 85.0)
+    except Exception:
+        return jsonify({"error": "parámetros de tile/bbox inválidos"}), 400
+    z = min(max(z, 0), CLUSTER_ZMAX)
+
+    campos = {k: [] for k in ("capa", "lat", "lon", "n", "suma_promedio", "bounds")}
+    totales = {}
+    for capa in capas:
+        frame = INDICE_GEO[capa][0]
+        claves = (dpto, prov, dist) if capa == "nodo" else (dpto, prov, dist, divi)
+        sel = seleccionar(capa, *claves)
+        if sel is frame:
+            nivel = CLUSTERS[capa].get(z)
+        elif len(sel):
+            nivel = _nivel_desde_puntos(*_cluster_columnas(sel, capa), z, CLUSTER_CELDAS_TILE)
+        else:
+            nivel = None
+
+        if nivel is None:
+            totales[capa] = 0
+            continue
+        i = consultar_clusters(nivel, bbox)
+        n = nivel["n"][i]
+        totales[capa] = int(n.sum())
+
+        campos["capa"] += [capa] * len(i)
+        campos["lat"] += (nivel["slat"][i] / n).tolist()
+        campos["lon"] += (nivel["slon"][i] / n).tolist()
+        campos["n"] += n.tolist()
+        campos["suma_promedio"] += nivel["sprom"][i].tolist()
+        campos["bounds"] += [[[s, w], [no, e]] for s, w, no, e in zip(
+            nivel["s"][i].tolist(), nivel["w"][i].tolist(), nivel["no"][i].tolist(), nivel["e"][i].tolist())]
+
+    return responder_json({
+        "z": z,
+        "bbox": [round(v, 6) for v in bbox],
+        "totales": totales,
+        "clusters": construir_registros(campos),
+    })
+
+# ============================================================
+# API /api/division_border — BORDE NEÓN DE LA SELECCIÓN ✅
+#   - capas=atm,agente,oficina (por defecto todas)
+#   - mismos filtros departamento/provincia/distrito/division
+# ============================================================
+@app.route("/api/division_border")
+@login_required
+@respuesta_cacheada
+def api_division_border():
+    dpto = request.args.get("departamento", "").upper().strip()
+    prov = request.args.get("provincia", "").upper().strip()
+    dist = request.args.get("distrito", "").upper().strip()
+    divi = request.args.get("division", "").upper().strip()
+    capas = [c for c in request.args.get("capas", "atm,agente,oficina").lower().split(",") if c in BORDES_DIVISION]
+
+    return responder_json({"capas": capas, "poly": borde_division((dpto, prov, dist, divi), capas)})
+
+# ============================================================
+# API /api/cobertura — DISTANCIA AL CANAL MÁS CERCANO ✅
+#   - canales=atm,agente,oficina (por defecto todos): distancia al más
+#     cercano de esos canales (en toda la red, no solo en el filtro)
+#   - radios_km=1,2,5: % de clientes / nodos a esa distancia o menos
+#   - filtros departamento/provincia/distrito (+ segmento para clientes)
+# ============================================================
+@app.route("/api/cobertura")
+@login_required
+@respuesta_cacheada
+def api_cobertura():
+    dpto = request.args.get("departamento", "").upper().strip()
+    prov = request.args.get("provincia", "").upper().strip()
+    dist = request.args.get("distrito", "").upper().strip()
+    seg = request.args.get("segmento", "").upper().strip()
+    canales = [c for c in request.args.get("canales", "atm,agente,oficina").lower().split(",") if c in COBERTURA_CANALES]
+    try:
+        radios = [float(r) for r in request.args.get("radios_km", "1,2,5").split(",") if r.strip()]
+    except ValueError:
+        return jsonify({"error": "radios_km inválido"}), 400
+
+    return responder_json({
+        "canales": canales,
+        "clientes": resumen_cobertura(seleccionar("cliente", dpto, prov, dist, seg), canales, radios),
+        "nodos": resumen_cobertura(seleccionar("nodo", dpto, prov, dist), canales, radios),
+    })
+
+# ============================================================
+# API /api/catchment — ÁREA DE INFLUENCIA DE CADA CANAL ✅
+#   - canal=atm|agente|oficina + filtros departamento/provincia/
+#     distrito/division
+#   - por punto: clientes atribuidos, perfil (3G) y polígono de Voronoi
+#   - poligonos=0 omite los polígonos; se omiten también si la selección
+#     pasa de CATCHMENT_MAX_POLIGONOS puntos
+# ============================================================
+@app.route("/api/catchment")
+@login_required
+@respuesta_cacheada
+def api_catchment():
+    canal = request.args.get("canal", "atm").lower().strip()
+    if canal not in COBERTURA_CANALES:
+        return jsonify({"error": "canal inválido (atm, agente u oficina)"}), 400
+    dpto = request.args.get("departamento", "").upper().strip()
+    prov = request.args.get("provincia", "").upper().strip()
+    dist = request.args.get("distrito", "").upper().strip()
+    divi = request.args.get("division", "").upper().strip()
+
+    pos = posiciones_geo(canal, dpto, prov, dist, divi)
+    pos = np.zeros(0, dtype=np.int32) if pos is None else pos
+    frame, clat, clon = COBERTURA_CANALES[canal]
+    dff = frame.take(pos)
+    col_id, col_nombre = CATCHMENT_CAMPOS[canal]
+    con_poligonos = request.args.get("poligonos", "1") != "0" and len(pos) <= CATCHMENT_MAX_POLIGONOS
+
+    canales = []
+    for p, cid, nombre, lat, lon in zip(pos.tolist(), _col_str(dff, col_id), _col_str(dff, col_nombre),
+                                        dff[clat].tolist(), dff[clon].tolist()):
+        perfil = perfil_catchment(canal, p)
+        item = {"pos": p, "id": cid, "nombre": nombre or cid, "lat": lat, "lon": lon,
+                "clientes": perfil.pop("total"), **perfil}
+        if con_poligonos:
+            item["poly"] = poligono_canal(canal, p)
+        canales.append(item)
+
+    return responder_json({
+        "canal": canal,
+        "total": len(canales),
+        "clientes": int(sum(c["clientes"] for c in canales)),
+        "poligonos": con_poligonos,
+        "canales": canales,
+    })
+
+# ============================================================
+# API /api/anillos — CÍRCULOS DE 500 m / 1 km / 3 km DE UN CANAL ✅
+#   ?canal=atm|agente|oficina&id=<código del punto>
+#   - conteos de la tabla precalculada (3O), círculos armados al vuelo
+# ============================================================
+@app.route("/api/anillos")
+@login_required
+@respuesta_cacheada
+def api_anillos():
+    canal = request.args.get("canal", "atm").lower().strip()
+    if canal not in COBERTURA_CANALES:
+        return jsonify({"error": "canal inválido (atm, agente u oficina)"}), 400
+    pid = request.args.get("id", "").strip()
+    pos = ANILLOS_ID_POS[canal].get(pid)
+    if pos is None:
+        return jsonify({"error": f"no existe {canal} con id {pid!r}"}), 404
+
+    frame, clat, clon = COBERTURA_CANALES[canal]
+    fila = frame.iloc[pos]
+    lat, lon = float(fila[clat]), float(fila[clon])
+    return responder_json({
+        "canal": canal,
+        "id": pid,
+        "lat": lat,
+        "lon": lon,
+        "anillos": [
+            {
+                "radio_m": r,
+                **{capa: int(fila[f"{prefijo}_{r}"]) for capa, (prefijo, _, _) in ANILLOS_CAPAS.items()},
+                "poly": circulo(lat, lon, r),
+            }
+            for r in ANILLOS_RADIOS_M
+        ],
+    })
+
+# ============================================================
+# API /api/simular — QUÉ PASA SI (AGREGAR / QUITAR CANALES) ✅
+#   ?agregar=atm,-9.93,-76.24;agente,...&quitar=oficina,-9.92,-76.23
+#   + mismos filtros, canales y radios_km que /api/cobertura
+# ============================================================
+@app.route("/api/simular")
+@login_required
+@respuesta_cacheada
+def api_simular():
+    dpto = request.args.get("departamento", "").upper().strip()
+    prov = request.args.get("provincia", "").upper().strip()
+    dist = request.args.get("distrito", "").upper().strip()
+    seg = request.args.get("segmento", "").upper().strip()
+    canales = [c for c in request.args.get("canales", "atm,agente,oficina").lower().split(",") if c in COBERTURA_CANALES]
+    try:
+        radios = [float(r) for r in request.args.get("radios_km", "1,2,5").split(",") if r.strip()]
+        agregar = puntos_param(request.args.get("agregar", ""))
+        quitar = puntos_param(request.args.get("quitar", ""))
+    except ValueError as e:
+        return jsonify({"error": f"parámetro inválido: {e}"}), 400
+    if len(agregar) + len(quitar) > SIM_MAX_PUNTOS:
+        return jsonify({"error": f"máximo {SIM_MAX_PUNTOS} puntos por simulación"}), 400
+
+    cambios, no_encontrados = simular_canales(agregar, quitar)
+    pos = posiciones_geo("cliente", dpto, prov, dist, seg)
+    pos = np.zeros(0, dtype=np.int64) if pos is None else pos
+    antes, despues, por_canal = cobertura_simulada(pos, canales, cambios)
+
+    if canales:
+        res_antes, res_despues = resumen_distancias(antes, radios), resumen_distancias(despues, radios)
+    else:
+        res_antes = res_despues = _resumen_vacio(len(pos), radios)
+    return responder_json({
+        "canales": canales,
+        "agregados": len(agregar),
+        "quitados": len(quitar) - len(no_encontrados),
+        "no_encontrados": no_encontrados,
+        "afectados": {
+            "total": int(np.count_nonzero(despues != antes)),
+            "mas_cerca": int(np.count_nonzero(despues < antes)),
+            "mas_lejos": int(np.count_nonzero(despues > antes)),
+            "por_canal": por_canal,
+        },
+        "antes": res_antes,
+        "despues": res_despues,
+        "delta": {
+            "promedio_km": round(res_despues["promedio_km"] - res_antes["promedio_km"], 3),
+            "dentro": {r: round(res_despues["dentro"][r] - res_antes["dentro"][r], 2) for r in res_antes["dentro"]},
+        },
+    })
+
+# ============================================================
+# API /tiles/<capa>/<z>/<x>/<y>.pbf — VECTOR TILES (MVT) ✅
+#   - Mapbox Vector Tile v2 de puntos, codificado a mano (protobuf)
+#   - Cada capa lleva solo un subconjunto de atributos
+#   - Tiles en disco bajo TILES_DIR/<versión de la data>/..., así un
+#     cambio de Excel/CSV nunca sirve tiles viejos
+#   - Solo se guardan tiles con puntos y hasta TILES_DISCO_ZMAX: los vacíos
+#     y los de zoom alto son baratos de generar y su número crece 4x por nivel
+# ============================================================
+TILES_DIR = os.getenv("TILES_DIR", os.path.join("data", ".tiles"))
+TILES_DISCO_ZMAX = int(os.getenv("TILES_DISCO_ZMAX", "14"))
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+TILE_ZMAX = 22
+
+TILE_CAPAS = {
+    "atm": {"frame": df, "lat": COL_LAT, "lon": COL_LON, "zmin": 0, "atributos": {
+        "atm": lambda d: _col_str(d, COL_ATM),
+        "nombre": lambda d: _col_str(d, COL_NAME),
+        "promedio": lambda d: _col_float(d, PROM_COL),
+        "tipo": lambda d: _col_str(d, COL_TIPO),
+        "ubicacion": lambda d: _col_str(d, COL_UBIC),
+        "division": lambda d: _col_str(d, COL_DIV),
+    }},
+    "agente": {"frame": df_agentes, "lat": COLA_LAT, "lon": COLA_LON, "zmin": 0, "atributos": {
+        "atm": lambda d: _col_str(d, COLA_ID),
+        "nombre": lambda d: _col_str(d, COLA_COM),
+        "promedio": lambda d: _col_float(d, PROMA_COL),
+        "capa": lambda d: _col_str(d, COLA_CAPA),
+        "division": lambda d: _col_str(d, COLA_DIV),
+    }},
+    "oficina": {"frame": df_oficinas, "lat": COLF_LAT, "lon": COLF_LON, "zmin": 0, "atributos": {
+        "atm": lambda d: _col_str(d, COLF_ID),
+        "nombre": lambda d: _col_str(d, COLF_NAME),
+        "promedio": lambda d: _col_float(d, COLF_TRX),
+        "division": lambda d: _col_str(d, COLF_DIV),
+    }},
+    "nodo": {"frame": df_nodos, "lat": "LATITUD", "lon": "LONGITUD", "zmin": 0, "atributos": {
+        "nombre": lambda d: [n.strip() for n in _col_str(d, "NOMBRE")],
+        "categoria": lambda d: _col_str(d, "CATEGORIA"),
+    }},
+    # clientes solo de cerca: en zoom bajo se usa el heatmap
+    "cliente": {"frame": df_clientes, "lat": "latitud", "lon": "longitud", "zmin": 12, "atributos": {
+        "segmento": lambda d: _col_str(d, "segmento"),
+    }},
+}
+
+def _pb_varint(buf, v):
+    while v > 0x7F:
+        buf.append((v & 0x7F) | 0x80)
+        v >>= 7
+    buf.append(v)
+
+def _pb_bytes(buf, campo, data):
+    _pb_varint(buf, (campo << 3) | 2)
+    _pb_varint(buf, len(data))
+    buf += data
+
+def _pb_empaquetado(buf, campo, valores):
+    sub = bytearray()
+    for v in valores:
+        _pb_varint(sub, v)
+    _pb_bytes(buf, campo, sub)
+
+def _zigzag(v):
+    return (v << 1) ^ (v >> 63)
+
+def _mvt_valor(v):
+    b = bytearray()
+    if isinstance(v, str):
+        _pb_bytes(b, 1, v.encode("utf-8"))
+    elif isinstance(v, (int, np.integer)):
+        _pb_varint(b, (6 << 3) | 0)
+        _pb_varint(b, _zigzag(int(v)))
+    else:
+        _pb_varint(b, (3 << 3) | 1)
+        b += struct.pack("<d", float(v))
+    return bytes(b)
+
+def codificar_capa_mvt(nombre, xs, ys, ids, atributos):
+    """
+    Layer MVT de puntos. xs/ys en coordenadas del tile (0..TILE_EXTENT),
+    atributos = {clave: lista por feature}; "" y NaN se omiten.
+    """
+    claves = list(atributos.keys())
+    columnas = [atributos[k] for k in claves]
+    valores = {}
+
+    layer = bytearray()
+    _pb_varint(layer, (15 << 3) | 0)
+    _pb_varint(layer, 2)
+    _pb_bytes(layer, 1, nombre.encode("utf-8"))
+    for i, (x, y, fid) in enumerate(zip(xs, ys, ids)):
+        tags = []
+        for k, col in enumerate(columnas):
+            v = col[i]
+            if v == "" or v is None or v != v:
+                continue
+            tags += (k, valores.setdefault(_mvt_valor(v), len(valores)))
+        f = bytearray()
+        _pb_varint(f, (1 << 3) | 0)
+        _pb_varint(f, fid)
+        _pb_empaquetado(f, 2, tags)
+        _pb_varint(f, (3 << 3) | 0)
+        _pb_varint(f, 1)  # POINT
+        _pb_empaquetado(f, 4, [(1 << 3) | 1, _zigzag(x), _zigzag(y)])  # MoveTo(1)
+        _pb_bytes(layer, 2, f)
+    for k in claves:
+        _pb_bytes(layer, 3, k.encode("utf-8"))
+    for v in valores:
+        _pb_bytes(layer, 4, v)
+    _pb_varint(layer, (5 << 3) | 0)
+    _pb_varint(layer, TILE_EXTENT)
+    return bytes(layer)
+
+def generar_tile(capa, z, x, y):
+    """
+    (cuerpo MVT, cantidad de puntos) del tile.
+    """
+    cfg = TILE_CAPAS[capa]
+    pos = np.empty(0, dtype=np.int32)
+    if z >= cfg["zmin"] and cfg["frame"] is not None:
+        f = TILE_BUFFER / TILE_EXTENT
+        w, _, _, n = tile_bbox(z, x - f, y - f)
+        _, s, e, _ = tile_bbox(z, x + f, y + f)
+        pos = consultar_grilla(GRILLAS[capa], (w, s, e, n))
+
+    sub = cfg["frame"].iloc[pos] if len(pos) else cfg["frame"].iloc[0:0]
+    mx, my = _mercator_xy(sub[cfg["lat"]].to_numpy(dtype=float), sub[cfg["lon"]].to_numpy(dtype=float))
+    xs = np.round((mx * 2 ** z - x) * TILE_EXTENT).astype(np.int64).tolist()
+    ys = np.round((my * 2 ** z - y) * TILE_EXTENT).astype(np.int64).tolist()
+    atributos = {k: fn(sub) for k, fn in cfg["atributos"].items()}
+
+    tile = bytearray()
+    _pb_bytes(tile, 3, codificar_capa_mvt(capa, xs, ys, pos.tolist(), atributos))
+    return bytes(tile), len(pos)
+
+def _limpiar_tiles_viejos():
+    if not os.path.isdir(TILES_DIR):
+        return
+    for d in os.listdir(TILES_DIR):
+        if d != DATA_VERSION:
+            shutil.rmtree(os.path.join(TILES_DIR, d), ignore_errors=True)
+
+_limpiar_tiles_viejos()
+
+@app.route("/tiles/<capa>/<int:z>/<int:x>/<int:y>.pbf")
+@login_required
+def tiles_mvt(capa, z, x, y):
+    if capa not in TILE_CAPAS or z > TILE_ZMAX or x >= 2 ** z or y >= 2 ** z:
+        return "No existe ese tile", 404
+
+    path = os.path.join(TILES_DIR, DATA_VERSION, capa, str(z), str(x), f"{y}.pbf")
+    if os.path.exists(path):
+        with open(path, "rb") as fh:
+            body = fh.read()
+        estado = "HIT"
+    else:
+        body, n_puntos = generar_tile(capa, z, x, y)
+        estado = "MISS"
+
+        def escribir(tmp):
+            with open(tmp, "wb") as fh:
+                fh.write(body)
+        if n_puntos and z <= TILES_DISCO_ZMAX:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _escribir_atomico(path, escribir)
+            except OSError as e:
+                print(f"⚠ No se pudo guardar el tile {path}: {e}")
+
+    resp = app.response_class(body, mimetype="application/vnd.mapbox-vector-tile")
+    resp.headers["X-Cache"] = estado
+    resp.set_etag(f"{DATA_VERSION}-{capa}-{z}-{x}-{y}")
+    resp.last_modified = DATA_LAST_MODIFIED
+    return resp.make_conditional(request)
+
 # ============================================================
 # 8. TEMPLATE MAPA — FRONTEND COMPLETO
 # ✅ + NODOS: icono rojo y popup con globo (no muestra rectángulos “siempre”)
@@ -1563,6 +4237,28 @@ TEMPLATE_MAPA = """\
       border-top:14px solid #ff2a2a;
       filter: drop-shadow(0 0 12px rgba(255,0,0,0.95));
     }
+    .nodo-balloon .nodo-dir{
+      margin-top:4px;
+      font-weight:600;
+      font-size:11px;
+    }
+
+    /* Clúster del servidor (/api/clusters) en la vista integral */
+    .srv-cluster{
+      border-radius:50%;
+      border:2px solid rgba(255,255,255,0.9);
+      color:#fff;
+      display:flex;
+      align-items:center;
+      justify-content:center;
+      font-weight:800;
+      font-size:12px;
+      box-shadow: 0 0 10px rgba(0,0,0,0.35);
+      text-shadow: 0 1px 2px rgba(0,0,0,0.55);
+    }
+    .srv-cluster.atm{ background:rgba(30,108,255,0.85); }
+    .srv-cluster.oficina{ background:rgba(0,160,90,0.85); }
+    .srv-cluster.agente{ background:rgba(255,140,0,0.88); }
 
     /* Cluster rojo para comercial */
     .nodo-cluster{
@@ -1903,7 +4599,10 @@ TEMPLATE_MAPA = """\
     const markersReco = L.layerGroup();
     const heatClientes = L.heatLayer([], { radius: 7, blur: 6, maxZoom: 18, minOpacity: 0.04 });
 
+    const clustersLayer = L.layerGroup();
+
     markers.addTo(map);
+    clustersLayer.addTo(map);
     heat.addTo(map);
 
     const selDep = document.getElementById("selDepartamento");
@@ -1974,8 +4673,9 @@ TEMPLATE_MAPA = """\
       });
     }
 
-    function nodoBalloonHtml(nombre){
-      return `<div class="nodo-balloon">${escHtml(nombre)}</div>`;
+    function nodoBalloonHtml(nombre, direccion, aprox){
+      const dir = direccion ? `<div class="nodo-dir">${escHtml(direccion)}${aprox ? " (aprox.)" : ""}</div>` : "";
+      return `<div class="nodo-balloon">${escHtml(nombre)}${dir}</div>`;
     }
 
     function syncComercialVisibility(){
@@ -2053,7 +4753,7 @@ TEMPLATE_MAPA = """\
         arr.forEach(n=>{
           const m = L.marker([n.lat, n.lon], { icon: nodoPinIcon(), zIndexOffset: 5000 });
           // popup con globo “como antes”, pero solo cuando haces click
-          m.bindPopup(nodoBalloonHtml(n.nombre), {
+          m.bindPopup(nodoBalloonHtml(n.nombre, n.direccion, n.direccion_aprox), {
             className: "nodo-popup",
             closeButton: false,
             autoPan: true,
@@ -2077,38 +4777,6 @@ TEMPLATE_MAPA = """\
         divisionBorderLayer = null;
       }
     }
-    function convexHullLatLng(latlngs){
-      if(!latlngs || latlngs.length <= 2) return latlngs || [];
-      const uniq = new Map();
-      latlngs.forEach(ll=>{
-        const k = ll.lat.toFixed(6) + "," + ll.lng.toFixed(6);
-        uniq.set(k, ll);
-      });
-      const pts = Array.from(uniq.values()).map(ll => ({x: ll.lng, y: ll.lat}));
-      if(pts.length <= 2) return pts.map(p => L.latLng(p.y, p.x));
-      pts.sort((a,b) => (a.x === b.x) ? (a.y - b.y) : (a.x - b.x));
-      const cross = (o,a,b) => (a.x - o.x)*(b.y - o.y) - (a.y - o.y)*(b.x - o.x);
-      const lower = [];
-      for(const p of pts){
-        while(lower.length >= 2 && cross(lower[lower.length-2], lower[lower.length-1], p) <= 0) lower.pop();
-        lower.push(p);
-      }
-      const upper = [];
-      for(let i=pts.length-1; i>=0; i--){
-        const p = pts[i];
-        while(upper.length >= 2 && cross(upper[upper.length-2], upper[upper.length-1], p) <= 0) upper.pop();
-        upper.push(p);
-      }
-      upper.pop(); lower.pop();
-      const hull = lower.concat(upper);
-      return hull.map(p => L.latLng(p.y, p.x));
-    }
-    function rectFromLatLngs(latlngs){
-      const b = L.latLngBounds(latlngs);
-      const sw = b.getSouthWest();
-      const ne = b.getNorthEast();
-      return [ sw, L.latLng(sw.lat, ne.lng), ne, L.latLng(ne.lat, sw.lng) ];
-    }
     function drawDivisionBorder(latlngs){
       clearDivisionBorder();
       if(!latlngs || latlngs.length === 0) return;
@@ -2123,20 +4791,20 @@ TEMPLATE_MAPA = """\
       divisionBorderLayer = L.layerGroup([glow, main]).addTo(map);
       try { glow.bringToFront(); main.bringToFront(); } catch(e){}
     }
-    function updateDivisionBorderFromPoints(latlngs){
+    // borde precalculado en backend (/api/division_border) para las capas visibles
+    let _bordeSeq = 0;
+    async function fetchDivisionBorder(capas){
+      const seq = ++_bordeSeq;
       const dv = (selDiv && selDiv.value) ? String(selDiv.value).trim() : "";
-      if(!dv){ clearDivisionBorder(); return; }
-      if(!latlngs || latlngs.length === 0){ clearDivisionBorder(); return; }
-      let outline = [];
-      if(latlngs.length < 3){
-        outline = rectFromLatLngs(latlngs);
-      }else{
-        outline = convexHullLatLng(latlngs);
-        if(!outline || outline.length < 3){
-          outline = rectFromLatLngs(latlngs);
-        }
+      if(!dv || !capas){ clearDivisionBorder(); return; }
+      const qs = `departamento=${encodeURIComponent(selDep.value)}&provincia=${encodeURIComponent(selProv.value)}&distrito=${encodeURIComponent(selDist.value)}&division=${encodeURIComponent(dv)}&capas=${capas}`;
+      try{
+        const js = await (await fetch(`/api/division_border?${qs}`)).json();
+        if(seq !== _bordeSeq) return;
+        drawDivisionBorder(js.poly || []);
+      }catch(err){
+        console.error("Error cargando borde de división:", err);
       }
-      drawDivisionBorder(outline);
     }
 
     // ======================================================
@@ -2152,8 +4820,10 @@ TEMPLATE_MAPA = """\
       if(zonaUrbanLayer){ try{ map.removeLayer(zonaUrbanLayer); }catch(e){} zonaUrbanLayer=null; }
     }
 
-    function drawZona(polyLatLng, color, className){
-      if(!polyLatLng || polyLatLng.length < 3) return null;
+    // anillos: [[ [lat, lon], ... ], ...] (contorno cóncavo, puede tener varias partes)
+    function drawZona(anillos, color, className){
+      if(!anillos || !anillos.length) return null;
+      const polyLatLng = anillos;
 
       const glow = L.polygon(polyLatLng, {
         pane: "zonesPane",
@@ -2176,6 +4846,14 @@ TEMPLATE_MAPA = """\
       return grp;
     }
 
+    // nivel de simplificación que devolvió /api/zonas (se pide otro al cruzar de nivel)
+    let zonasNivel = null;
+    let zonasNiveles = [];
+    function nivelZonasPara(z){
+      const elegibles = zonasNiveles.filter(n => n <= z);
+      return elegibles.length ? elegibles[elegibles.length - 1] : zonasNiveles[0];
+    }
+
     async function fetchZonasBorders(){
       const showR = (chkZonaRural && chkZonaRural.checked);
       const showU = (chkZonaUrbana && chkZonaUrbana.checked);
@@ -2193,8 +4871,10 @@ TEMPLATE_MAPA = """\
       try{
         const d = selDep.value, p = selProv.value, di = selDist.value;
         const qs = `departamento=${encodeURIComponent(d)}&provincia=${encodeURIComponent(p)}&distrito=${encodeURIComponent(di)}`;
-        const res = await fetch(`/api/zonas?${qs}`);
+        const res = await fetch(`/api/zonas?${qs}&zoom=${map.getZoom()}`);
         const js = await res.json();
+        zonasNivel = js.nivel;
+        zonasNiveles = js.niveles || [];
 
         const rural = js.rural || {};
         const urbano = js.urbano || {};
@@ -2204,11 +4884,11 @@ TEMPLATE_MAPA = """\
 
         if(showR){
           clearZonaRural();
-          zonaRuralLayer = drawZona(rural.poly || [], "#00FF66", "zone-neon-rural");
+          zonaRuralLayer = drawZona(rural.anillos || [], "#00FF66", "zone-neon-rural");
         }
         if(showU){
           clearZonaUrban();
-          zonaUrbanLayer = drawZona(urbano.poly || [], "#D6FF00", "zone-neon-urban");
+          zonaUrbanLayer = drawZona(urbano.anillos || [], "#D6FF00", "zone-neon-urban");
         }
       }catch(err){
         console.error("Error cargando zonas:", err);
@@ -2302,6 +4982,7 @@ TEMPLATE_MAPA = """\
 `___________ RECOMENDACIÓN ___________
 Canal sugerido: ${String(r.canal||"").toUpperCase()}
 Clientes afectados: ${r.clientes_afectados}
+Distancia al canal actual: ${Number(r.dist_canal_km||0).toFixed(2)} km
 Departamento: ${r.departamento}
 Provincia: ${r.provincia}
 Distrito: ${r.distrito}
@@ -2321,6 +5002,11 @@ _____________________________________`;
 
     function showATMPanel(pt){
       const lineaUbic = `${pt.departamento} / ${pt.provincia} / ${pt.distrito}`;
+      const direccion = `${pt.direccion}${pt.direccion_aprox ? " (aprox.)" : ""}`;
+      const anillo = (conteos) => Object.entries(conteos || {}).map(([r, n]) => `${r} m: ${n}`).join(" · ");
+      const lineaAnillos = pt.anillos
+        ? `\n• Clientes cerca: ${anillo(pt.anillos.clientes)}\n• Nodos cerca: ${anillo(pt.anillos.nodos)}`
+        : "";
       let texto = "";
       if(TIPO_MAPA === "integral"){
         const canal = (pt.tipo_canal || "").toUpperCase();
@@ -2328,12 +5014,12 @@ _____________________________________`;
           texto =
 `_____________________ AGENTE ${pt.atm} _____________________
 • Comercio: ${pt.nombre}
-• Dirección: ${pt.direccion}
+• Dirección: ${direccion}
 • División: ${pt.division}
 • Capa: ${pt.capa || ""}
 • Tipo: ${pt.tipo}
 • Ubicación: ${pt.ubicacion}
-• Ubicación Geográfica: ${lineaUbic}
+• Ubicación Geográfica: ${lineaUbic}${lineaAnillos}
 • Trxs Octubre: ${pt.trxs_oct ?? 0}
 • Trxs Noviembre: ${pt.trxs_nov ?? 0}
 _____________________ Promedio: ${pt.promedio} _____________________`;
@@ -2341,9 +5027,9 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
           texto =
 `_____________________ OFICINA ${pt.atm} _____________________
 • Nombre: ${pt.nombre}
-• Dirección: ${pt.direccion}
+• Dirección: ${direccion}
 • División: ${pt.division}
-• Ubicación Geográfica: ${lineaUbic}
+• Ubicación Geográfica: ${lineaUbic}${lineaAnillos}
 
 ——— Métricas de la Oficina ———
 • TRX: ${pt.promedio}
@@ -2358,23 +5044,23 @@ _________________________________________`;
           texto =
 `_____________________ ATM ${pt.atm} _____________________
 • Nombre: ${pt.nombre}
-• Dirección: ${pt.direccion}
+• Dirección: ${direccion}
 • División: ${pt.division}
 • Tipo: ${pt.tipo}
 • Ubicación: ${pt.ubicacion}
-• Ubicación Geográfica: ${lineaUbic}
+• Ubicación Geográfica: ${lineaUbic}${lineaAnillos}
 _____________________ Promedio: ${pt.promedio} _____________________`;
         }
       } else if(TIPO_MAPA === "agentes"){
         texto =
 `_____________________ AGENTE ${pt.atm} _____________________
 • Comercio: ${pt.nombre}
-• Dirección: ${pt.direccion}
+• Dirección: ${direccion}
 • División: ${pt.division}
 • Capa: ${pt.capa}
 • Tipo: ${pt.tipo}
 • Ubicación: ${pt.ubicacion}
-• Ubicación Geográfica: ${lineaUbic}
+• Ubicación Geográfica: ${lineaUbic}${lineaAnillos}
 • Trxs Octubre: ${pt.trxs_oct ?? 0}
 • Trxs Noviembre: ${pt.trxs_nov ?? 0}
 _____________________ Promedio: ${pt.promedio} _____________________`;
@@ -2382,9 +5068,9 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
         texto =
 `_____________________ OFICINA ${pt.atm} _____________________
 • Nombre: ${pt.nombre}
-• Dirección: ${pt.direccion}
+• Dirección: ${direccion}
 • División: ${pt.division}
-• Ubicación Geográfica: ${lineaUbic}
+• Ubicación Geográfica: ${lineaUbic}${lineaAnillos}
 
 ——— Métricas de la Oficina ———
 • TRX: ${pt.promedio}
@@ -2399,11 +5085,11 @@ _________________________________________`;
         texto =
 `_____________________ ATM ${pt.atm} _____________________
 • Nombre: ${pt.nombre}
-• Dirección: ${pt.direccion}
+• Dirección: ${direccion}
 • División: ${pt.division}
 • Tipo: ${pt.tipo}
 • Ubicación: ${pt.ubicacion}
-• Ubicación Geográfica: ${lineaUbic}
+• Ubicación Geográfica: ${lineaUbic}${lineaAnillos}
 _____________________ Promedio: ${pt.promedio} _____________________`;
       }
 
@@ -2428,14 +5114,16 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
     // ======================================================
     // CLIENTES
     // ======================================================
+    let vistaClientes = null;
+
     async function fetchClientes(){
       try {
-        const zoom = map.getZoom();
         const d = selDep.value, p = selProv.value, di = selDist.value, seg = selSegmento.value;
-        const qs = `zoom=${zoom}&departamento=${encodeURIComponent(d)}&provincia=${encodeURIComponent(p)}&distrito=${encodeURIComponent(di)}&segmento=${encodeURIComponent(seg)}`;
+        const qs = `departamento=${encodeURIComponent(d)}&provincia=${encodeURIComponent(p)}&distrito=${encodeURIComponent(di)}&segmento=${encodeURIComponent(seg)}&${vistaQS()}`;
+        vistaClientes = map.getBounds().pad(0.5);
         const res = await fetch(`/api/clientes?${qs}`);
         const data = await res.json();
-        heatClientes.setLatLngs(data.map(c => [c.lat, c.lon, 1]));
+        heatClientes.setLatLngs(data.map(c => [c.lat, c.lon, c.peso]));
         if (!map.hasLayer(heatClientes)) map.addLayer(heatClientes);
       } catch (err){
         console.error("Error cargando clientes:", err);
@@ -2455,10 +5143,14 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
       document.getElementById("cliTopSeg").textContent = js.top_segmento;
     }
 
+    let _recoSeq = 0;
     async function cargarRecomendaciones(){
+      const seq = ++_recoSeq;
+      const qs = `departamento=${encodeURIComponent(selDep.value)}&provincia=${encodeURIComponent(selProv.value)}&distrito=${encodeURIComponent(selDist.value)}&segmento=${encodeURIComponent(selSegmento.value)}`;
       try {
-        const res = await fetch("/api/recomendaciones");
+        const res = await fetch(`/api/recomendaciones?${qs}`);
         const data = await res.json();
+        if(seq !== _recoSeq) return;
         markersReco.clearLayers();
         data.forEach(r => {
           const m = L.marker([r.lat, r.lon], {
@@ -2476,32 +5168,82 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
       }
     }
 
+    // ======================================================
+    // ✅ VIEWPORT: solo se piden los puntos dentro del mapa visible
+    //   - bbox = vista actual + 50% de margen; el backend lo redondea
+    //   - al mover el mapa se vuelve a pedir solo si la vista sale
+    //     del último bbox descargado
+    // ======================================================
+    let ultimaVista = null;
+    let _puntosSeq = 0;
+    let _vistaTimer = null;
+    let ultimoZoom = null;
+    let vistaAgrupada = false;
+
+    // integral: por debajo de este zoom se dibujan los clústeres del backend
+    const CLUSTER_ZOOM_DETALLE = 13;
+
+    function vistaQS(){
+      return `bbox=${map.getBounds().pad(0.5).toBBoxString()}&zoom=${map.getZoom()}`;
+    }
+
+    function recordarVista(data){
+      const b = data.bbox;
+      ultimaVista = b ? L.latLngBounds([b[1], b[0]], [b[3], b[2]]) : null;
+    }
+
+    function ajustarVista(data){
+      if(!data.bounds){ map.setView(INITIAL_CENTER, INITIAL_ZOOM, {animate:false}); return; }
+      const b = L.latLngBounds(data.bounds);
+      if(b.getSouthWest().equals(b.getNorthEast())) map.setView(b.getCenter(), 16, {animate:false});
+      else map.fitBounds(b, {padding:[20,20], animate:false});
+    }
+
+    function vistaVigente(){
+      if(!ultimaVista || !ultimaVista.contains(map.getBounds())) return false;
+      // los clústeres dependen del zoom: se piden de nuevo al cambiarlo
+      if(TIPO_MAPA === "integral" && (vistaAgrupada || map.getZoom() < CLUSTER_ZOOM_DETALLE)){
+        return map.getZoom() === ultimoZoom;
+      }
+      return true;
+    }
+
+    function refrescarVista(){
+      if(vistaVigente()) return;
+      if(TIPO_MAPA === "integral") fetchIntegral(false);
+      else fetchPoints(false);
+    }
+
     // ======================================================
     // CAPAS NORMALES (NO integral)
     // ======================================================
-    async function fetchPoints(){
+    async function fetchPoints(ajustar = true){
       if(TIPO_MAPA === "integral") return;
 
       const d = selDep.value, p = selProv.value, di = selDist.value, dv = selDiv.value;
       const t_atm = selTipoATM ? selTipoATM.value : "";
       const u_atm = selUbicATM ? selUbicATM.value : "";
 
-      const qs = `tipo=${TIPO_MAPA}&departamento=${encodeURIComponent(d)}&provincia=${encodeURIComponent(p)}&distrito=${encodeURIComponent(di)}&division=${encodeURIComponent(dv)}&tipo_atm=${encodeURIComponent(t_atm)}&ubic_atm=${encodeURIComponent(u_atm)}`;
+      const qs = `tipo=${TIPO_MAPA}&departamento=${encodeURIComponent(d)}&provincia=${encodeURIComponent(p)}&distrito=${encodeURIComponent(di)}&division=${encodeURIComponent(dv)}&tipo_atm=${encodeURIComponent(t_atm)}&ubic_atm=${encodeURIComponent(u_atm)}&anillos=1&${vistaQS()}`;
 
-      infoBox.textContent = "...";
-      panelATM.classList.add("hidden");
+      const seq = ++_puntosSeq;
+      if(ajustar){
+        infoBox.textContent = "...";
+        panelATM.classList.add("hidden");
+      }
 
       const res = await fetch(`/api/points?${qs}`);
       const data = await res.json();
+      if(seq !== _puntosSeq) return;   // llegó una respuesta más nueva
       const pts = data.puntos || [];
 
       infoBox.textContent = data.total_atms ?? pts.length;
+      recordarVista(data);
 
       markers.clearLayers();
       heat.setLatLngs([]);
 
       let heatPts = [];
-      let bounds = [];
 
       pts.forEach(pt => {
         const icon = getIcon(pt);
@@ -2509,22 +5251,19 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
         m.on("click", () => showATMPanel(pt));
         markers.addLayer(m);
         heatPts.push([pt.lat, pt.lon, Math.max(1, pt.promedio || 1)]);
-        bounds.push([pt.lat, pt.lon]);
       });
 
       heat.setLatLngs(heatPts);
 
-      if(bounds.length === 1) map.setView(bounds[0], 16);
-      else if(bounds.length > 1) map.fitBounds(bounds, {padding:[20,20]});
-      else map.setView(INITIAL_CENTER, INITIAL_ZOOM);
-
       if(chkHeat.checked){
         if(!map.hasLayer(heat)) heat.addTo(map);
       }else{
         if(map.hasLayer(heat)) map.removeLayer(heat);
       }
 
-      updateDivisionBorderFromPoints(bounds.map(b => L.latLng(b[0], b[1])));
+      if(!ajustar) return;   // solo cambió la vista: paneles, zonas, nodos y borde siguen igual
+      ajustarVista(data);
+      fetchDivisionBorder({islas: "atm", agentes: "agente", oficinas: "oficina"}[TIPO_MAPA]);
 
       if(TIPO_MAPA === "islas"){
         document.getElementById("resAtmTotal").textContent = data.total_atms || 0;
@@ -2587,27 +5326,62 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
       if(panelAgResumen)  panelAgResumen.classList.toggle("hidden", !(chkAgentes && chkAgentes.checked));
     }
 
-    async function fetchIntegral(){
+    function clusterIcon(c){
+      const size = Math.round(30 + 8 * Math.log10(Math.max(1, c.n)));
+      return L.divIcon({
+        className: "srv-cluster-icon",
+        html: `<div class="srv-cluster ${c.capa}" style="width:${size}px;height:${size}px">${c.n}</div>`,
+        iconSize: [size,size],
+        iconAnchor: [size/2,size/2]
+      });
+    }
+
+    function pintarClusters(clusters, heatPts){
+      clusters.forEach(c=>{
+        const m = L.marker([c.lat, c.lon], {icon: clusterIcon(c), zIndexOffset: 1000});
+        m.on("click", ()=> map.fitBounds(c.bounds, {padding:[30,30], maxZoom: CLUSTER_ZOOM_DETALLE}));
+        clustersLayer.addLayer(m);
+        if(c.capa === "atm") heatPts.push([c.lat, c.lon, Math.max(1, c.suma_promedio || 1)]);
+      });
+    }
+
+    async function fetchIntegral(ajustar = true){
       if(TIPO_MAPA !== "integral") return;
 
       const d = selDep.value, p = selProv.value, di = selDist.value, dv = selDiv.value;
-      const qs = `departamento=${encodeURIComponent(d)}&provincia=${encodeURIComponent(p)}&distrito=${encodeURIComponent(di)}&division=${encodeURIComponent(dv)}`;
+      const qs = `departamento=${encodeURIComponent(d)}&provincia=${encodeURIComponent(p)}&distrito=${encodeURIComponent(di)}&division=${encodeURIComponent(dv)}&${vistaQS()}`;
 
-      infoBox.textContent = "...";
-      panelATM.classList.add("hidden");
+      const showATMs = !chkATMs || chkATMs.checked;
+      const showOfi  = !chkOficinas || chkOficinas.checked;
+      const showAg   = !chkAgentes || chkAgentes.checked;
 
-      const res = await fetch(`/api/points_integral?${qs}`);
-      const data = await res.json();
+      // zoom bajo: el backend agrupa y aquí solo se dibujan unos cientos de clústeres
+      const zoom = map.getZoom();
+      const agrupar = zoom < CLUSTER_ZOOM_DETALLE;
+      const capas = [showATMs && "atm", showOfi && "oficina", showAg && "agente"].filter(Boolean).join(",");
+
+      const seq = ++_puntosSeq;
+      if(ajustar){
+        infoBox.textContent = "...";
+        panelATM.classList.add("hidden");
+      }
+
+      const [data, cl] = await Promise.all([
+        fetch(`/api/points_integral?${qs}${agrupar ? "&puntos=0" : ""}`).then(r => r.json()),
+        (agrupar && capas) ? fetch(`/api/clusters?${qs}&capas=${capas}`).then(r => r.json()) : null,
+      ]);
+      if(seq !== _puntosSeq) return;   // llegó una respuesta más nueva
+      recordarVista(data);
+      ultimoZoom = zoom;
+      vistaAgrupada = agrupar;
 
       markers.clearLayers();
+      clustersLayer.clearLayers();
       heat.setLatLngs([]);
 
-      let bounds = [];
       let heatPts = [];
 
-      const showATMs = !chkATMs || chkATMs.checked;
-      const showOfi  = !chkOficinas || chkOficinas.checked;
-      const showAg   = !chkAgentes || chkAgentes.checked;
+      if(cl) pintarClusters(cl.clusters || [], heatPts);
 
       if(showATMs){
         (data.atms || []).forEach(pt=>{
@@ -2617,7 +5391,6 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
           m.on("click",()=>showATMPanel(pt));
           markers.addLayer(m);
           heatPts.push([pt.lat, pt.lon, Math.max(1, pt.promedio || 1)]);
-          bounds.push([pt.lat, pt.lon]);
         });
       }
 
@@ -2626,7 +5399,6 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
           const m = L.marker([pt.lat, pt.lon], {icon:ICON_OFICINA, zIndexOffset: 1400});
           m.on("click",()=>showATMPanel(pt));
           markers.addLayer(m);
-          bounds.push([pt.lat, pt.lon]);
         });
       }
 
@@ -2635,36 +5407,26 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
           const m = L.marker([pt.lat, pt.lon], {icon:ICON_AGENTE, zIndexOffset: 1200});
           m.on("click",()=>showATMPanel(pt));
           markers.addLayer(m);
-          bounds.push([pt.lat, pt.lon]);
         });
       }
 
       heat.setLatLngs(heatPts);
 
-      if(bounds.length === 1) map.setView(bounds[0], 16);
-      else if(bounds.length > 1) map.fitBounds(bounds, {padding:[20,20]});
-      else map.setView(INITIAL_CENTER, INITIAL_ZOOM);
-
       if(chkHeat.checked){
         if(!map.hasLayer(heat)) heat.addTo(map);
       }else{
         if(map.hasLayer(heat)) map.removeLayer(heat);
       }
 
-      updateDivisionBorderFromPoints(bounds.map(b => L.latLng(b[0], b[1])));
+      if(!ajustar) return;   // solo cambió la vista: paneles, zonas, nodos y borde siguen igual
+      ajustarVista(data);
+      fetchDivisionBorder(capas);
 
-      // --- Panel ATMs ---
+      // --- Panel ATMs (conteos de toda la selección, calculados en backend) ---
       let atm_total = (data.total_atms || 0);
       let atm_suma  = (data.suma_atms || 0);
-      let atm_ofi=0, atm_isla=0, atm_disp=0, atm_mon=0, atm_rec=0;
-      (data.atms || []).forEach(pt=>{
-        const u = (pt.ubicacion || "").toUpperCase();
-        const t = (pt.tipo || "").toUpperCase();
-        if(u.includes("OFICINA")) atm_ofi++; else atm_isla++;
-        if(t.includes("DISPENSADOR")) atm_disp++;
-        if(t.includes("MONEDERO")) atm_mon++;
-        if(t.includes("RECICLADOR")) atm_rec++;
-      });
+      const atm_ofi = data.atm_en_oficina || 0, atm_isla = data.atm_en_isla || 0;
+      const atm_disp = data.atm_disp || 0, atm_mon = data.atm_mon || 0, atm_rec = data.atm_rec || 0;
 
       document.getElementById("resAtmTotal").textContent = showATMs ? atm_total : 0;
       document.getElementById("resAtmSuma").textContent  = showATMs ? Math.round(atm_suma) : 0;
@@ -2692,15 +5454,8 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
       const ag_total = (data.total_agentes || 0);
       const ag_suma  = (data.suma_agentes || 0);
 
-      let a1=0,a2=0,a3=0,b=0,c=0;
-      (data.agentes || []).forEach(pt=>{
-        const capa = (pt.capa || "").toUpperCase().trim();
-        if(capa === "A1") a1++;
-        else if(capa === "A2") a2++;
-        else if(capa === "A3") a3++;
-        else if(capa === "B") b++;
-        else if(capa === "C") c++;
-      });
+      const a1 = data.ag_capa_A1 || 0, a2 = data.ag_capa_A2 || 0, a3 = data.ag_capa_A3 || 0;
+      const b = data.ag_capa_B || 0, c = data.ag_capa_C || 0;
 
       document.getElementById("resAgTotal").textContent = showAg ? ag_total : 0;
       document.getElementById("resAgSuma").textContent  = showAg ? Math.round(ag_suma) : 0;
@@ -2730,7 +5485,10 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
       selProv.onchange= ()=>{ updateDistritos(); fetchIntegral(); if (chkHeatClientes.checked) fetchResumenClientes(); };
       selDist.onchange= ()=>{ updateDivisiones(); fetchIntegral(); if (chkHeatClientes.checked) fetchResumenClientes(); };
       selDiv.onchange = ()=> fetchIntegral();
-      selSegmento.onchange = ()=>{ if (chkHeatClientes.checked){ fetchClientes(); fetchResumenClientes(); } };
+      selSegmento.onchange = ()=>{
+        if (chkHeatClientes.checked){ fetchClientes(); fetchResumenClientes(); }
+        if (chkReco.checked) cargarRecomendaciones();
+      };
 
       if(chkATMs) chkATMs.onchange = ()=> fetchIntegral();
       if(chkOficinas) chkOficinas.onchange = ()=> fetchIntegral();
@@ -2779,7 +5537,10 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
       selProv.onchange= ()=>{ updateDistritos(); fetchPoints(); if (chkHeatClientes.checked) fetchResumenClientes(); };
       selDist.onchange= ()=>{ updateDivisiones(); fetchPoints(); if (chkHeatClientes.checked) fetchResumenClientes(); };
       selDiv.onchange = ()=> fetchPoints();
-      selSegmento.onchange = ()=>{ if (chkHeatClientes.checked){ fetchClientes(); fetchResumenClientes(); } };
+      selSegmento.onchange = ()=>{
+        if (chkHeatClientes.checked){ fetchClientes(); fetchResumenClientes(); }
+        if (chkReco.checked) cargarRecomendaciones();
+      };
 
       if (selTipoATM) selTipoATM.onchange = ()=> fetchPoints();
       if (selUbicATM) selUbicATM.onchange = ()=> fetchPoints();
@@ -2842,7 +5603,19 @@ _____________________ Promedio: ${pt.promedio} _____________________`;
       fetchPoints();
     }
 
-    map.on("zoomend", ()=>{ if (chkHeatClientes.checked) fetchClientes(); });
+    map.on("zoomend", ()=>{
+      if (chkHeatClientes.checked) fetchClientes();
+      const zonasVisibles = (chkZonaRural && chkZonaRural.checked) || (chkZonaUrbana && chkZonaUrbana.checked);
+      if (zonasVisibles && zonasNivel !== null && nivelZonasPara(map.getZoom()) !== zonasNivel) fetchZonasBorders();
+    });
+    map.on("moveend", ()=>{
+      clearTimeout(_vistaTimer);
+      _vistaTimer = setTimeout(()=>{
+        refrescarVista();
+        // celdas de clientes: solo se piden de nuevo si la vista salió de las ya recibidas
+        if (chkHeatClientes.checked && vistaClientes && !vistaClientes.contains(map.getBounds())) fetchClientes();
+      }, 150);
+    });
   </script>
 </body>
 </html>
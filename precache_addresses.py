@@ -1,64 +1,262 @@
 import os
+import re
+import sys
 import json
 import time
+import random
+import argparse
+import tempfile
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
 import pandas as pd
+from requests.adapters import HTTPAdapter
 
 # -------------------------
-# Configuración
+# Configuración (flags o variables de entorno)
+#   python precache_addresses.py --capas atm,agentes --rps 1
+#   NOMINATIM_URL=http://localhost:8080/reverse python precache_addresses.py --rps 50 --workers 16
 # -------------------------
-import os
-BASE_DIR = os.path.dirname(__file__)
-EXCEL_FILE = os.path.join(BASE_DIR, "data", "Mapa Geoespacial ATM (1) (1).xlsx")
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 OUTPUT_CACHE = os.path.join(BASE_DIR, "address_cache.json")
 
-COL_LAT = "LATITUD"
-COL_LON = "LONGITUD"
+CAPAS = {
+    "atm": os.path.join(BASE_DIR, "data", "Mapa Geoespacial ATM (1) (1).xlsx"),
+    "agentes": os.path.join(BASE_DIR, "data", "AGENTES.xlsx"),
+    "oficinas": os.path.join(BASE_DIR, "data", "OFICINAS.xlsx"),
+    "nodos": os.path.join(BASE_DIR, "data", "NODOS1.xlsx"),
+}
+# mismo respaldo que usa geoespacial.py para NODOS1.xlsx
+if not os.path.exists(CAPAS["nodos"]) and os.path.exists("/mnt/data/NODOS1.xlsx"):
+    CAPAS["nodos"] = "/mnt/data/NODOS1.xlsx"
+
+SIN_DIRECCION = "Sin dirección"
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Precarga direcciones (reverse geocoding) de todos los canales.")
+    p.add_argument("--url", default=os.getenv("NOMINATIM_URL", "https://nominatim.openstreetmap.org/reverse"),
+                   help="endpoint reverse de Nominatim (o un servicio local compatible)")
+    p.add_argument("--capas", default=os.getenv("PRECACHE_CAPAS", ",".join(CAPAS)),
+                   help="capas a recorrer: " + ",".join(CAPAS))
+    p.add_argument("--rps", type=float, default=float(os.getenv("PRECACHE_RPS", "1")),
+                   help="consultas por segundo (Nominatim público: 1)")
+    p.add_argument("--workers", type=int, default=int(os.getenv("PRECACHE_WORKERS", "4")))
+    p.add_argument("--reintentos", type=int, default=int(os.getenv("PRECACHE_REINTENTOS", "4")))
+    p.add_argument("--timeout", type=float, default=float(os.getenv("PRECACHE_TIMEOUT", "15")))
+    p.add_argument("--checkpoint", type=int, default=int(os.getenv("PRECACHE_CHECKPOINT", "50")),
+                   help="guardar el cache cada N direcciones nuevas")
+    p.add_argument("--limite", type=int, default=0, help="máximo de consultas (0 = todas)")
+    p.add_argument("--user-agent", default=os.getenv("PRECACHE_USER_AGENT", "GeoApp/1.0"))
+    p.add_argument("--salida", default=OUTPUT_CACHE)
+    return p.parse_args()
+
 # -------------------------
-# Cargar Excel
+# Claves: mismo formato que get_address() en geoespacial.py
 # -------------------------
-df = pd.read_excel(EXCEL_FILE)
+def clave(lat, lon):
+    return f"{float(lat):.6f},{float(lon):.6f}"
+
+def normalize_col(s):
+    s = unicodedata.normalize("NFKD", str(s)).encode("ascii", "ignore").decode("utf-8")
+    return re.sub(r"\s+", " ", re.sub(r"[^A-Z0-9 ]+", " ", s.upper())).strip()
+
+def to_coord(s):
+    return pd.to_numeric(
+        s.astype(str).str.replace(",", ".", regex=False).str.replace(r"[^\d\.\-]", "", regex=True),
+        errors="coerce",
+    )
+
+def coordenadas_capa(path):
+    """
+    Pares (lat, lon) únicos de un Excel de canal, detectando las columnas
+    igual que los cargadores de geoespacial.py.
+    """
+    raw = pd.read_excel(path)
+    norm_map = {normalize_col(c): c for c in raw.columns}
+
+    def find_col(keys):
+        for norm, orig in norm_map.items():
+            for k in keys:
+                if k in norm:
+                    return orig
+        return None
+
+    c_lat = find_col(["LATITUD", "LAT"])
+    c_lon = find_col(["LONGITUD", "LON"])
+    if c_lat is None or c_lon is None:
+        print(f"⚠ {os.path.basename(path)}: sin columnas de latitud/longitud")
+        return []
+    coords = pd.DataFrame({"lat": to_coord(raw[c_lat]), "lon": to_coord(raw[c_lon])}).dropna()
+    return list(dict.fromkeys(zip(coords["lat"].tolist(), coords["lon"].tolist())))
 
 # -------------------------
-# Cargar cache previo (si existe)
+# Cache: carga (migrando claves viejas "lat,lon") y guardado atómico
 # -------------------------
-if os.path.exists(OUTPUT_CACHE):
-    with open(OUTPUT_CACHE, "r", encoding="utf-8") as f:
-        address_cache = json.load(f)
-else:
-    address_cache = {}
+def cargar_cache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        crudo = json.load(f)
+    cache = {}
+    for k, v in crudo.items():
+        try:
+            lat, lon = k.split(",")
+            cache[clave(lat, lon)] = v
+        except ValueError:
+            cache[k] = v
+    return cache
+
+def guardar_cache(path, cache):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp_cache_")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
 
 # -------------------------
-# Función para consultar Nominatim
+# Rate limiter (token bucket compartido por todos los hilos)
 # -------------------------
-def fetch_address(lat, lon):
-    url = f"https://nominatim.openstreetmap.org/reverse"
-    params = {"lat": lat, "lon": lon, "format": "json", "zoom": 16}
-    try:
-        r = requests.get(url, params=params, headers={"User-Agent": "GeoApp/1.0"})
-        if r.status_code == 200:
-            data = r.json()
-            return data.get("display_name", "Sin dirección")
-    except Exception as e:
-        print("❌ Error:", e)
-    return "Sin dirección"
+class TokenBucket:
+    def __init__(self, rps, capacidad=None):
+        self.rps = rps
+        self.capacidad = capacidad or max(1.0, rps)
+        self.tokens = 1.0
+        self.t = time.monotonic()
+        self.lock = threading.Lock()
+
+    def tomar(self):
+        while True:
+            with self.lock:
+                ahora = time.monotonic()
+                self.tokens = min(self.capacidad, self.tokens + (ahora - self.t) * self.rps)
+                self.t = ahora
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                espera = (1.0 - self.tokens) / self.rps
+            time.sleep(espera)
 
 # -------------------------
-# Recorrer registros
+# Cliente Nominatim: sesión con pool + reintentos con backoff
 # -------------------------
-for _, row in df.iterrows():
-    lat, lon = row[COL_LAT], row[COL_LON]
-    key = f"{lat},{lon}"
+class Geocoder:
+    def __init__(self, args):
+        self.url = args.url
+        self.timeout = args.timeout
+        self.reintentos = args.reintentos
+        self.bucket = TokenBucket(args.rps)
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = args.user_agent
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=args.workers))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=args.workers))
+        self.stats = {"consultas": 0, "reintentos": 0, "errores": 0}
+        self.lock = threading.Lock()
 
-    if key not in address_cache:  # Solo si no está guardado
-        print(f"🌍 Consultando {key} ...")
-        address_cache[key] = fetch_address(lat, lon)
-        time.sleep(1)  # ⚠️ Espera para no ser bloqueado
+    def _contar(self, k):
+        with self.lock:
+            self.stats[k] += 1
+
+    def reverse(self, lat, lon):
+        """
+        Dirección (display_name o SIN_DIRECCION); None si falló tras los reintentos.
+        """
+        params = {"lat": lat, "lon": lon, "format": "json", "zoom": 16}
+        for intento in range(self.reintentos + 1):
+            if intento:
+                self._contar("reintentos")
+            self.bucket.tomar()
+            self._contar("consultas")
+            espera = None
+            try:
+                r = self.session.get(self.url, params=params, timeout=self.timeout)
+                if r.status_code == 200:
+                    return r.json().get("display_name", SIN_DIRECCION)
+                if r.status_code not in (429, 500, 502, 503, 504):
+                    print(f"❌ {lat},{lon}: HTTP {r.status_code}")
+                    break
+                ra = r.headers.get("Retry-After", "")
+                espera = float(ra) if ra.replace(".", "", 1).isdigit() else None
+            except (requests.RequestException, ValueError) as e:
+                print(f"⚠ {lat},{lon}: {e}")
+            if intento < self.reintentos:
+                time.sleep(espera if espera is not None else min(60.0, 2 ** intento) * (0.5 + random.random()))
+        self._contar("errores")
+        return None
 
 # -------------------------
-# Guardar cache
+# Pipeline
 # -------------------------
-with open(OUTPUT_CACHE, "w", encoding="utf-8") as f:
-    json.dump(address_cache, f, ensure_ascii=False, indent=2)
+def main():
+    args = parse_args()
+    cache = cargar_cache(args.salida)
+    print(f"📦 Cache previo: {len(cache)} direcciones")
+
+    pendientes, vistos, en_cache = [], set(), 0
+    for capa in [c.strip() for c in args.capas.split(",") if c.strip()]:
+        path = CAPAS.get(capa)
+        if path is None or not os.path.exists(path):
+            print(f"⚠ Capa {capa}: no encontré {path}")
+            continue
+        coords = coordenadas_capa(path)
+        nuevos = 0
+        for lat, lon in coords:
+            k = clave(lat, lon)
+            if k in cache:
+                en_cache += 1
+            elif k not in vistos:
+                vistos.add(k)
+                pendientes.append((k, lat, lon))
+                nuevos += 1
+        print(f"🗂 {capa}: {len(coords)} ubicaciones, {nuevos} por consultar")
+
+    if args.limite:
+        pendientes = pendientes[:args.limite]
+    print(f"🌍 Consultando {len(pendientes)} ubicaciones ({en_cache} ya en cache) "
+          f"a {args.rps:g} req/s con {args.workers} hilos -> {args.url}")
+    if not pendientes:
+        return
+
+    geo = Geocoder(args)
+    t0 = time.monotonic()
+    ok = fallidas = desde_checkpoint = 0
+
+    def progreso():
+        dt = max(time.monotonic() - t0, 1e-9)
+        s = geo.stats
+        return (f"{ok + fallidas}/{len(pendientes)} | ok {ok} | fallidas {fallidas} | "
+                f"consultas {s['consultas']} | reintentos {s['reintentos']} | "
+                f"{s['consultas'] / dt:.2f} req/s | {(ok + fallidas) / dt:.2f} dir/s")
+
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+    futuros = {pool.submit(geo.reverse, lat, lon): k for k, lat, lon in pendientes}
+    try:
+        for fut in as_completed(futuros):
+            direccion = fut.result()
+            if direccion is None:
+                fallidas += 1  # no se guarda: se reintenta en la próxima corrida
+                continue
+            cache[futuros[fut]] = direccion
+            ok += 1
+            desde_checkpoint += 1
+            if desde_checkpoint >= args.checkpoint:
+                guardar_cache(args.salida, cache)
+                desde_checkpoint = 0
+                print(f"💾 Checkpoint: {progreso()}")
+    except KeyboardInterrupt:
+        print("⚠ Interrumpido: guardando lo avanzado...")
+        pool.shutdown(wait=False, cancel_futures=True)
+        guardar_cache(args.salida, cache)
+        sys.exit(1)
+    pool.shutdown()
+
+    guardar_cache(args.salida, cache)
+    print(f"✅ {progreso()}")
+    print(f"✅ Cache actualizado en {args.salida} con {len(cache)} direcciones")
 
-print(f"✅ Cache actualizado en {OUTPUT_CACHE} con {len(address_cache)} direcciones")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
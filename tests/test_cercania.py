@@ -0,0 +1,144 @@
+"""
+Cercanía contra fuerza bruta: vecinos_cercanos / DIST_<CANAL>_M contra el
+mínimo de haversine, y simular_canales contra reconstruir todo.
+
+Ojo: importa geoespacial desde la raíz del repo, que necesita la data
+privada (data/clientes_huanuco_v6.csv y los Excel). Sin ese CSV el módulo
+entero se salta ("1 skipped"): en un checkout sin data estas pruebas,
+incluida la de simular_canales contra reconstruir, NUNCA corren.
+"""
+import os
+
+import numpy as np
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if not os.path.exists(os.path.join(RAIZ, "data", "clientes_huanuco_v6.csv")):
+    pytest.skip("falta data/clientes_huanuco_v6.csv", allow_module_level=True)
+
+
+@pytest.fixture(scope="module")
+def g():
+    cwd = os.getcwd()
+    os.chdir(RAIZ)
+    try:
+        import geoespacial
+    finally:
+        os.chdir(cwd)
+    return geoespacial
+
+
+def _muestra(g, n, semilla):
+    cl = g.df_clientes
+    pos = np.random.default_rng(semilla).choice(len(cl), min(n, len(cl)), replace=False)
+    return pos, g.SIM_LATS[pos], g.SIM_LONS[pos]
+
+
+def _fuerza_bruta(g, lats, lons, plats, plons):
+    mejor = np.empty(len(lats), dtype=np.int64)
+    dist = np.empty(len(lats))
+    for i in range(0, len(lats), 500):
+        d = g.haversine_m(lats[i:i + 500, None], lons[i:i + 500, None], plats[None, :], plons[None, :])
+        mejor[i:i + 500] = np.argmin(d, axis=1)
+        dist[i:i + 500] = d[np.arange(len(d)), mejor[i:i + 500]]
+    return mejor, dist
+
+
+def test_vecinos_cercanos_igual_a_haversine(g):
+    rng = np.random.default_rng(0)
+    plats, plons = rng.uniform(-18.5, 0.0, 3000), rng.uniform(-81.5, -68.5, 3000)
+    # consultas dentro y lejos de la nube, y puntos repetidos
+    lats = np.r_[rng.uniform(-20.0, 2.0, 2000), plats[:50]]
+    lons = np.r_[rng.uniform(-84.0, -66.0, 2000), plons[:50]]
+
+    pos, dist = g.vecinos_cercanos(g.construir_indice_cercania(plats, plons), lats, lons)
+    _, ref = _fuerza_bruta(g, lats, lons, plats, plons)
+    np.testing.assert_allclose(dist, ref, rtol=0, atol=1e-6)
+    np.testing.assert_allclose(g.haversine_m(lats, lons, plats[pos], plons[pos]), ref, rtol=0, atol=1e-6)
+
+
+def test_vecinos_cercanos_indice_vacio(g):
+    indice = g.construir_indice_cercania([], [])
+    pos, dist = g.vecinos_cercanos(indice, [-9.9], [-76.2])
+    assert pos.tolist() == [-1] and np.isinf(dist).all()
+
+
+@pytest.mark.parametrize("canal", ["atm", "agente", "oficina"])
+def test_dist_canal_igual_a_haversine(g, canal):
+    fc, clat, clon = g.COBERTURA_CANALES[canal]
+    if fc is None or fc.empty:
+        pytest.skip(f"sin puntos de {canal}")
+    pos, lats, lons = _muestra(g, 3000, 1)
+    _, ref = _fuerza_bruta(g, lats, lons, fc[clat].to_numpy(dtype=float), fc[clon].to_numpy(dtype=float))
+    got = g.df_clientes[f"DIST_{canal.upper()}_M"].to_numpy()[pos]
+    np.testing.assert_allclose(got, ref.astype(np.float32), rtol=1e-6)
+
+
+def _reconstruir(g, agregar, quitar, canales):
+    """
+    Distancia al canal más cercano de cada cliente reconstruyendo los
+    puntos de cada canal con los cambios aplicados.
+    """
+    out = np.full(len(g.df_clientes), np.inf, dtype=np.float32)
+    for canal in canales:
+        fc, clat, clon = g.COBERTURA_CANALES[canal]
+        plats, plons = fc[clat].to_numpy(dtype=float), fc[clon].to_numpy(dtype=float)
+        queda = np.ones(len(plats), dtype=bool)
+        for c, la, lo in quitar:
+            if c == canal:
+                d = np.where(queda, g.haversine_m(la, lo, plats, plons), np.inf)
+                queda[np.argmin(d)] = False
+        nuevos = [(la, lo) for c, la, lo in agregar if c == canal]
+        plats = np.r_[plats[queda], [la for la, _ in nuevos]]
+        plons = np.r_[plons[queda], [lo for _, lo in nuevos]]
+        pos, _ = g.vecinos_cercanos(g.construir_indice_cercania(plats, plons), g.SIM_LATS, g.SIM_LONS)
+        out = np.minimum(out, g.haversine_m(g.SIM_LATS, g.SIM_LONS, plats[pos], plons[pos]).astype(np.float32))
+    return out
+
+
+@pytest.mark.parametrize("semilla", [3, 4, 5])
+def test_simular_igual_a_reconstruir(g, semilla):
+    rng = np.random.default_rng(semilla)
+    canales = [c for c, (fc, _, _) in g.COBERTURA_CANALES.items() if fc is not None and len(fc) > 3]
+    if not canales:
+        pytest.skip("sin canales")
+    agregar, quitar = [], []
+    for _ in range(3):
+        i = rng.integers(len(g.SIM_LATS))
+        agregar.append((str(rng.choice(canales)), float(g.SIM_LATS[i]) + 0.01, float(g.SIM_LONS[i])))
+        canal = str(rng.choice(canales))
+        fc, clat, clon = g.COBERTURA_CANALES[canal]
+        j = rng.integers(len(fc))
+        quitar.append((canal, float(fc[clat].iloc[j]), float(fc[clon].iloc[j])))
+
+    cambios, no_encontrados = g.simular_canales(agregar, quitar)
+    assert no_encontrados == []
+    _, despues, _ = g.cobertura_simulada(np.arange(len(g.df_clientes)), canales, cambios)
+    np.testing.assert_allclose(despues, _reconstruir(g, agregar, quitar, canales), rtol=1e-6)
+
+
+@pytest.mark.parametrize("canal", ["atm", "agente", "oficina"])
+def test_clientes_cerca_de_no_omite_ninguno(g, canal):
+    # todo cliente que un punto nuevo acerca debe estar entre los candidatos
+    pos, lats, lons = _muestra(g, 20, 6)
+    nlats, nlons = lats + 0.02, lons - 0.02
+    cand = g.clientes_cerca_de(canal, nlats, nlons)
+    base = g.df_clientes[f"DIST_{canal.upper()}_M"].to_numpy()
+    for la, lo in zip(nlats, nlons):
+        mejora = np.flatnonzero(g.haversine_m(g.SIM_LATS, g.SIM_LONS, la, lo) < base)
+        assert np.isin(mejora, cand).all()
+
+
+def test_contar_en_radios_lejos_de_la_latitud_mediana(g):
+    # del ecuador a 60°: cos(lat) / cos(mediana) baja mucho de 1
+    rng = np.random.default_rng(2)
+    plats, plons = rng.uniform(0.0, 60.0, 40000), rng.uniform(-10.0, 10.0, 40000)
+    lats, lons = rng.uniform(0.0, 60.0, 300), rng.uniform(-10.0, 10.0, 300)
+    radios = [3000, 30000]
+
+    got = g.contar_en_radios(lats, lons, plats, plons, radios)
+    r_grados = np.asarray(radios, dtype=float) / np.radians(g._RADIO_TIERRA_M)
+    d2 = (lats[:, None] - plats) ** 2 + ((lons[:, None] - plons) * np.cos(np.radians(lats))[:, None]) ** 2
+    ref = np.stack([np.count_nonzero(d2 <= r * r, axis=1) for r in r_grados], axis=1)
+    np.testing.assert_array_equal(got, ref)